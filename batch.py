@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+"""Compress a directory tree of PDFs in parallel with the SovPDF engine.
+
+Every PDF below the input directory is written to the same relative path
+below the output directory, and one JSON line per file is printed with the
+result (or the error) of that file.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# The engine lives next to the web app so the browser can load it too
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "docs"))
+
+from cache import DEFAULT_MAX_BYTES, FileStorage, ResultCache, cache_key, input_digest  # noqa: E402
+from engine import PRESETS, compress_file  # noqa: E402
+from instrument import Instrumentation  # noqa: E402
+from linearize import check_linearization  # noqa: E402
+from streaming import compress_streaming  # noqa: E402
+from target import compress_to_target  # noqa: E402
+
+
+def find_pdfs(root):
+    """Return the paths of all PDF files below root"""
+    found = []
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.lower().endswith(".pdf"):
+                found.append(os.path.join(dirpath, name))
+    return found
+
+
+def compress_job(input_path, output_path, preset, target_size=None, report=None, memory_budget=None,
+                 cache_dir=None, cache_size=DEFAULT_MAX_BYTES, linearize=False):
+    """Worker entry point: never raises, so one bad file can't stop the batch
+
+    report is None, "timing" or "memory"; with "memory", tracemalloc gives
+    exact per-stage peaks at the cost of speed. With memory_budget (bytes),
+    the file is compressed in streaming mode within that budget. With
+    cache_dir, results are looked up in and added to a result cache there
+    of at most cache_size bytes. With linearize, the output is laid out for
+    fast web view and checked; any problems found are listed under
+    "linearization_problems".
+    """
+    instr = Instrumentation(trace_memory=report == "memory") if report else None
+    try:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        if cache_dir:
+            cache = ResultCache(FileStorage(cache_dir), cache_size)
+            with open(input_path, "rb") as f:
+                digest = input_digest(f.read())
+            # Everything the output depends on: the settings, and streaming's page windows
+            if target_size:
+                request = {"target": target_size}
+            else:
+                request = {"preset": preset, **PRESETS[preset]}
+                if memory_budget:
+                    request["memory_budget"] = memory_budget
+            if linearize:
+                request["linearize"] = True
+            key = cache_key(digest, request)
+            cached = asyncio.run(cache.get(key))
+            if cached is not None:
+                data, stats = cached
+                with open(output_path, "wb") as f:
+                    f.write(data)
+                return {"input": input_path, "output": output_path, **stats, "cached": True}
+
+        if target_size:
+            sink, stats = compress_to_target(input_path, target_size, instr=instr, linearize=linearize)
+            with open(output_path, "wb") as f:
+                f.write(sink.getbuffer())
+        elif memory_budget:
+            stats = compress_streaming(input_path, output_path, preset, memory_budget, instr)
+        else:
+            stats = compress_file(input_path, output_path, preset, instr, linearize)
+            stats = {name: value for name, value in stats.items() if name not in ("input", "output")}
+
+        if linearize:
+            with open(output_path, "rb") as f:
+                problems = check_linearization(f.read())
+            if problems:
+                stats["linearization_problems"] = problems
+        if cache_dir:
+            with open(output_path, "rb") as f:
+                data = f.read()
+            asyncio.run(cache.put(key, data, len(data), stats))
+        return {"input": input_path, "output": output_path, **stats}
+    except Exception as e:
+        return {
+            "input": input_path,
+            "output": output_path,
+            "preset": preset,
+            "error": f"{type(e).__name__}: {e}",
+        }
+    finally:
+        if instr is not None:
+            instr.close()
+
+
+def run_batch(input_dir, output_dir, preset, workers, out=sys.stdout, target_size=None, report=None,
+              memory_budget=None, cache_dir=None, cache_size=DEFAULT_MAX_BYTES, linearize=False):
+    """Compress every PDF below input_dir, writing one JSON line per file to out
+
+    With target_size (bytes), each file is fitted under that size instead of
+    using preset. report, memory_budget, cache_dir, cache_size and linearize
+    are passed on to compress_job.
+
+    Returns the number of files that failed.
+    """
+    pdfs = find_pdfs(input_dir)
+    # Largest files first, so a big file picked up last doesn't leave every
+    # other worker idle while it finishes
+    pdfs.sort(key=os.path.getsize, reverse=True)
+
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for input_path in pdfs:
+            relative = os.path.relpath(input_path, input_dir)
+            output_path = os.path.join(output_dir, relative)
+            futures.append(pool.submit(compress_job, input_path, output_path, preset,
+                                       target_size, report, memory_budget, cache_dir, cache_size, linearize))
+
+        for future in as_completed(futures):
+            result = future.result()
+            if "error" in result:
+                failures += 1
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input_dir", help="directory tree to scan for PDFs")
+    parser.add_argument("output_dir", help="where compressed PDFs are written")
+    parser.add_argument("-p", "--preset", choices=sorted(PRESETS), default="medium")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes (default: all cores)")
+    parser.add_argument("-t", "--target-size", type=float, metavar="MB",
+                        help="fit each file under this size instead of using a preset")
+    parser.add_argument("-m", "--memory-budget", type=float, metavar="MB",
+                        help="stream each file through in page windows using about this much memory")
+    parser.add_argument("-l", "--linearize", action="store_true",
+                        help="lay the outputs out for fast web view (not with --memory-budget)")
+    parser.add_argument("-c", "--cache", metavar="DIR",
+                        help="reuse results of earlier runs on the same files and settings, kept in DIR")
+    parser.add_argument("--cache-size", type=float, default=DEFAULT_MAX_BYTES / 1024 / 1024, metavar="MB",
+                        help="evict the least recently used cached results above this size (default: %(default)g)")
+    parser.add_argument("-o", "--results", help="write JSON lines here instead of stdout")
+    parser.add_argument("-r", "--report", choices=["timing", "memory"],
+                        help="add a per-stage instrumentation report to every result")
+    args = parser.parse_args(argv)
+    target_size = int(args.target_size * 1024 * 1024) if args.target_size else None
+    memory_budget = int(args.memory_budget * 1024 * 1024) if args.memory_budget else None
+    cache_size = int(args.cache_size * 1024 * 1024)
+
+    if os.path.abspath(args.input_dir) == os.path.abspath(args.output_dir):
+        parser.error("output_dir must differ from input_dir")
+    if args.linearize and memory_budget:
+        parser.error("--linearize can't be combined with --memory-budget")
+
+    if args.results:
+        with open(args.results, "w") as out:
+            failures = run_batch(args.input_dir, args.output_dir, args.preset, args.workers,
+                                 out, target_size, args.report, memory_budget, args.cache, cache_size,
+                                 args.linearize)
+    else:
+        failures = run_batch(args.input_dir, args.output_dir, args.preset, args.workers,
+                             target_size=target_size, report=args.report, memory_budget=memory_budget,
+                             cache_dir=args.cache, cache_size=cache_size, linearize=args.linearize)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+#! /usr/bin/env python
+"""Generate the benchmark corpus: repeatable synthetic PDFs made with pypdf and Pillow.
+
+Every document is built from a fixed random seed, so the same command
+produces the same files on every machine, fully offline.
+"""
+
+import argparse
+import os
+import random
+import sys
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+from pypdf import PdfReader, PdfWriter, Transformation
+from pypdf.generic import ArrayObject, DecodedStreamObject, DictionaryObject, FloatObject, NameObject
+
+LETTER = (612, 792)
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud").split()
+
+
+def text_content(rng, lines=48):
+    """Content stream drawing lines of pseudo-random Helvetica text"""
+    ops = ["BT", "/F1 10 Tf", "12 TL", "56 740 Td"]
+    for _ in range(lines):
+        line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 14)))
+        ops.append(f"({line}) Tj T*")
+    ops.append("ET")
+    return "\n".join(ops).encode()
+
+
+def add_text_page(writer, rng, lines=48):
+    """Append a letter page of text to writer and return it"""
+    page = writer.add_blank_page(*LETTER)
+    page[NameObject("/Resources")] = DictionaryObject({
+        NameObject("/Font"): DictionaryObject({
+            NameObject("/F1"): DictionaryObject({
+                NameObject("/Type"): NameObject("/Font"),
+                NameObject("/Subtype"): NameObject("/Type1"),
+                NameObject("/BaseFont"): NameObject("/Helvetica"),
+            })
+        })
+    })
+    content = DecodedStreamObject()
+    content.set_data(text_content(rng, lines))
+    page.replace_contents(content)
+    return page
+
+
+def photo(rng, width, height):
+    """A smooth colour image with sensor-like noise, JPEG-friendly but not trivial"""
+    channels = []
+    for _ in range(3):
+        gradient = Image.linear_gradient("L").rotate(rng.randint(0, 359)).resize((width, height))
+        noise = Image.frombytes("L", (width, height), rng.randbytes(width * height))
+        channels.append(Image.blend(gradient, noise, 0.12))
+    return Image.merge("RGB", channels)
+
+
+def scan(rng, width, height):
+    """A grayscale 'scanned' page: dark text-like strokes on paper-coloured noise"""
+    page = Image.new("L", (width, height), 235)
+    draw = ImageDraw.Draw(page)
+    margin = width // 12
+    y = margin
+    while y < height - margin:
+        x = margin
+        while x < width - margin:
+            word = rng.randint(width // 40, width // 12)
+            draw.rectangle((x, y, min(x + word, width - margin), y + height // 160), fill=rng.randint(10, 60))
+            x += word + width // 80
+        y += height // 45
+    noise = Image.frombytes("L", (width, height), rng.randbytes(width * height))
+    return Image.blend(page, noise, 0.08)
+
+
+def image_page(img, dpi):
+    """A single-page PDF (as a PdfReader page) showing img at dpi"""
+    buffer = BytesIO()
+    img.save(buffer, "PDF", resolution=dpi, quality=92)
+    return PdfReader(buffer).pages[0]
+
+
+def text_report(rng, pages=40):
+    writer = PdfWriter()
+    for _ in range(pages):
+        add_text_page(writer, rng)
+    return writer
+
+
+def photo_brochure(rng, pages=12):
+    writer = PdfWriter()
+    for _ in range(pages):
+        page = add_text_page(writer, rng, lines=12)
+        # A 300 dpi photo shown across the lower half of the page
+        picture = image_page(photo(rng, 1500, 1000), 300)
+        page.merge_transformed_page(picture, Transformation().scale(500 / 360).translate(56, 40))
+    return writer
+
+
+def link(rect, target, action=False):
+    """Link annotation to the page target, as a /Dest or (with action) a GoTo action"""
+    dest = ArrayObject([target, NameObject("/Fit")])
+    annotation = DictionaryObject({
+        NameObject("/Type"): NameObject("/Annot"),
+        NameObject("/Subtype"): NameObject("/Link"),
+        NameObject("/Rect"): ArrayObject(FloatObject(v) for v in rect),
+        NameObject("/Border"): ArrayObject([FloatObject(0)] * 3),
+    })
+    if action:
+        annotation[NameObject("/A")] = DictionaryObject({NameObject("/S"): NameObject("/GoTo"), NameObject("/D"): dest})
+    else:
+        annotation[NameObject("/Dest")] = dest
+    return annotation
+
+
+def linked_brochure(rng, pages=8):
+    """A brochure whose pages link to the next one and back to the first,
+    so sharded runs have links across page ranges"""
+    writer = photo_brochure(rng, pages)
+    refs = [page.indirect_reference for page in writer.pages]
+    for index in range(pages):
+        writer.add_annotation(index, link((56, 20, 156, 36), refs[(index + 1) % pages]))
+        writer.add_annotation(index, link((456, 20, 556, 36), refs[0], action=True))
+    return writer
+
+
+def scanned(rng, pages=10):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_page(image_page(scan(rng, 2550, 3300), 300))
+    return writer
+
+
+def repeated_logos(rng, pages=100):
+    writer = PdfWriter()
+    logo = BytesIO()
+    photo(rng, 600, 200).save(logo, "PDF", resolution=150, quality=92)
+    for _ in range(pages):
+        page = add_text_page(writer, rng, lines=40)
+        # A fresh reader per page stores the logo as a separate copy every
+        # time, like documents merged from many single-page sources
+        letterhead = PdfReader(BytesIO(logo.getvalue())).pages[0]
+        page.merge_transformed_page(letterhead, Transformation().scale(0.5).translate(56, 740))
+    return writer
+
+
+def thousand_pages(rng, pages=1000):
+    return text_report(rng, pages)
+
+
+# name -> (builder, pages in quick mode)
+DOCUMENTS = {
+    "text_report": (text_report, 10),
+    "photo_brochure": (photo_brochure, 3),
+    "scanned": (scanned, 2),
+    "repeated_logos": (repeated_logos, 20),
+    "thousand_pages": (thousand_pages, 100),
+    "linked_brochure": (linked_brochure, 3),
+}
+
+
+def generate(directory, quick=False, seed=1):
+    """Write every corpus document into directory and return their paths"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for index, (name, (builder, quick_pages)) in enumerate(DOCUMENTS.items()):
+        rng = random.Random(seed * 1000 + index)
+        writer = builder(rng, quick_pages) if quick else builder(rng)
+        path = os.path.join(directory, f"{name}.pdf")
+        with open(path, "wb") as f:
+            writer.write(f)
+        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", nargs="?", default=os.path.join(os.path.dirname(__file__), "corpus"))
+    parser.add_argument("--quick", action="store_true", help="fewer pages per document, for smoke runs")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    for path in generate(args.directory, args.quick, args.seed):
+        print(f"{path}: {os.path.getsize(path):,} bytes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
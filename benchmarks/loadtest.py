@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+"""Measure how many requests per second serve.py answers locally.
+
+serve.py is started on docs/ in its own process (or --url points at a
+running server) and a number of clients, one process and one kept-alive
+connection each, request the app's startup assets in turn for a fixed
+time. Reports requests per second, throughput and latency percentiles;
+--revalidate sends the ETag of each asset back, as a browser with a warm
+cache does, to measure 304 responses instead.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# What a browser fetches from the server to start the app
+PATHS = [
+    "/",
+    "/bulma.min.css",
+    "/font-awesome/css/font-awesome.min.css",
+    "/font-awesome/fonts/fontawesome-webfont.woff2",
+    "/icons/icon-256x256.png",
+    "/manifest.json",
+    "/sw.js",
+    "/main.py",
+    "/engine.py",
+    "/images.py",
+]
+
+
+def client(url, paths, seconds, encoding, revalidate):
+    """Worker entry point: request paths in turn over one connection for seconds
+
+    Returns (latencies in seconds, bytes received, {status: count}, errors).
+    """
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+    prefix = parts.path.rstrip("/")
+    etags = {}
+    latencies = []
+    received = 0
+    statuses = {}
+    errors = 0
+    index = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        path = prefix + paths[index % len(paths)]
+        index += 1
+        headers = {"Accept-Encoding": encoding}
+        if revalidate and path in etags:
+            headers["If-None-Match"] = etags[path]
+        start = time.perf_counter()
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            continue
+        latencies.append(time.perf_counter() - start)
+        received += len(body)
+        statuses[response.status] = statuses.get(response.status, 0) + 1
+        if response.getheader("ETag"):
+            etags[path] = response.getheader("ETag")
+    connection.close()
+    return latencies, received, statuses, errors
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+def wait_for_port(host, port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def run(url, paths, connections, seconds, encoding, revalidate):
+    with ProcessPoolExecutor(connections) as pool:
+        futures = [pool.submit(client, url, paths, seconds, encoding, revalidate) for _ in range(connections)]
+        results = [future.result() for future in futures]
+    latencies = sorted(latency for result in results for latency in result[0])
+    statuses = {}
+    for result in results:
+        for status, count in result[2].items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+    received = sum(result[1] for result in results)
+    return {
+        "connections": connections,
+        "seconds": seconds,
+        "encoding": encoding,
+        "revalidate": revalidate,
+        "requests": len(latencies),
+        "errors": sum(result[3] for result in results),
+        "statuses": statuses,
+        "requests_per_second": round(len(latencies) / seconds, 1),
+        "megabytes_per_second": round(received / seconds / 1024 / 1024, 2),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.5) * 1000, 2),
+            "p95": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="load test a server that is already running here instead")
+    parser.add_argument("--port", type=int, default=8766, help="port to start serve.py on")
+    parser.add_argument("-c", "--connections", type=int, default=os.cpu_count() or 4,
+                        help="concurrent clients, one process each")
+    parser.add_argument("-t", "--seconds", type=float, default=10, help="how long to send requests for")
+    parser.add_argument("--encoding", default="br, gzip", help="Accept-Encoding to send; 'identity' for none")
+    parser.add_argument("--revalidate", action="store_true", help="send If-None-Match, as a warm browser cache does")
+    parser.add_argument("-o", "--output", help="write the results JSON here as well")
+    args = parser.parse_args(argv)
+
+    server = None
+    url = args.url
+    if url is None:
+        url = f"http://localhost:{args.port}/"
+        server = subprocess.Popen([sys.executable, os.path.join(ROOT, "serve.py"), "--port", str(args.port), "--quiet"])
+        if not wait_for_port("localhost", args.port, 60):
+            server.terminate()
+            parser.error(f"serve.py didn't start listening on port {args.port}")
+    try:
+        results = run(url, PATHS, args.connections, args.seconds, args.encoding, args.revalidate)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    latency = results["latency_ms"]
+    print(f"{results['requests']:,} requests in {args.seconds:g} s over {args.connections} connections: "
+          f"{results['requests_per_second']:,} requests/s, {results['megabytes_per_second']} MB/s, "
+          f"latency p50 {latency['p50']} ms, p95 {latency['p95']} ms, p99 {latency['p99']} ms, "
+          f"{results['errors']} errors", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if results["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
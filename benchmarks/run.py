@@ -0,0 +1,184 @@
+#! /usr/bin/env python
+"""Run every SovPDF preset over the benchmark corpus and record the results.
+
+Each (document, preset) run happens in a fresh process, so the peak RSS it
+reports belongs to that run alone. Results are written as JSON; pass a
+previous results file with --compare to flag regressions against it.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# The engine lives next to the web app so the browser can load it too
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "docs"))
+
+from engine import PRESETS, compress_file, compress_to_buffer  # noqa: E402
+from shard import check_shards, compress_sharded  # noqa: E402
+
+import corpus  # noqa: E402
+
+# Differences below these floors are measurement noise, never regressions
+MIN_SECONDS = 0.05
+MIN_RSS = 4 * 1024 * 1024
+
+
+def peak_rss():
+    """Peak resident set size in bytes of this process or its largest child, or None"""
+    if resource is None:
+        return None
+    maxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def measure(input_path, preset, output_dir, shards=None):
+    """Worker entry point: compress one document with one preset
+
+    With shards, the document is split across that many processes, and
+    the output checked against a single process's (see shard.check_shards).
+    """
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    output_path = os.path.join(output_dir, f"{name}-{preset}.pdf")
+    start = time.perf_counter()
+    if shards:
+        sink, stats = compress_sharded(input_path, preset, shards)
+        with open(output_path, "wb") as f:
+            f.write(sink.getbuffer())
+    else:
+        stats = compress_file(input_path, output_path, preset)
+    seconds = time.perf_counter() - start
+    row = {
+        "document": name,
+        "preset": preset,
+        "shards": stats.get("shards", 1),
+        "seconds": round(seconds, 4),
+        "peak_rss": peak_rss(),
+        "input_size": stats["original_size"],
+        "output_size": stats["compressed_size"],
+        "ratio": round(stats["compressed_size"] / stats["original_size"], 4),
+        "image_decisions": stats.get("image_decisions", {}),
+        "stripped": stats.get("stripped", {}),
+    }
+    # After the measurements, so the second run counts in neither
+    if stats.get("shards", 1) > 1:
+        single, _ = compress_to_buffer(input_path, preset)
+        row["shard_problems"] = check_shards(sink.getvalue(), single.getvalue())
+    return row
+
+
+def run(paths, presets, output_dir, repeat=1, shards=None):
+    """Benchmark every path with every preset and return the result rows
+
+    With repeat > 1 the fastest time and the lowest peak of the repeats are
+    kept, which filters out most scheduling noise.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # spawn, not fork: a forked child inherits the parent's peak RSS
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with ProcessPoolExecutor(max_workers=1, mp_context=context, max_tasks_per_child=1) as pool:
+        for path in paths:
+            for preset in presets:
+                rows = [pool.submit(measure, path, preset, output_dir, shards).result() for _ in range(repeat)]
+                best = min(rows, key=lambda r: r["seconds"])
+                peaks = [r["peak_rss"] for r in rows if r["peak_rss"] is not None]
+                best["peak_rss"] = min(peaks) if peaks else None
+                print(f"{best['document']:>16} {preset:>7}: {best['seconds']:8.3f} s  "
+                      f"{(best['peak_rss'] or 0) / 2**20:7.1f} MiB  "
+                      f"{best['output_size']:>12,} bytes  ({best['ratio']:.1%})", file=sys.stderr)
+                for problem in best.get("shard_problems", []):
+                    print(f"{'':>16} {'':>7}  sharded output differs: {problem}", file=sys.stderr)
+                results.append(best)
+    return results
+
+
+def compare(results, baseline, threshold, size_threshold):
+    """Return a message for every result that regressed against baseline
+
+    Time and peak RSS may grow by threshold (a fraction) before they count as
+    a regression; output size by size_threshold, as it is deterministic.
+    """
+    previous = {(r["document"], r["preset"], r.get("shards", 1)): r for r in baseline["results"]}
+    regressions = []
+    for row in results:
+        key = (row["document"], row["preset"], row.get("shards", 1))
+        base = previous.get(key)
+        if base is None:
+            continue
+        label = f"{row['document']}/{row['preset']}"
+        if row["seconds"] > base["seconds"] * (1 + threshold) and row["seconds"] - base["seconds"] > MIN_SECONDS:
+            regressions.append(f"{label}: time {base['seconds']:.3f} s -> {row['seconds']:.3f} s")
+        if (row["peak_rss"] and base.get("peak_rss")
+                and row["peak_rss"] > base["peak_rss"] * (1 + threshold)
+                and row["peak_rss"] - base["peak_rss"] > MIN_RSS):
+            regressions.append(f"{label}: peak RSS {base['peak_rss']:,} -> {row['peak_rss']:,} bytes")
+        if row["output_size"] > base["output_size"] * (1 + size_threshold):
+            regressions.append(f"{label}: output {base['output_size']:,} -> {row['output_size']:,} bytes")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default=os.path.join(HERE, "corpus"),
+                        help="corpus directory, generated if it holds no PDFs")
+    parser.add_argument("--quick", action="store_true", help="generate a smaller corpus, for smoke runs")
+    parser.add_argument("-p", "--preset", action="append", choices=sorted(PRESETS),
+                        help="benchmark only this preset (repeatable)")
+    parser.add_argument("-s", "--shards", type=int, help="split each document across this many processes")
+    parser.add_argument("-n", "--repeat", type=int, default=1, help="runs per measurement, best kept")
+    parser.add_argument("-o", "--output", default=os.path.join(HERE, "results.json"),
+                        help="where to write the results JSON")
+    parser.add_argument("--compare", metavar="BASELINE", help="results JSON to check for regressions against")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="allowed growth in time and peak RSS before it is a regression (default 0.15)")
+    parser.add_argument("--size-threshold", type=float, default=0.01,
+                        help="allowed growth in output size before it is a regression (default 0.01)")
+    args = parser.parse_args(argv)
+
+    paths = sorted(os.path.join(args.corpus, f) for f in os.listdir(args.corpus)
+                   if f.endswith(".pdf")) if os.path.isdir(args.corpus) else []
+    if not paths:
+        print(f"Generating corpus in {args.corpus}", file=sys.stderr)
+        paths = corpus.generate(args.corpus, args.quick)
+
+    results = run(paths, args.preset or list(PRESETS), os.path.join(args.corpus, "out"), args.repeat, args.shards)
+    with open(args.output, "w") as f:
+        json.dump({
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }, f, indent=2)
+
+    status = 0
+    mismatches = [r for r in results if r.get("shard_problems")]
+    if mismatches:
+        print(f"{len(mismatches)} sharded outputs differ from a single process's", file=sys.stderr)
+        status = 1
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.size_threshold)
+        for message in regressions:
+            print(f"REGRESSION {message}", file=sys.stderr)
+        if regressions:
+            return 1
+        print("No regressions", file=sys.stderr)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
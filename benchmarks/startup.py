@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+"""Measure the time to interactive of the SovPDF web app, cold, warm and offline.
+
+docs/ is served with serve.py's handler and the app is loaded three times
+in one headless Chromium profile: cold (empty caches), warm (service worker
+and runtime cache filled) and offline (server stopped, everything from the
+service worker). Each load reports, in milliseconds since navigation, when
+the UI became interactive and, after a file is selected, when the engine
+finished loading. Requires Playwright:
+pip install playwright && playwright install chromium
+"""
+
+import argparse
+import functools
+import json
+import os
+import sys
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer
+from io import BytesIO
+
+from pypdf import PdfWriter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+from serve import CORSHTTPHandler  # noqa: E402
+
+
+def sample_pdf():
+    """A one-page PDF to select, which starts loading the engine"""
+    writer = PdfWriter()
+    writer.add_blank_page(612, 792)
+    sink = BytesIO()
+    writer.write(sink)
+    return sink.getvalue()
+
+
+class QuietHandler(CORSHTTPHandler):
+    # One log line per request would bury the results
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port):
+    handler = functools.partial(QuietHandler, directory=os.path.join(ROOT, "docs"))
+    httpd = ThreadingHTTPServer(("localhost", port), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def load(page, url, timeout):
+    """Load the app and select a file; return its startup timings"""
+    page.goto(url)
+    page.wait_for_function("window.sovPdfStartup !== undefined", timeout=timeout)
+    page.set_input_files("#filePdf", {"name": "sample.pdf", "mimeType": "application/pdf", "buffer": sample_pdf()})
+    page.wait_for_function("JSON.parse(window.sovPdfStartup).engine_ready_ms !== undefined", timeout=timeout)
+    # The service worker may still be filling its caches from this load
+    page.evaluate("navigator.serviceWorker.ready.then(() => true)")
+    return json.loads(page.evaluate("window.sovPdfStartup"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for each load")
+    parser.add_argument("--settle", type=float, default=10,
+                        help="seconds to let the service worker cache the runtime after the cold load")
+    parser.add_argument("-o", "--output", help="write the results JSON here as well")
+    args = parser.parse_args(argv)
+
+    try:
+        from playwright.sync_api import sync_playwright
+    except ImportError:
+        parser.error("Playwright is required: pip install playwright && playwright install chromium")
+
+    url = f"http://localhost:{args.port}/"
+    timeout = args.timeout * 1000
+    results = []
+    httpd = start_server(args.port)
+    with tempfile.TemporaryDirectory() as profile, sync_playwright() as playwright:
+        context = playwright.chromium.launch_persistent_context(profile, headless=True)
+        page = context.new_page()
+        for run in ("cold", "warm", "offline"):
+            if run == "offline":
+                httpd.shutdown()
+                context.set_offline(True)
+            timings = load(page, url, timeout)
+            results.append({"run": run, **timings})
+            print(f"{run:>8}: interactive {timings['interactive_ms']:>7,} ms, "
+                  f"engine ready {timings['engine_ready_ms']:>7,} ms", file=sys.stderr)
+            if run == "cold":
+                page.wait_for_timeout(args.settle * 1000)
+        context.close()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
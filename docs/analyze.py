@@ -0,0 +1,146 @@
+"""Quick analysis of a document for the SovPDF engine.
+
+analyze_document inventories what a PDF spends its bytes on (images,
+content streams, fonts, duplicate streams) and predicts the output size and
+run time of each preset without compressing the document: only a few
+sampled images are encoded and a few sampled pages compressed and written
+without their images (see target.SizeEstimator). It takes a
+DocumentAnalysis, so a compression started afterwards reuses the parse and
+the sampled rasters.
+"""
+
+import time
+
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject
+
+from engine import PRESETS
+from images import skip_reason
+from instrument import Instrumentation
+from target import SizeEstimator
+
+# Images encoded per preset estimate: the two largest plus two spread over the rest
+SAMPLE_SIZE = 4
+# ... but no more pixels than this, beyond the largest image
+SAMPLE_PIXELS = 4_000_000
+# Stages of encode_entry that run for every image an estimate encodes
+ENCODE_STAGES = ("classify", "resample", "encode")
+
+
+def _filter_name(stream):
+    filters = stream.get("/Filter")
+    filters = filters.get_object() if filters is not None else None
+    if isinstance(filters, ArrayObject):
+        return "+".join(str(f) for f in filters) or "none"
+    return str(filters) if filters is not None else "none"
+
+
+def _font_files(resources, seen):
+    """Yield the embedded font programs reachable from resources, once each"""
+    resources = resources.get_object() if resources is not None else None
+    if not isinstance(resources, DictionaryObject):
+        return
+    fonts = resources.get("/Font")
+    fonts = fonts.get_object() if fonts is not None else {}
+    for name in fonts:
+        font = fonts[name].get_object()
+        descendants = font.get("/DescendantFonts")
+        for font in [font] + (list(descendants.get_object()) if descendants is not None else []):
+            descriptor = font.get_object().get("/FontDescriptor")
+            descriptor = descriptor.get_object() if descriptor is not None else {}
+            for key in ("/FontFile", "/FontFile2", "/FontFile3"):
+                ref = descriptor.raw_get(key) if key in descriptor else None
+                if isinstance(ref, IndirectObject) and ref.idnum not in seen:
+                    seen.add(ref.idnum)
+                    yield ref.get_object()
+
+
+def image_inventory(estimator):
+    """Per-image and per-filter summary of the unique images of estimator"""
+    items = []
+    filters = {}
+    for entry in estimator.entries:
+        stream = entry.stream
+        width, height = int(stream.get("/Width", 0)), int(stream.get("/Height", 0))
+        dpi = None
+        if entry.display_size and min(entry.display_size) > 0:
+            # The lower of the two directions: images are rarely stretched
+            dpi = round(min(width / entry.display_size[0], height / entry.display_size[1]) * 72)
+        name = _filter_name(stream)
+        size = len(stream._data)
+        items.append({"object": entry.ref.idnum, "filter": name, "bytes": size,
+                      "width": width, "height": height, "dpi": dpi, "uses": entry.uses})
+        totals = filters.setdefault(name, {"count": 0, "bytes": 0})
+        totals["count"] += 1
+        totals["bytes"] += size
+    return {
+        "count": sum(entry.uses for entry in estimator.entries),
+        "unique": len(items),
+        "bytes": sum(item["bytes"] for item in items),
+        "filters": filters,
+        "items": items,
+    }
+
+
+def analyze_document(analysis, presets=None, sample_size=SAMPLE_SIZE):
+    """Inventory the document of analysis and estimate each preset's result
+
+    Returns a JSON-ready dictionary: page count, input size, the image
+    inventory (see image_inventory), content stream, font and duplicate
+    stream bytes, and {preset: {"bytes", "ratio", "seconds"}} under
+    "estimates". Times are measured on this machine, so they only hold for
+    a job worker as fast as it.
+    """
+    start = time.perf_counter()
+    reader = analysis.reader
+    pages = reader.pages
+    estimator = SizeEstimator(analysis, sample_size, SAMPLE_PIXELS)
+    images = image_inventory(estimator)
+
+    seen = set()
+    font_bytes = sum(len(font._data) for page in pages for font in _font_files(page.get("/Resources"), seen))
+
+    # Images are measured per pixel of their full size, which decoding may
+    # shrink (see images.decode_reduction): the rates below account for that
+    pixels = {entry.key: int(entry.stream.get("/Width", 0)) * int(entry.stream.get("/Height", 0))
+              for entry in estimator.entries}
+    sampled = {entry.key for entry in estimator.sample}
+
+    runs = {}
+    for preset in presets or PRESETS:
+        settings = PRESETS[preset]
+        instr = Instrumentation(memory_sampler=lambda: None)
+        image_bytes = estimator.image_bytes(settings, instr)
+        encoded = [entry for entry in estimator.entries if skip_reason(entry, settings["dpi"]) is None]
+        runs[preset] = (settings, image_bytes, encoded, instr)
+
+    # Decoding is shared by the presets, so its rate comes from all of them
+    decode_seconds = sum(run[3].stages.get("decode", {}).get("seconds", 0) for run in runs.values())
+    decoded_pixels = sum(pixels[key] for key in sampled if key in analysis.images.rasters)
+    decode_rate = decode_seconds / decoded_pixels if decoded_pixels else 0
+
+    estimates = {}
+    for preset, (settings, image_bytes, encoded, instr) in runs.items():
+        encode_seconds = sum(instr.stages.get(stage, {}).get("seconds", 0) for stage in ENCODE_STAGES)
+        sample_pixels = sum(pixels[entry.key] for entry in encoded if entry.key in sampled)
+        encode_rate = encode_seconds / sample_pixels if sample_pixels else 0
+        count, page_seconds, _, _, _, _ = estimator.page_sample(settings)
+        scale = len(pages) / count if count else 0
+        size = estimator.other_bytes(settings) + image_bytes
+        seconds = (decode_rate + encode_rate) * sum(pixels[entry.key] for entry in encoded) + page_seconds * scale
+        estimates[preset] = {
+            "bytes": round(size),
+            "ratio": size / analysis.size if analysis.size else 1.0,
+            "seconds": round(seconds, 2),
+        }
+
+    return {
+        "pages": len(pages),
+        "size": analysis.size,
+        "images": images,
+        "content_bytes": estimator.contents,
+        "font_bytes": font_bytes,
+        "duplicate_streams": estimator.duplicates,
+        "duplicate_bytes": estimator.duplicate_bytes,
+        "estimates": estimates,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
@@ -0,0 +1,174 @@
+"""Content-addressed cache of compression results for the SovPDF engine.
+
+A result is stored under a key derived from the input bytes, the settings
+and ENGINE_VERSION, so the same request is answered without compressing
+again while a changed engine or setting never gets a stale result.
+ResultCache keeps the stored results under a size cap, evicting the least
+recently used first. Where they are stored is up to a storage backend: the
+web app keeps them in IndexedDB, the headless tools in a directory
+(FileStorage). Backend methods are coroutines because IndexedDB is
+asynchronous.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from engine import ENGINE_VERSION
+
+log = logging.getLogger("sovpdf")
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def input_digest(data):
+    """Hash of the input PDF bytes (bytes or memoryview), computed once per file"""
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def cache_key(digest, settings):
+    """Key of the result of compressing the input with digest using settings
+
+    settings is any JSON-serializable description of the request, e.g. a
+    preset name with its PRESETS entry, or a target size.
+    """
+    request = json.dumps(settings, sort_keys=True)
+    return hashlib.blake2b(f"{digest}\0{request}\0{ENGINE_VERSION}".encode(), digest_size=20).hexdigest()
+
+
+class CacheStorage:
+    """Where ResultCache keeps its records
+
+    A record is the result data, which is opaque to the cache (bytes, a
+    Blob, ...), plus a metadata dict holding at least "size" and
+    "last_used". Subclasses implement every coroutine below.
+    """
+
+    async def get(self, key):
+        """Return (data, meta) of key, or None"""
+        raise NotImplementedError
+
+    async def put(self, key, data, meta):
+        raise NotImplementedError
+
+    async def touch(self, key, meta):
+        """Replace the metadata of key, leaving its data alone"""
+        raise NotImplementedError
+
+    async def delete(self, key):
+        raise NotImplementedError
+
+    async def index(self):
+        """Return {key: meta} of every record, without loading any data"""
+        raise NotImplementedError
+
+
+class FileStorage(CacheStorage):
+    """CacheStorage in a directory: <key>.pdf holds the data, <key>.json its metadata
+
+    Several processes may share the directory, so files are written whole
+    under a temporary name and then renamed into place.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def _replace(self, path, write):
+        """Write a file with write(f) in the directory, then move it to path"""
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    async def get(self, key):
+        try:
+            with open(self._path(key, ".json")) as f:
+                meta = json.load(f)
+            with open(self._path(key, ".pdf"), "rb") as f:
+                return f.read(), meta
+        except (OSError, ValueError):
+            return None
+
+    async def put(self, key, data, meta):
+        self._replace(self._path(key, ".pdf"), lambda f: f.write(data))
+        # The metadata goes last: a record without it doesn't exist yet
+        await self.touch(key, meta)
+
+    async def touch(self, key, meta):
+        self._replace(self._path(key, ".json"), lambda f: f.write(json.dumps(meta).encode()))
+
+    async def delete(self, key):
+        for extension in (".json", ".pdf"):
+            try:
+                os.remove(self._path(key, extension))
+            except FileNotFoundError:
+                pass
+
+    async def index(self):
+        records = {}
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                try:
+                    with open(os.path.join(self.directory, name)) as f:
+                        records[name[:-5]] = json.load(f)
+                except (OSError, ValueError):
+                    continue
+        return records
+
+
+class ResultCache:
+    """Compressed outputs and their stats, by cache_key, within max_bytes"""
+
+    def __init__(self, storage, max_bytes=DEFAULT_MAX_BYTES):
+        self.storage = storage
+        self.max_bytes = max_bytes
+
+    async def get(self, key):
+        """Return (data, stats) of key and mark it as just used, or None"""
+        record = await self.storage.get(key)
+        if record is None:
+            return None
+        data, meta = record
+        meta["last_used"] = time.time()
+        await self.storage.touch(key, meta)
+        return data, meta["stats"]
+
+    async def put(self, key, data, size, stats):
+        """Store data (size bytes) with its stats, evicting older results to
+        make room; returns False if it is larger than the whole cache"""
+        if size > self.max_bytes:
+            return False
+        await self.storage.put(key, data, {"size": size, "last_used": time.time(), "stats": stats})
+        await self.evict(keep=key)
+        return True
+
+    async def evict(self, keep=None):
+        """Delete least recently used results until the rest fit in max_bytes
+
+        Returns the number of results deleted.
+        """
+        records = await self.storage.index()
+        total = sum(meta["size"] for meta in records.values())
+        evicted = 0
+        for key, meta in sorted(records.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            await self.storage.delete(key)
+            total -= meta["size"]
+            evicted += 1
+        if evicted:
+            log.info(f"Evicted {evicted} cached results, {total:,} bytes left")
+        return evicted
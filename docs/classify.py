@@ -0,0 +1,97 @@
+"""Raster classification for the SovPDF engine.
+
+Scanned paperwork is mostly black and white, or at least free of colour,
+but it usually arrives as a colour JPEG. classify_image tells such rasters
+apart from colour ones so they can be stored as 1-bit or single-channel
+images instead. It looks at a small nearest-neighbour sample of the image,
+never the full raster, so it costs a small fraction of an encode.
+
+NumPy is optional: without it every image is classified as colour and
+encoded as before.
+"""
+
+from PIL import Image
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - NumPy is loaded with the engine
+    np = None
+
+# Longest side of the sample the classifier looks at
+SAMPLE_SIZE = 256
+# A pixel whose channels differ by more than this is coloured
+COLOR_SPREAD = 40
+# At most this fraction of coloured pixels for an image to be gray
+MAX_COLOR_FRACTION = 0.01
+# Gray levels between these are neither ink nor paper
+MIDTONE_RANGE = (64, 192)
+# At most this fraction of midtones for a gray image to be bilevel
+MAX_MIDTONE_FRACTION = 0.05
+
+BILEVEL = "bilevel"
+GRAY = "gray"
+COLOR = "color"
+
+
+def sample(img, size=SAMPLE_SIZE):
+    """A nearest-neighbour copy of img no larger than size on either side"""
+    scale = size / max(img.width, img.height)
+    if scale >= 1:
+        return img
+    # NEAREST only reads the pixels it keeps, so this is cheap even for
+    # a full-page scan, and it doesn't invent midtones along edges
+    return img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.NEAREST)
+
+
+def _gray_levels(img):
+    """A uint8 array of the gray levels of img, or None if it is coloured"""
+    if img.mode in ("RGBA", "LA"):
+        img = img.convert(img.mode[:-1])
+    if img.mode == "P":
+        img = img.convert("RGB")
+    if img.mode == "L":
+        return np.asarray(img)
+    if img.mode != "RGB":
+        # CMYK, LAB and the rest: not worth guessing
+        return None
+    pixels = np.asarray(img)
+    spread = pixels.max(axis=2).astype(np.int16) - pixels.min(axis=2)
+    if np.count_nonzero(spread > COLOR_SPREAD) > MAX_COLOR_FRACTION * spread.size:
+        return None
+    return np.asarray(img.convert("L"))
+
+
+def classify_image(img):
+    """Classify a PIL image as BILEVEL, GRAY or COLOR
+
+    Returns (kind, threshold): threshold is the gray level separating ink
+    from paper for BILEVEL images and None otherwise.
+    """
+    if np is None or img.mode in ("1", "I", "F", "I;16"):
+        return COLOR, None
+    levels = _gray_levels(sample(img))
+    if levels is None:
+        return COLOR, None
+    histogram = np.bincount(levels.ravel(), minlength=256)
+    low, high = MIDTONE_RANGE
+    if histogram[low:high].sum() > MAX_MIDTONE_FRACTION * levels.size:
+        return GRAY, None
+    return BILEVEL, otsu_threshold(histogram)
+
+
+def otsu_threshold(histogram):
+    """The gray level that best splits a 256-bin histogram in two (Otsu's method)
+
+    Levels up to and including the threshold are ink.
+    """
+    histogram = histogram.astype(np.float64)
+    weight = np.cumsum(histogram)
+    total = weight[-1]
+    if not total:
+        return 127
+    mass = np.cumsum(histogram * np.arange(256))
+    background = total - weight
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mass[-1] * weight - mass * total) ** 2 / (weight * background)
+    between[~np.isfinite(between)] = 0
+    return int(np.argmax(between)) if between.any() else 127
@@ -0,0 +1,262 @@
+"""Content stream compression for the SovPDF engine.
+
+A ContentCompressor replaces pypdf's compress_content_streams, which joins
+and deflates every page's content at one level, even content that is
+already deflated (it ends up deflated twice). Here each content stream is
+looked at once:
+
+- streams already deflated to a good ratio are kept as they are;
+- the others are decoded and, at the higher levels, normalised: comments
+  and redundant whitespace are dropped, numbers shortened, and operators
+  that set a graphics or text state parameter to the value it already has
+  removed, as are empty q/Q pairs;
+- the result is deflated at a level chosen by its size, and kept only
+  when it is smaller than the original;
+- streams with the same bytes as one already compressed reuse its result.
+
+Normalising needs the stream to tokenize cleanly; streams that don't, and
+streams with inline images, are deflated without normalising.
+"""
+
+import hashlib
+import re
+import zlib
+
+from pypdf.generic import ArrayObject, IndirectObject, NameObject, StreamObject
+
+from instrument import NULL_INSTRUMENTATION
+
+# A deflated stream at most this fraction of its decoded size is left alone
+GOOD_FLATE_RATIO = 0.4
+# Streams smaller than this gain nothing from the slowest levels ...
+SMALL_STREAM_BYTES = 16 * 1024
+# ... so they are deflated at no more than this level
+SMALL_STREAM_LEVEL = 6
+# Normalising costs about twice what deflating does, so it is left to the
+# presets that favour size over speed
+NORMALIZE_MIN_LEVEL = 5
+
+WHITESPACE = b"\x00\t\n\x0c\r "
+DELIMITERS = b"()<>[]{}/%"
+# Bytes that can be part of a number, keyword or name: two tokens made of
+# them need whitespace between them
+REGULAR = frozenset(range(256)) - frozenset(WHITESPACE + DELIMITERS)
+
+# A literal string with up to two levels of nested parentheses, written as
+# "unrolled loops" so that an unterminated string fails in linear time
+_STRING = rb"\([^()\\]*(?:\\.[^()\\]*)*\)"
+for _ in range(2):
+    _STRING = rb"\([^()\\]*(?:(?:\\.|" + _STRING + rb")[^()\\]*)*\)"
+
+# Whitespace and comments, then one token. A "(", ")", "<" or ">" matched
+# on its own means the stream didn't tokenize (see _tokenize).
+_TOKEN = re.compile(
+    rb"(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*"
+    rb"(" + _STRING +
+    rb"|<[0-9A-Fa-f\x00\t\n\x0c\r ]*>"
+    rb"|<<|>>|[\[\]{}]"
+    rb"|/[^\x00\t\n\x0c\r ()<>\[\]{}/%]*"
+    rb"|[^\x00\t\n\x0c\r ()<>\[\]{}/%]+"
+    rb"|[()<>])",
+    re.S,
+)
+
+# State operators and the parameter each sets; repeating the value a
+# parameter already has does nothing
+STATE_OPERATORS = {
+    b"w": b"w", b"J": b"J", b"j": b"j", b"M": b"M", b"d": b"d", b"ri": b"ri", b"i": b"i",
+    b"g": b"fill", b"rg": b"fill", b"k": b"fill", b"sc": b"fill", b"scn": b"fill",
+    b"G": b"stroke", b"RG": b"stroke", b"K": b"stroke", b"SC": b"stroke", b"SCN": b"stroke",
+    b"Tc": b"Tc", b"Tw": b"Tw", b"Tz": b"Tz", b"TL": b"TL", b"Ts": b"Ts", b"Tr": b"Tr", b"Tf": b"Tf",
+}
+# Operators that change parameters as a side effect
+SIDE_EFFECTS = {
+    b"cs": (b"fill",),  # a new colour space resets the colour
+    b"CS": (b"stroke",),
+    b"TD": (b"TL",),
+    b'"': (b"Tw", b"Tc"),
+}
+# Tokens that are operands even though they are made of regular bytes
+KEYWORD_OPERANDS = {b"true", b"false", b"null"}
+NUMBER_START = frozenset(b"+-.0123456789")
+
+
+def _tokenize(data):
+    """The tokens of a content stream, or None if it can't be normalised"""
+    tokens = _TOKEN.findall(data)
+    for token in tokens:
+        if len(token) == 1 and token in b"()<>":
+            return None
+        if token == b"BI":
+            # Inline image data isn't made of tokens
+            return None
+    return tokens
+
+
+def _number(token):
+    """The shortest spelling of a numeric token"""
+    if b"." not in token:
+        return token
+    token = token.rstrip(b"0").rstrip(b".")
+    if token in (b"", b"-", b"+", b"-0"):
+        return b"0"
+    if token.startswith(b"0."):
+        return token[1:]
+    if token.startswith(b"-0."):
+        return b"-" + token[2:]
+    return token
+
+
+def _join(tokens, separator=b" "):
+    """Tokens with separator only where two of them would run together"""
+    parts = []
+    previous = None
+    for token in tokens:
+        if previous is not None and previous[-1] in REGULAR and token[0] in REGULAR:
+            parts.append(separator)
+        parts.append(token)
+        previous = token
+    return b"".join(parts)
+
+
+def normalize(data):
+    """Rewrite content stream data more compactly, or return None if it can't be
+
+    The result draws exactly the same thing.
+    """
+    tokens = _tokenize(data)
+    if tokens is None:
+        return None
+    operations = []
+    operands = []
+    state = {}
+    saved = []
+    for token in tokens:
+        first = token[0]
+        if first not in REGULAR or token in KEYWORD_OPERANDS:
+            operands.append(token)
+            continue
+        if first in NUMBER_START:
+            operands.append(_number(token))
+            continue
+        # An operator: decide whether it does anything
+        if token == b"q":
+            saved.append(dict(state))
+        elif token == b"Q":
+            state = saved.pop() if saved else {}
+            if operations and operations[-1] == b"q":
+                # Nothing happened between q and Q
+                operations.pop()
+                operands = []
+                continue
+        elif token == b"gs":
+            # An ExtGState can set any parameter
+            state = {b"gs": tuple(operands)}
+        elif token in STATE_OPERATORS:
+            parameter = STATE_OPERATORS[token]
+            value = (token, tuple(operands))
+            if state.get(parameter) == value:
+                operands = []
+                continue
+            state[parameter] = value
+            state.pop(b"gs", None)
+        elif token in SIDE_EFFECTS:
+            for parameter in SIDE_EFFECTS[token]:
+                state.pop(parameter, None)
+        operands.append(token)
+        operations.append(_join(operands))
+        operands = []
+    if operands:
+        # Trailing operands without an operator: not worth guessing
+        return None
+    return _join(operations, b"\n")
+
+
+def _copy(stream):
+    new_stream = StreamObject()
+    new_stream.update(stream)
+    new_stream._data = stream._data
+    return new_stream
+
+
+class ContentCompressor:
+    """Compresses the content streams of one document at a preset's level
+
+    Results are remembered by the streams' bytes, so identical streams on
+    many pages are only compressed once; with max_remembered, only until
+    that many compressed bytes are held. Counters go to instr.
+    """
+
+    def __init__(self, level, instr=NULL_INSTRUMENTATION, max_remembered=None):
+        self.level = level
+        self.instr = instr
+        self.max_remembered = max_remembered
+        self.remembered = 0
+        self.results = {}  # digest of the original -> compressed stream, or None to keep it
+
+    def level_for(self, size):
+        """Deflate level for a stream of size decoded bytes"""
+        if size < SMALL_STREAM_BYTES:
+            return min(self.level, SMALL_STREAM_LEVEL)
+        return self.level
+
+    def compress(self, stream):
+        """A compressed replacement for content stream, or None to keep it"""
+        digest = hashlib.blake2b(stream._data, digest_size=16)
+        digest.update(repr(stream.get("/Filter")).encode())
+        key = digest.digest()
+        if key in self.results:
+            self.instr.count("content_streams_reused")
+            result = self.results[key]
+            # Each stream object can only sit at one place in a document
+            return _copy(result) if result is not None else None
+        result = self._compress(stream)
+        size = len(result._data) if result is not None else 0
+        if self.max_remembered is None or self.remembered + size <= self.max_remembered:
+            self.results[key] = result
+            self.remembered += size
+        return result
+
+    def _compress(self, stream):
+        filters = stream.get("/Filter")
+        filters = filters.get_object() if filters is not None else None
+        try:
+            data = stream.get_data()
+        except Exception:
+            self.instr.count("content_streams_kept")
+            return None
+        if filters == "/FlateDecode" and len(stream._data) <= len(data) * GOOD_FLATE_RATIO:
+            self.instr.count("content_streams_kept")
+            return None
+
+        normalized = normalize(data) if self.level >= NORMALIZE_MIN_LEVEL else None
+        if normalized is not None:
+            self.instr.count("content_streams_normalized")
+            data = normalized
+        compressed = zlib.compress(data, self.level_for(len(data)))
+        if filters is not None and len(compressed) >= len(stream._data):
+            self.instr.count("content_streams_kept")
+            return None
+        self.instr.count("content_streams_deflated")
+        new_stream = StreamObject()
+        for key, value in stream.items():
+            if key not in ("/Filter", "/DecodeParms", "/Length"):
+                new_stream[key] = value
+        new_stream[NameObject("/Filter")] = NameObject("/FlateDecode")
+        new_stream._data = compressed
+        return new_stream
+
+    def compress_page(self, writer, page):
+        """Compress the content streams of page, an object of writer, in place"""
+        contents = page.raw_get("/Contents") if "/Contents" in page else None
+        items = contents.get_object() if isinstance(contents, IndirectObject) else contents
+        refs = list(items) if isinstance(items, ArrayObject) else [contents]
+        for ref in refs:
+            if not isinstance(ref, IndirectObject):
+                continue
+            stream = ref.get_object()
+            if not isinstance(stream, StreamObject):
+                continue
+            new_stream = self.compress(stream)
+            if new_stream is not None:
+                writer._replace_object(ref, new_stream)
@@ -0,0 +1,324 @@
+"""SovPDF compression engine.
+
+Pure Python, no browser dependencies: this module is imported by the
+PyScript front end (main.py) and by the headless batch CLI (batch.py).
+"""
+
+import logging
+import os
+import time
+
+from pypdf import PdfReader, PdfWriter
+
+from content import ContentCompressor
+from fonts import optimize_fonts
+from images import MIN_SAVINGS, ImageCache, iter_reencode_images, reencode_images, summarize_decisions
+from instrument import NULL_INSTRUMENTATION
+from linearize import write_linearized
+from optimize import optimize_objects, write_compact
+from pdfio import buffer_size, open_source, source_size, write_to_buffer
+from strip import CATEGORIES, SAFE, strip_payload
+
+log = logging.getLogger("sovpdf")
+
+# Map presets to JPEG quality, deflate level and image resolution ceiling.
+# Settings may also carry "min_savings", the fraction by which a re-encoded
+# image must shrink to replace the original (images.MIN_SAVINGS by default),
+# "optimize": False to skip merging identical and unreachable objects,
+# "subset_fonts": False to keep embedded fonts whole (see fonts.py), and
+# "strip", the categories of payload no page renders to remove (strip.SAFE
+# by default, () to keep everything; see strip.py).
+PRESETS = {
+    "medium": {"quality": 90, "level": 3, "dpi": 150, "strip": SAFE},
+    "small": {"quality": 75, "level": 5, "dpi": 110, "strip": SAFE + ("metadata", "destinations")},
+    "tiny": {"quality": 50, "level": 9, "dpi": 72, "strip": CATEGORIES},
+}
+
+# Part of every result cache key: bump it whenever the engine can produce
+# different output for the same input and settings
+ENGINE_VERSION = "1.8.1"
+
+
+# Share of the progress bar given to image re-encoding when a document has images
+IMAGE_WORK_SHARE = 0.8
+
+
+class CompressionCancelled(Exception):
+    """Raised inside a compression job whose CancelToken was cancelled"""
+
+
+class CancelToken:
+    """Cooperative cancellation flag, checked by a job between steps"""
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        if self.cancelled:
+            raise CompressionCancelled("Compression cancelled")
+
+
+class CompressionJob:
+    """One compression of a DocumentAnalysis, run as a sequence of small steps
+
+    steps() yields a progress event after every image and every page, and
+    checks the cancel token before each, so a caller can update a UI, give
+    control back to an event loop or abort between steps. run() does the
+    whole job at once. Either way the result ends up in self.writer.
+    With pages (a range of page indexes), only those pages are compressed.
+    Stage timings and counters go to instr.
+    """
+
+    def __init__(self, analysis, settings, cancel=None, instr=None, pages=None):
+        self.analysis = analysis
+        self.settings = settings
+        self.pages = pages
+        self.cancel = cancel or CancelToken()
+        self.instr = instr or NULL_INSTRUMENTATION
+        self.writer = None
+        self.image_stats = {}
+        self.strip_stats = {}
+        self.font_stats = {}
+        self.object_stats = {}
+
+    def steps(self):
+        start = time.perf_counter()
+        reader = self.analysis.reader
+        instr = self.instr
+        self.cancel.check()
+        with instr.stage("copy_pages"):
+            writer = copy_pages(reader, self.pages)
+        pages_total = len(writer.pages)
+        # Payload no page renders goes first, so no later stage spends time on it
+        self.strip_stats.update(strip_payload(writer, self.settings.get("strip", SAFE), instr))
+
+        # Re-encode images, in the order of the pages that first use them
+        stats = self.image_stats
+        images_done = 0
+        bytes_in = bytes_out = 0
+        images = iter_reencode_images(writer, self.settings["quality"], self.settings["dpi"],
+                                      self.analysis.images, stats, instr,
+                                      self.settings.get("min_savings", MIN_SAVINGS))
+        for entry, entry_in, entry_out in images:
+            images_done += 1
+            bytes_in += entry_in
+            bytes_out += entry_out
+            image_fraction = bytes_in / stats["original_image_bytes"] if stats["original_image_bytes"] else 1
+            yield self._event("images", start, entry.first_page, pages_total, images_done,
+                              bytes_in, bytes_out, IMAGE_WORK_SHARE * image_fraction)
+            self.cancel.check()
+
+        # Deflate content streams page by page
+        image_share = IMAGE_WORK_SHARE if stats.get("unique_images") else 0
+        content = ContentCompressor(self.settings["level"], instr)
+        for page_index, page in enumerate(writer.pages):
+            self.cancel.check()
+            with instr.stage("content_streams"):
+                content.compress_page(writer, page)
+            instr.count("pages")
+            yield self._event("content", start, page_index + 1, pages_total, images_done,
+                              bytes_in, bytes_out, image_share + (1 - image_share) * (page_index + 1) / pages_total)
+
+        # Share font programs and cut fonts down to the glyphs the pages show
+        self.cancel.check()
+        self.font_stats = optimize_fonts(writer, self.settings["level"], self.settings.get("subset_fonts", True), instr)
+
+        # Merge identical objects and drop unreachable ones before writing
+        if self.settings.get("optimize", True):
+            self.cancel.check()
+            self.object_stats = optimize_objects(writer, instr)
+        self.writer = writer
+
+    def _event(self, stage, start, pages_done, pages_total, images_done, bytes_in, bytes_out, fraction):
+        elapsed = time.perf_counter() - start
+        return {
+            "stage": stage,
+            "pages_done": pages_done,
+            "pages_total": pages_total,
+            "images_done": images_done,
+            "images_total": self.image_stats.get("unique_images", 0),
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "fraction": fraction,
+            "elapsed": elapsed,
+            "eta": elapsed * (1 - fraction) / fraction if fraction > 0 else None,
+        }
+
+    def run(self, on_progress=None):
+        """Run every step, passing each progress event to on_progress"""
+        for event in self.steps():
+            if on_progress is not None:
+                on_progress(event)
+        return self.writer
+
+
+class DocumentAnalysis:
+    """The preset-independent part of compressing one document
+
+    Holds the parsed reader (which caches every resolved page and resource
+    object) and the decoded image rasters, so trying another preset on the
+    same document only pays for encoding and writing.
+    """
+
+    def __init__(self, source, instr=None):
+        self.size = source_size(source)
+        with (instr or NULL_INSTRUMENTATION).stage("parse"):
+            self.reader = PdfReader(open_source(source))
+            page_count = len(self.reader.pages)
+        self.images = ImageCache()
+        self.image_stats = {}
+        self.strip_stats = {}
+        log.info(f"PDF has {page_count} pages")
+
+    def compress(self, preset, cancel=None, instr=None):
+        """Compress the document with preset and return a new PdfWriter"""
+        return self.job(preset, cancel, instr).run()
+
+    def compress_with(self, settings, cancel=None, instr=None):
+        """Compress the document with explicit quality/level/dpi settings
+
+        The image and strip stats of the run are kept in self.image_stats
+        and self.strip_stats.
+        """
+        return self.job_with(settings, cancel, instr).run()
+
+    def job(self, preset, cancel=None, instr=None, pages=None):
+        """Return a CompressionJob for preset, to be run step by step"""
+        if preset not in PRESETS:
+            raise ValueError(f"Unknown preset: {preset}")
+        return self.job_with(PRESETS[preset], cancel, instr, pages)
+
+    def job_with(self, settings, cancel=None, instr=None, pages=None):
+        """Return a CompressionJob for explicit settings, optionally on a range of pages"""
+        job = CompressionJob(self, settings, cancel, instr, pages)
+        # Shared with the job, so it is filled in as the job runs
+        self.image_stats = job.image_stats
+        self.strip_stats = job.strip_stats
+        return job
+
+    def close(self):
+        """Release the cached rasters"""
+        self.images.clear()
+
+
+def reduce_quality(reader, quality=90, dpi=None, image_cache=None, min_savings=MIN_SAVINGS):
+    """Copy the pages of reader into a new writer, re-encoding each unique image once
+
+    Images drawn at more than dpi pixels per inch are downsampled first, and
+    an image only replaced when it comes out at least min_savings smaller.
+    """
+    log.info(f"Reducing quality with setting: {quality}, dpi ceiling: {dpi}")
+    writer = copy_pages(reader)
+    reencode_images(writer, quality, dpi, image_cache, min_savings)
+    log.info("Quality reduction complete")
+    return writer
+
+
+def copy_pages(reader, pages=None):
+    """Copy the pages (all, or the indexes in pages) and document info of reader into a new PdfWriter"""
+    writer = PdfWriter()
+    for index in pages if pages is not None else range(len(reader.pages)):
+        writer.add_page(reader.pages[index])
+    if reader.metadata:
+        writer.add_metadata(reader.metadata)
+    return writer
+
+
+def compress_lossless(writer, level=3):
+    """Deflate the content streams of every page (see content.ContentCompressor)"""
+    log.info(f"Compressing with level: {level}")
+    content = ContentCompressor(level)
+    for page in writer.pages:
+        content.compress_page(writer, page)
+
+    log.info("Compression complete")
+    return writer
+
+
+def compress_pdf(source, preset, analysis=None, instr=None):
+    """Compress a PDF with the given preset and return the PdfWriter
+
+    Parameters:
+        source: path, bytes-like buffer or binary file object of the input PDF
+        preset: str - one of the keys of PRESETS
+        analysis: DocumentAnalysis of source to reuse, if any
+        instr: Instrumentation collecting stage timings and counters, if any
+    """
+    if analysis is None:
+        analysis = DocumentAnalysis(source, instr)
+    return analysis.compress(preset, instr=instr)
+
+
+def compress_all_presets(source, presets=None):
+    """Yield (preset, writer) for every preset, parsing and decoding source once"""
+    analysis = DocumentAnalysis(source)
+    try:
+        for preset in presets or PRESETS:
+            yield preset, analysis.compress(preset)
+    finally:
+        analysis.close()
+
+
+def compress_to_buffer(source, preset, analysis=None, instr=None, linearize=False):
+    """Compress source into an in-memory sink, linearized for fast web view with linearize
+
+    Returns (sink, stats): a BytesIO holding the compressed PDF and a stats
+    dictionary with sizes taken from the buffer lengths.
+    """
+    start = time.perf_counter()
+    if analysis is None:
+        analysis = DocumentAnalysis(source, instr)
+    writer = analysis.compress(preset, instr=instr)
+    with (instr or NULL_INSTRUMENTATION).stage("write"):
+        sink = write_to_buffer(writer, linearize)
+    stats = make_stats(preset, analysis.size, buffer_size(sink), start, instr)
+    stats["image_decisions"] = summarize_decisions(analysis.image_stats.get("decisions", []))
+    stats["stripped"] = dict(analysis.strip_stats)
+    if linearize:
+        stats["linearized"] = True
+    return sink, stats
+
+
+def compress_file(input_path, output_path, preset, instr=None, linearize=False):
+    """Compress input_path into output_path and return a stats dictionary
+
+    With linearize, the output is laid out for fast web view.
+    """
+    start = time.perf_counter()
+    analysis = DocumentAnalysis(input_path, instr)
+    writer = compress_pdf(input_path, preset, analysis, instr)
+    with (instr or NULL_INSTRUMENTATION).stage("write"):
+        with open(output_path, "wb") as f:
+            if linearize:
+                write_linearized(writer, f)
+            else:
+                write_compact(writer, f)
+
+    stats = make_stats(preset, os.path.getsize(input_path), os.path.getsize(output_path), start, instr)
+    stats["image_decisions"] = summarize_decisions(analysis.image_stats.get("decisions", []))
+    stats["stripped"] = dict(analysis.strip_stats)
+    if linearize:
+        stats["linearized"] = True
+    return {"input": input_path, "output": output_path, **stats}
+
+
+def make_stats(preset, original_size, compressed_size, start, instr=None):
+    """Stats dictionary for one compression that began at perf_counter() start
+
+    With instr, its report is included under "report".
+    """
+    stats = {
+        "preset": preset,
+        "original_size": original_size,
+        "compressed_size": compressed_size,
+        "ratio": compressed_size / original_size if original_size else 1.0,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+    if instr is not None:
+        instr.count("input_bytes", original_size)
+        instr.count("output_bytes", compressed_size)
+        stats["report"] = instr.report()
+    return stats
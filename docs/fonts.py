@@ -0,0 +1,687 @@
+"""Font deduplication and subsetting for the SovPDF engine.
+
+Merged documents often embed the same font program once per source file,
+and many documents embed whole fonts of which they show a few dozen
+glyphs. optimize_fonts
+
+- points every font descriptor at one copy of each font program, comparing
+  programs by their decoded bytes (optimize.merge_identical_objects only
+  merges streams whose stored bytes are identical);
+- collects the character codes shown with each font, from the content
+  streams of the pages, the form XObjects, tiling patterns and Type 3
+  glyphs they use, and the appearances of their annotations;
+- subsets each TrueType program (the FontFile2 of simple TrueType and
+  CIDFontType2 fonts) to the glyphs those codes select, and trims /Widths,
+  /W, /Differences and /CIDSet to the codes shown.
+
+Subsets keep their glyph ids, with the unused glyphs emptied, so content
+streams and CIDToGIDMaps stay as they are. Fonts whose use can't be fully
+known (form field fonts, fonts set by an ExtGState, CMaps other than
+Identity) are kept whole, as are programs whose licence forbids
+subsetting. fontTools is optional: without it fonts are only deduplicated.
+"""
+
+import hashlib
+import logging
+import re
+import zlib
+from collections import defaultdict
+from io import BytesIO
+
+from pypdf._codecs import _mac_encoding, _std_encoding, _win_encoding, adobe_glyphs
+from pypdf.filters import decode_stream_data
+from pypdf.generic import (
+    ArrayObject,
+    ContentStream,
+    DecodedStreamObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    StreamObject,
+)
+
+from content import KEYWORD_OPERANDS, NUMBER_START, REGULAR, _tokenize
+from instrument import NULL_INSTRUMENTATION
+from optimize import replace_references
+
+try:
+    from fontTools import subset as ft_subset
+    from fontTools.agl import UV2AGL
+    from fontTools.ttLib import TTFont, newTable
+except ImportError:  # pragma: no cover - fontTools is loaded with the engine
+    ft_subset = None
+
+log = logging.getLogger("sovpdf")
+
+FONT_FILE_KEYS = ("/FontFile", "/FontFile2", "/FontFile3")
+# Font types whose FontFile2 program can be subset
+SUBSET_TYPES = ("/TrueType", "/CIDFontType2")
+IDENTITY_ENCODINGS = ("/Identity-H", "/Identity-V")
+BASE_ENCODINGS = {
+    "/WinAnsiEncoding": _win_encoding,
+    "/MacRomanEncoding": _mac_encoding,
+    "/StandardEncoding": _std_encoding,
+}
+# Text showing operators; their strings are the operands
+SHOW_OPERATORS = {b"Tj", b"TJ", b"'", b'"'}
+# OS/2 fsType bit set by fonts that may not be subset
+NO_SUBSETTING = 0x0100
+# Tables no PDF viewer reads
+UNUSED_TABLES = ["GSUB", "GPOS", "GDEF", "BASE", "JSTF", "MATH", "kern", "morx", "kerx", "hdmx", "VDMX", "FFTM"]
+
+_ESCAPE = re.compile(rb"\\(?:([0-7]{1,3})|(\r\n|\r|\n)|(.))|\r\n?", re.S)
+_ESCAPED = {b"n": b"\n", b"r": b"\r", b"t": b"\t", b"b": b"\b", b"f": b"\f"}
+_NAME_ESCAPE = re.compile(rb"#([0-9A-Fa-f]{2})")
+_SUBSET_TAG = re.compile(r"^/[A-Z]{6}\+")
+
+
+def _unescape(match):
+    octal, newline, char = match.groups()
+    if octal:
+        return bytes([int(octal, 8) & 0xFF])
+    if newline:
+        return b""
+    if char is None:
+        # An unescaped end of line reads as a line feed
+        return b"\n"
+    return _ESCAPED.get(char, char)
+
+
+def _literal(token):
+    """The bytes of a literal string token"""
+    return _ESCAPE.sub(_unescape, token[1:-1])
+
+
+def _hex(token):
+    digits = bytes(b for b in token[1:-1] if b not in b"\x00\t\n\x0c\r ")
+    if len(digits) % 2:
+        digits += b"0"
+    try:
+        return bytes.fromhex(digits.decode("ascii"))
+    except ValueError:
+        return b""
+
+
+def _operand(token):
+    """A name as a str, a string as bytes, anything else as None"""
+    first = token[0]
+    if first == 0x2F:
+        if b"#" in token:
+            token = _NAME_ESCAPE.sub(lambda m: bytes([int(m.group(1), 16)]), token)
+        return token.decode("latin-1")
+    if first == 0x28:
+        return _literal(token)
+    if first == 0x3C and token != b"<<":
+        return _hex(token)
+    return None
+
+
+def _parsed_operations(data):
+    """(operands, operator) of data as parsed by pypdf, for streams the
+    tokenizer can't read (inline images, deeply nested strings)"""
+    stream = DecodedStreamObject()
+    stream.set_data(data)
+    for operands, operator in ContentStream(stream, None).operations:
+        items = []
+        for operand in operands if isinstance(operands, list) else []:
+            for item in operand if isinstance(operand, ArrayObject) else [operand]:
+                if isinstance(item, NameObject):
+                    items.append(str(item))
+                elif hasattr(item, "original_bytes"):
+                    items.append(item.original_bytes)
+                elif isinstance(item, bytes):
+                    items.append(bytes(item))
+                else:
+                    items.append(None)
+        yield items, operator
+
+
+def _operations(data):
+    """Yield (operands, operator) for each operation of content stream data
+
+    Operands are reduced to what the scan needs: names as str, strings as
+    bytes, everything else None.
+    """
+    tokens = _tokenize(data)
+    if tokens is None:
+        yield from _parsed_operations(data)
+        return
+    operands = []
+    for token in tokens:
+        first = token[0]
+        if first in REGULAR and first not in NUMBER_START and token not in KEYWORD_OPERANDS:
+            yield operands, token
+            operands = []
+        else:
+            operands.append(_operand(token))
+
+
+def _resolved(value):
+    value = value.get_object() if value is not None else None
+    return value if isinstance(value, DictionaryObject) else DictionaryObject()
+
+
+def _decoded(stream):
+    """The decoded data of stream, whichever pypdf stream class it is"""
+    if "/Filter" not in stream:
+        return stream._data
+    return decode_stream_data(stream)
+
+
+def _stream_data(value):
+    """Decoded data of a content stream, or of an array of them joined"""
+    value = value.get_object() if value is not None else None
+    items = list(value) if isinstance(value, ArrayObject) else [value]
+    parts = []
+    for item in items:
+        item = item.get_object() if item is not None else None
+        if isinstance(item, StreamObject):
+            try:
+                parts.append(_decoded(item))
+            except Exception:
+                return None
+    return b"\n".join(parts)
+
+
+def _descendant(font):
+    """The CIDFont of a Type 0 font, as a reference if it is one"""
+    descendants = font.get("/DescendantFonts")
+    descendants = descendants.get_object() if descendants is not None else None
+    if isinstance(descendants, ArrayObject) and descendants:
+        return descendants[0]
+    return None
+
+
+def _program(font):
+    """The reference to the FontFile2 program of a simple or CID font, if any"""
+    descriptor = _resolved(font.get("/FontDescriptor"))
+    program = descriptor.raw_get("/FontFile2") if "/FontFile2" in descriptor else None
+    return program if isinstance(program, IndirectObject) else None
+
+
+class GlyphUsage:
+    """The strings shown with each font of a document
+
+    strings maps the object number of each simple or CID font dictionary
+    to the strings shown with it; whole holds the object numbers of the
+    font programs whose use couldn't be fully followed.
+    """
+
+    def __init__(self):
+        self.strings = defaultdict(set)
+        self.whole = set()
+        self.scanned = set()
+
+    def keep_whole(self, font):
+        """Mark the program of font (a font dictionary or a reference to one) as used whole"""
+        font = font.get_object() if font is not None else None
+        if not isinstance(font, DictionaryObject):
+            return
+        if font.get("/Subtype") == "/Type0":
+            font = _resolved(_descendant(font))
+        program = _program(font)
+        if program is not None:
+            self.whole.add(program.idnum)
+
+    def show(self, ref, strings):
+        """Record strings shown with the font ref points at"""
+        font = ref.get_object() if ref is not None else None
+        if not isinstance(ref, IndirectObject) or not isinstance(font, DictionaryObject):
+            self.keep_whole(font)
+            return
+        if font.get("/Subtype") == "/Type0":
+            descendant = _descendant(font)
+            if font.get("/Encoding") not in IDENTITY_ENCODINGS or not isinstance(descendant, IndirectObject):
+                self.keep_whole(font)
+                return
+            ref = descendant
+        self.strings[ref.idnum].update(strings)
+
+    def scan_document(self, writer):
+        """Scan every page of writer, with its annotations, and the form fields"""
+        for page in writer.pages:
+            data = _stream_data(page.raw_get("/Contents")) if "/Contents" in page else b""
+            if data is None:
+                for ref in _resolved(_resolved(page.get("/Resources")).get("/Font")).values():
+                    self.keep_whole(ref)
+                continue
+            self.scan(data, page.get("/Resources"))
+            annotations = page.get("/Annots")
+            for annotation in annotations.get_object() if annotations is not None else []:
+                appearances = _resolved(_resolved(annotation).get("/AP"))
+                for key in ("/N", "/R", "/D"):
+                    self.scan_appearance(appearances.raw_get(key) if key in appearances else None)
+        # Form fields can be filled in later, with any glyph of their fonts
+        form = _resolved(writer.root_object.get("/AcroForm"))
+        for ref in _resolved(_resolved(form.get("/DR")).get("/Font")).values():
+            self.keep_whole(ref)
+
+    def scan_appearance(self, value):
+        """Scan an appearance stream, or a dictionary of them by state"""
+        obj = value.get_object() if value is not None else None
+        if isinstance(obj, StreamObject):
+            self.scan_stream(value, None)
+        elif isinstance(obj, DictionaryObject):
+            for state in obj.keys():
+                self.scan_appearance(obj.raw_get(state))
+
+    def scan_stream(self, ref, resources, font=None):
+        """Scan a form XObject, pattern or glyph procedure, once per starting font"""
+        stream = ref.get_object()
+        key = tuple(item.idnum if isinstance(item, IndirectObject) else id(item) for item in (ref, font))
+        if key in self.scanned:
+            return
+        self.scanned.add(key)
+        try:
+            data = _decoded(stream)
+        except Exception:
+            return
+        # Streams without resources of their own use those they are drawn with
+        self.scan(data, stream.get("/Resources", resources), font)
+
+    def scan(self, data, resources, font=None):
+        """Scan content stream data drawn with resources, starting with font selected"""
+        resources = _resolved(resources)
+        fonts = _resolved(resources.get("/Font"))
+        xobjects = _resolved(resources.get("/XObject"))
+        states = _resolved(resources.get("/ExtGState"))
+        saved = []
+        for operands, operator in _operations(data):
+            if operator in SHOW_OPERATORS:
+                if font is not None:
+                    self.show(font, [operand for operand in operands if isinstance(operand, bytes)])
+            elif operator == b"Tf":
+                name = operands[0] if operands else None
+                font = fonts.raw_get(name) if isinstance(name, str) and name in fonts else None
+                if font is not None and _resolved(font).get("/Subtype") == "/Type3":
+                    self.scan_type3(font, resources)
+            elif operator == b"q":
+                saved.append(font)
+            elif operator == b"Q":
+                if saved:
+                    font = saved.pop()
+            elif operator == b"Do":
+                name = operands[0] if operands else None
+                if isinstance(name, str) and name in xobjects:
+                    ref = xobjects.raw_get(name)
+                    if _resolved(ref).get("/Subtype") == "/Form":
+                        self.scan_stream(ref, resources, font)
+            elif operator == b"gs":
+                name = operands[0] if operands else None
+                state = _resolved(states.get(name)) if isinstance(name, str) and name in states else {}
+                selected = state.get("/Font")
+                if selected is not None:
+                    selected = selected.get_object()
+                    self.keep_whole(selected[0] if isinstance(selected, ArrayObject) and selected else None)
+        # Tiling patterns can show text too
+        patterns = _resolved(resources.get("/Pattern"))
+        for name in patterns.keys():
+            ref = patterns.raw_get(name)
+            if isinstance(ref.get_object(), StreamObject):
+                self.scan_stream(ref, resources)
+
+    def scan_type3(self, ref, resources):
+        """Scan the glyph procedures of a Type 3 font, once"""
+        font = ref.get_object()
+        key = ("type3", ref.idnum if isinstance(ref, IndirectObject) else id(font))
+        if key in self.scanned:
+            return
+        self.scanned.add(key)
+        procedures = _resolved(font.get("/CharProcs"))
+        for name in procedures.keys():
+            self.scan_stream(procedures.raw_get(name), font.get("/Resources", resources))
+
+
+def _glyph_unicode(name):
+    """The character a glyph name stands for, or None"""
+    char = adobe_glyphs.get(name)
+    if char:
+        return char
+    match = re.match(r"^/uni([0-9A-Fa-f]{4})$", name) or re.match(r"^/u([0-9A-Fa-f]{4,6})$", name)
+    return chr(int(match.group(1), 16)) if match else None
+
+
+def _differences(font):
+    """{code: glyph name} of the /Differences of font's encoding"""
+    encoding = font.get("/Encoding")
+    encoding = encoding.get_object() if encoding is not None else None
+    names = {}
+    if isinstance(encoding, DictionaryObject):
+        code = 0
+        for item in encoding.get("/Differences", []):
+            item = item.get_object()
+            if isinstance(item, NameObject):
+                names[code] = str(item)
+                code += 1
+            else:
+                code = int(item)
+    return names
+
+
+def _base_encodings(font):
+    """The base encodings a simple font's codes may be read with"""
+    encoding = font.get("/Encoding")
+    encoding = encoding.get_object() if encoding is not None else None
+    if isinstance(encoding, DictionaryObject):
+        encoding = encoding.get("/BaseEncoding")
+    if encoding in BASE_ENCODINGS:
+        return [BASE_ENCODINGS[encoding]]
+    # Viewers differ on the default: keep the glyphs of all of them
+    return list(BASE_ENCODINGS.values())
+
+
+def _simple_glyphs(font, codes, tt):
+    """The glyph names codes of simple TrueType font select in tt
+
+    Viewers look glyphs up through whichever cmap subtable the font has, by
+    code, by the character of the code's glyph name or by the name itself;
+    every glyph any of these selects is kept.
+    """
+    order = set(tt.getGlyphOrder())
+    tables = {(table.platformID, table.platEncID): table.cmap for table in tt["cmap"].tables} if "cmap" in tt else {}
+    unicode_tables = [cmap for (platform, encoding), cmap in tables.items() if platform == 0 or (platform, encoding) in ((3, 1), (3, 10))]
+    symbol = tables.get((3, 0), {})
+    mac = tables.get((1, 0), {})
+    differences = _differences(font)
+    bases = _base_encodings(font)
+    glyphs = set()
+    for code in codes:
+        for offset in (0, 0xF000, 0xF100, 0xF200):
+            glyphs.add(symbol.get(offset + code))
+        glyphs.add(mac.get(code))
+        chars = set()
+        name = differences.get(code)
+        if name is not None:
+            glyphs.add(name[1:])
+            chars.add(_glyph_unicode(name))
+        else:
+            chars.update(base[code] for base in bases)
+        for char in chars:
+            if char and char != "\x00":
+                for cmap in unicode_tables:
+                    glyphs.add(cmap.get(ord(char)))
+                glyphs.add(UV2AGL.get(ord(char)))
+        if not tables:
+            glyphs.add(tt.getGlyphName(code) if code < len(order) else None)
+    return {glyph for glyph in glyphs if glyph in order}
+
+
+def _cid_codes(strings):
+    return {(string[i] << 8) | string[i + 1] for string in strings for i in range(0, len(string) - 1, 2)}
+
+
+def _cid_glyphs(font, cids, tt):
+    """The glyph names the CIDs of CIDFontType2 font select in tt"""
+    mapping = font.get("/CIDToGIDMap")
+    mapping = mapping.get_object() if mapping is not None else None
+    table = _decoded(mapping) if isinstance(mapping, StreamObject) else None
+    order = tt.getGlyphOrder()
+    glyphs = set()
+    for cid in cids:
+        gid = cid if table is None else int.from_bytes(table[2 * cid:2 * cid + 2] or b"\0\0", "big")
+        if gid < len(order):
+            glyphs.add(order[gid])
+    return glyphs
+
+
+def _subset_program(tt, glyphs):
+    """The TrueType font tt cut down to glyphs, keeping glyph ids, as bytes"""
+    options = ft_subset.Options()
+    options.retain_gids = True
+    options.notdef_outline = True
+    options.glyph_names = True
+    options.legacy_cmap = True
+    options.symbol_cmap = True
+    options.layout_closure = False
+    options.prune_unicode_ranges = False
+    options.recalc_timestamp = False
+    options.drop_tables = options.drop_tables + UNUSED_TABLES
+    # The subsetter needs a cmap, which the fonts of CID fonts often lack
+    cmap = "cmap" in tt
+    if not cmap:
+        tt["cmap"] = newTable("cmap")
+        tt["cmap"].tableVersion = 0
+        tt["cmap"].tables = []
+    subsetter = ft_subset.Subsetter(options)
+    subsetter.populate(glyphs=glyphs)
+    subsetter.subset(tt)
+    if not cmap:
+        del tt["cmap"]
+    out = BytesIO()
+    tt.save(out)
+    return out.getvalue()
+
+
+def _trim_simple(font, codes):
+    """Trim /Widths to the codes shown and /Differences to those of them it names"""
+    if codes and "/Widths" in font and "/FirstChar" in font:
+        first = int(font["/FirstChar"])
+        widths = font["/Widths"].get_object()
+        low, high = max(first, min(codes)), min(first + len(widths) - 1, max(codes))
+        if low <= high:
+            font[NameObject("/FirstChar")] = NumberObject(low)
+            font[NameObject("/LastChar")] = NumberObject(high)
+            font[NameObject("/Widths")] = ArrayObject(
+                widths[code - first] if code in codes else NumberObject(0) for code in range(low, high + 1)
+            )
+    encoding = font.get("/Encoding")
+    encoding = encoding.get_object() if encoding is not None else None
+    if isinstance(encoding, DictionaryObject) and "/Differences" in encoding:
+        differences = ArrayObject()
+        previous = None
+        for code, name in sorted(_differences(font).items()):
+            if code in codes:
+                if code != previous:
+                    differences.append(NumberObject(code))
+                differences.append(NameObject(name))
+                previous = code + 1
+        new_encoding = DictionaryObject(encoding)
+        new_encoding[NameObject("/Differences")] = differences
+        font[NameObject("/Encoding")] = new_encoding
+
+
+def _trim_cid(font, cids):
+    """Trim /W to the CIDs shown"""
+    if "/W" not in font:
+        return
+    widths = {}
+    items = list(font["/W"].get_object())
+    i = 0
+    while i + 1 < len(items):
+        first, second = int(items[i]), items[i + 1].get_object()
+        if isinstance(second, ArrayObject):
+            for offset, width in enumerate(second):
+                widths.setdefault(first + offset, width)
+            i += 2
+        elif i + 2 < len(items):
+            for cid in range(first, int(second) + 1):
+                widths.setdefault(cid, items[i + 2])
+            i += 3
+        else:
+            break
+    trimmed = ArrayObject()
+    for cid in sorted(cid for cid in cids if cid in widths):
+        if trimmed and int(trimmed[-2]) + len(trimmed[-1]) == cid:
+            trimmed[-1].append(widths[cid])
+        else:
+            trimmed.extend([NumberObject(cid), ArrayObject([widths[cid]])])
+    font[NameObject("/W")] = trimmed
+
+
+def _cid_set(cids):
+    """A /CIDSet stream listing cids and CID 0"""
+    bits = bytearray((max(cids | {0}) >> 3) + 1)
+    for cid in cids | {0}:
+        bits[cid >> 3] |= 0x80 >> (cid & 7)
+    stream = StreamObject()
+    stream._data = zlib.compress(bytes(bits))
+    stream[NameObject("/Filter")] = NameObject("/FlateDecode")
+    return stream
+
+
+def _tag(glyphs):
+    """Six capital letters naming a subset, derived from its glyphs"""
+    digest = hashlib.blake2b("\n".join(sorted(glyphs)).encode(), digest_size=6).digest()
+    return "".join(chr(ord("A") + byte % 26) for byte in digest)
+
+
+def _tagged(name, tag):
+    name = str(name)
+    return NameObject(name if _SUBSET_TAG.match(name) else f"/{tag}+{name[1:]}")
+
+
+def merge_font_programs(writer):
+    """Point every font descriptor at one copy of each font program
+
+    Programs are the same when their decoded bytes are; they are only
+    decoded when another program has the same type and declared lengths.
+    Returns (programs merged, bytes of the merged programs).
+    """
+    objects = writer._objects
+    candidates = defaultdict(set)  # type and declared lengths -> program numbers
+    for obj in objects:
+        if not isinstance(obj, DictionaryObject) or isinstance(obj, StreamObject):
+            continue
+        for key in FONT_FILE_KEYS:
+            ref = obj.raw_get(key) if key in obj else None
+            if not isinstance(ref, IndirectObject) or not 0 < ref.idnum <= len(objects):
+                continue
+            program = objects[ref.idnum - 1]
+            if isinstance(program, StreamObject):
+                shape = (key,) + tuple(program[name] for name in ("/Subtype", "/Length1", "/Length2", "/Length3")
+                                       if name in program)
+                candidates[shape].add(ref.idnum)
+
+    mapping = {}
+    saved = 0
+    for idnums in candidates.values():
+        if len(idnums) < 2:
+            continue
+        seen = {}
+        # The copy stored smallest is the one kept
+        for idnum in sorted(idnums, key=lambda idnum: (len(objects[idnum - 1]._data), idnum)):
+            try:
+                digest = hashlib.blake2b(_decoded(objects[idnum - 1]), digest_size=16).digest()
+            except Exception:
+                continue
+            first = seen.setdefault(digest, idnum)
+            if first != idnum:
+                mapping[idnum] = IndirectObject(first, 0, writer)
+                saved += len(objects[idnum - 1]._data)
+
+    if mapping:
+        for obj in objects:
+            if obj is not None:
+                replace_references(obj, mapping)
+        for idnum in mapping:
+            objects[idnum - 1] = None
+    return len(mapping), saved
+
+
+def subset_fonts(writer, level=6):
+    """Subset the TrueType programs of writer to the glyphs its pages show
+
+    Returns (programs subset, bytes saved).
+    """
+    if ft_subset is None:
+        return 0, 0
+    objects = writer._objects
+    users = defaultdict(list)  # program number -> numbers of the fonts using it
+    parents = {}  # CIDFont number -> its Type 0 font
+    whole = set()
+    for idnum, obj in enumerate(objects, start=1):
+        if not isinstance(obj, DictionaryObject) or obj.get("/Type") != "/Font":
+            continue
+        if obj.get("/Subtype") == "/Type0":
+            descendant = _descendant(obj)
+            if isinstance(descendant, IndirectObject):
+                parents[descendant.idnum] = obj
+            continue
+        program = _program(obj)
+        if program is None:
+            continue
+        users[program.idnum].append(idnum)
+        if obj.get("/Subtype") not in SUBSET_TYPES:
+            whole.add(program.idnum)
+    if not set(users) - whole:
+        return 0, 0
+
+    usage = GlyphUsage()
+    usage.scan_document(writer)
+    whole |= usage.whole
+
+    count = saved = 0
+    for program_idnum, fonts in users.items():
+        program = objects[program_idnum - 1]
+        if program_idnum in whole or not isinstance(program, StreamObject):
+            continue
+        try:
+            data = _decoded(program)
+            tt = TTFont(BytesIO(data), lazy=True)
+            if "OS/2" in tt and tt["OS/2"].fsType & NO_SUBSETTING:
+                continue
+            codes = {}
+            glyphs = {".notdef"}
+            for idnum in fonts:
+                font = objects[idnum - 1]
+                strings = usage.strings.get(idnum, ())
+                if font.get("/Subtype") == "/CIDFontType2":
+                    codes[idnum] = _cid_codes(strings)
+                    glyphs |= _cid_glyphs(font, codes[idnum], tt)
+                else:
+                    codes[idnum] = {code for string in strings for code in string}
+                    glyphs |= _simple_glyphs(font, codes[idnum], tt)
+            subset = _subset_program(tt, glyphs)
+        except Exception as e:
+            log.warning(f"Font program {program_idnum} kept whole: {type(e).__name__}: {e}")
+            continue
+        compressed = zlib.compress(subset, level)
+        if len(compressed) >= len(program._data):
+            continue
+
+        saved += len(program._data) - len(compressed)
+        count += 1
+        program._data = compressed
+        program[NameObject("/Filter")] = NameObject("/FlateDecode")
+        program[NameObject("/Length1")] = NumberObject(len(subset))
+        if "/DecodeParms" in program:
+            del program["/DecodeParms"]
+        tag = _tag(glyphs)
+        for idnum in fonts:
+            font = objects[idnum - 1]
+            descriptor = font["/FontDescriptor"].get_object()
+            if "/FontName" in descriptor:
+                descriptor[NameObject("/FontName")] = _tagged(descriptor["/FontName"], tag)
+            if "/BaseFont" in font:
+                font[NameObject("/BaseFont")] = _tagged(font["/BaseFont"], tag)
+            if font.get("/Subtype") == "/CIDFontType2":
+                _trim_cid(font, codes[idnum])
+                if "/CIDSet" in descriptor:
+                    descriptor[NameObject("/CIDSet")] = writer._add_object(_cid_set(codes[idnum]))
+                parent = parents.get(idnum)
+                if parent is not None and "/BaseFont" in parent:
+                    parent[NameObject("/BaseFont")] = _tagged(parent["/BaseFont"], tag)
+            else:
+                _trim_simple(font, codes[idnum])
+    return count, saved
+
+
+def optimize_fonts(writer, level=6, subset=True, instr=NULL_INSTRUMENTATION):
+    """Merge identical font programs, then subset TrueType fonts unless subset is false
+
+    Subset programs are deflated at level. Returns {"merged_font_programs":
+    n, "subset_font_programs": n, "font_bytes_saved": n}.
+    """
+    with instr.stage("fonts"):
+        merged, merged_bytes = merge_font_programs(writer)
+        subsetted, subset_bytes = subset_fonts(writer, level) if subset else (0, 0)
+    instr.count("merged_font_programs", merged)
+    instr.count("subset_font_programs", subsetted)
+    instr.count("font_bytes_saved", merged_bytes + subset_bytes)
+    log.info(f"Merged {merged} font programs, subset {subsetted}, saving {merged_bytes + subset_bytes} bytes")
+    return {
+        "merged_font_programs": merged,
+        "subset_font_programs": subsetted,
+        "font_bytes_saved": merged_bytes + subset_bytes,
+    }
@@ -0,0 +1,855 @@
+"""Image XObject handling for the SovPDF engine.
+
+Images are indexed by content before anything is re-encoded, so an image
+shared by many pages (a logo, a letterhead, a watermark) is decoded and
+encoded once, and every page ends up pointing at the same stream.
+
+An image that is going to be downsampled is shrunk while it is decoded:
+JPEGs are decoded at 1/2, 1/4 or 1/8 scale and plain Flate images a strip
+at a time, so neither ever needs its full-size raster in memory.
+"""
+
+import hashlib
+import logging
+import math
+import zlib
+from io import BytesIO
+
+from PIL import Image, ImageChops
+
+from classify import BILEVEL, COLOR, GRAY, classify_image
+from instrument import NULL_INSTRUMENTATION
+from pypdf.filters import FlateDecode
+from pypdf.generic import (
+    ArrayObject,
+    BooleanObject,
+    ContentStream,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    StreamObject,
+)
+
+try:
+    from pypdf.generic._image_xobject import _xobj_to_image
+except ImportError:  # pypdf < 4.0
+    from pypdf.filters import _xobj_to_image
+
+# PNG predictors are undone with pypdf's own code, when it has it
+_png_prediction = getattr(FlateDecode, "_decode_png_prediction", None)
+
+log = logging.getLogger("sovpdf")
+
+# Entries carried over from the original image dictionary when re-encoding.
+# Masks are separate images of their own size, so resampling doesn't touch
+# them; a colour-key /Mask (an array) rules re-encoding out instead
+KEPT_IMAGE_KEYS = ("/SMask", "/Mask", "/Interpolate", "/Intent", "/OC", "/StructParent", "/ID", "/Metadata")
+# Entries that don't change an image's pixels, and that strip.py may remove:
+# left out of its content key, so stripped and original copies match
+NON_PIXEL_KEYS = {"/Metadata", "/Alternates", "/PieceInfo", "/AF"}
+
+# Pillow modes that can be written as a baseline JPEG
+JPEG_COLOR_SPACES = {"L": "/DeviceGray", "RGB": "/DeviceRGB", "CMYK": "/DeviceCMYK"}
+
+# Re-encoding gates: images below these sizes are never worth a decode
+MIN_IMAGE_BYTES = 2048
+MIN_IMAGE_PIXELS = 32 * 32
+# A JPEG denser than this (bytes per pixel) is only re-encoded when downsampled
+EFFICIENT_JPEG_BYTES_PER_PIXEL = 0.15
+# A Flate image this compressed (bytes per sample) is flat-colour line art
+LINE_ART_BYTES_PER_SAMPLE = 0.05
+# An encoded image must be at least this much smaller to replace the original
+MIN_SAVINGS = 0.05
+# 1-bit images need more pixels than gray ones to stay legible: they are
+# kept at this multiple of the preset's resolution ceiling, and no lower
+# than BILEVEL_MIN_DPI
+BILEVEL_DPI_FACTOR = 2
+BILEVEL_MIN_DPI = 150
+# A decode_reduction that doesn't shrink
+FULL_SIZE = (1, 1)
+# Resampling box-reduces by an integer factor until the image is within
+# this multiple of the target size, and filters the rest of the way
+REDUCING_GAP = 2.0
+# Scales a JPEG can be decoded at, as 1/n
+DRAFT_SCALES = (8, 4, 2)
+# A Flate image shrunk while decoding is inflated about this much at a time
+STRIP_BYTES = 4 * 1024 * 1024
+# Pillow modes of the colour spaces whose samples decode to pixels as they are
+PLAIN_COLOR_SPACES = {"/DeviceGray": "L", "/CalGray": "L", "/DeviceRGB": "RGB", "/CalRGB": "RGB", "/DeviceCMYK": "CMYK"}
+
+
+class ImageEntry:
+    """One unique image of a document and every place it is referenced from"""
+
+    def __init__(self, key, ref):
+        self.key = key
+        self.ref = ref  # canonical indirect reference, shared by all pages
+        self.duplicates = []  # other references to identical streams
+        self.uses = 0
+        self.first_page = 0  # index of the first page using the image
+        self.display_size = None  # largest (width, height) drawn, in points
+
+    @property
+    def stream(self):
+        return self.ref.get_object()
+
+
+class ImageCache:
+    """Preset-independent image work, keyed by content hash
+
+    Holding one of these across several reencode_images calls on copies of
+    the same document means each image is decoded and measured only once
+    (once per reduction, for presets that shrink it by different factors).
+    """
+
+    def __init__(self):
+        self.rasters = {}  # key -> {reduction: decoded PIL image}, see decode_reduction
+        self.classes = {}  # (key, reduction) -> (kind, threshold) from classify_image
+        self.display_sizes = {}  # key -> largest rendered (width, height)
+        self.measured = False
+
+    def holds(self, entry, reduction=None):
+        return reduction in self.rasters.get(entry.key, ())
+
+    def decode(self, entry, reduction=None):
+        img = self.rasters.get(entry.key, {}).get(reduction)
+        if img is not None:
+            return img
+        if reduction not in (None, FULL_SIZE) and _predictor(entry.stream, _plain_mode(entry.stream)) != 1:
+            # Undoing a PNG predictor costs as much as a full decode, so the
+            # full raster is kept and reduced for every preset instead, which
+            # gives the same pixels as decoding it in strips
+            img = self.decode(entry, FULL_SIZE).reduce(reduction)
+        else:
+            img = decode_image(entry.stream, reduction)
+            img.load()
+        self.rasters.setdefault(entry.key, {})[reduction] = img
+        return img
+
+    def classify(self, entry, img, reduction=None):
+        result = self.classes.get((entry.key, reduction))
+        if result is None:
+            result = self.classes[entry.key, reduction] = classify_image(img)
+        return result
+
+    def clear(self):
+        self.rasters.clear()
+        self.classes.clear()
+        self.display_sizes.clear()
+        self.measured = False
+
+
+def iter_image_xobjects(resources, visited=None):
+    """Yield (xobject_dict, name, ref) for every image reachable from resources
+
+    Form XObjects are followed recursively; inline images are not included.
+    """
+    if visited is None:
+        visited = set()
+    resources = resources.get_object() if resources is not None else None
+    if not isinstance(resources, DictionaryObject) or "/XObject" not in resources:
+        return
+    xobjects = resources["/XObject"].get_object()
+    for name in list(xobjects.keys()):
+        ref = xobjects.raw_get(name)
+        if not isinstance(ref, IndirectObject):
+            continue
+        obj = ref.get_object()
+        if not isinstance(obj, StreamObject):
+            continue
+        subtype = obj.get("/Subtype")
+        if subtype == "/Image":
+            yield xobjects, name, ref
+        elif subtype == "/Form" and ref.idnum not in visited:
+            visited.add(ref.idnum)
+            yield from iter_image_xobjects(obj.get("/Resources"), visited)
+
+
+def _hash_value(value, digest, memo):
+    """Feed a stable representation of a PDF value into digest"""
+    if isinstance(value, IndirectObject):
+        target = value.get_object()
+        if isinstance(target, StreamObject):
+            # Follow streams (e.g. /SMask) by content, not by object number
+            digest.update(image_key(target, memo).encode())
+        else:
+            _hash_value(target, digest, memo)
+    elif isinstance(value, DictionaryObject):
+        digest.update(b"<<")
+        for k in sorted(value.keys()):
+            if k == "/Length":
+                continue
+            digest.update(k.encode())
+            _hash_value(value.raw_get(k), digest, memo)
+        digest.update(b">>")
+    elif isinstance(value, ArrayObject):
+        digest.update(b"[")
+        for item in value:
+            _hash_value(item, digest, memo)
+        digest.update(b"]")
+    else:
+        digest.update(repr(value).encode())
+
+
+def image_key(stream, memo=None):
+    """Content hash of an image stream: its encoded bytes plus its dictionary,
+    but for NON_PIXEL_KEYS"""
+    if memo is not None and id(stream) in memo:
+        return memo[id(stream)]
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(stream._data)
+    _hash_value(DictionaryObject((k, stream.raw_get(k)) for k in stream if k not in NON_PIXEL_KEYS), digest, memo)
+    key = digest.hexdigest()
+    if memo is not None:
+        memo[id(stream)] = key
+    return key
+
+
+def build_image_index(pages, rewire=True):
+    """Index the images of pages by content hash
+
+    Returns a dict {key: ImageEntry}. Identical streams stored as separate
+    objects become duplicates of the first reference seen, and with rewire
+    the resources naming a duplicate are pointed at that first reference.
+    """
+    index = {}
+    by_idnum = {}
+    memo = {}
+    for page_index, page in enumerate(pages):
+        for xobjects, name, ref in iter_image_xobjects(page.get("/Resources")):
+            entry = by_idnum.get(ref.idnum)
+            if entry is None:
+                key = image_key(ref.get_object(), memo)
+                entry = index.get(key)
+                if entry is None:
+                    entry = index[key] = ImageEntry(key, ref)
+                    entry.first_page = page_index
+                else:
+                    entry.duplicates.append(ref)
+                by_idnum[ref.idnum] = entry
+            if rewire and ref.idnum != entry.ref.idnum:
+                xobjects[NameObject(name)] = entry.ref
+            entry.uses += 1
+    return index
+
+
+IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+
+def _multiply(m, n):
+    """Concatenate PDF matrices: the result applies m first, then n"""
+    return (
+        m[0] * n[0] + m[1] * n[2],
+        m[0] * n[1] + m[1] * n[3],
+        m[2] * n[0] + m[3] * n[2],
+        m[2] * n[1] + m[3] * n[3],
+        m[4] * n[0] + m[5] * n[2] + n[4],
+        m[4] * n[1] + m[5] * n[3] + n[5],
+    )
+
+
+def _walk_placements(content, resources, ctm, pdf, sizes, stack):
+    """Record the size at which each image of a content stream is drawn"""
+    resources = resources.get_object() if resources is not None else None
+    xobjects = resources.get("/XObject") if isinstance(resources, DictionaryObject) else None
+    xobjects = xobjects.get_object() if xobjects is not None else {}
+    saved = []
+    for operands, operator in ContentStream(content, pdf).operations:
+        if operator == b"q":
+            saved.append(ctm)
+        elif operator == b"Q":
+            if saved:
+                ctm = saved.pop()
+        elif operator == b"cm" and len(operands) == 6:
+            ctm = _multiply(tuple(float(v) for v in operands), ctm)
+        elif operator == b"Do" and operands:
+            ref = xobjects.raw_get(operands[0]) if operands[0] in xobjects else None
+            if not isinstance(ref, IndirectObject):
+                continue
+            obj = ref.get_object()
+            subtype = obj.get("/Subtype")
+            if subtype == "/Image":
+                # Images are drawn into the unit square, so the CTM columns
+                # are the rendered width and height in default user space
+                width = math.hypot(ctm[0], ctm[1])
+                height = math.hypot(ctm[2], ctm[3])
+                old = sizes.get(ref.idnum, (0.0, 0.0))
+                sizes[ref.idnum] = (max(old[0], width), max(old[1], height))
+            elif subtype == "/Form" and ref.idnum not in stack:
+                matrix = tuple(float(v) for v in obj.get("/Matrix", IDENTITY))
+                _walk_placements(
+                    obj, obj.get("/Resources", resources), _multiply(matrix, ctm),
+                    pdf, sizes, stack | {ref.idnum},
+                )
+
+
+def measure_placements(pages, index):
+    """Set display_size on every entry of index from the pages' content streams
+
+    Only pages that reference images are parsed. Images that are never drawn
+    keep display_size None.
+    """
+    by_idnum = {entry.ref.idnum: entry for entry in index.values()}
+    sizes = {}
+    for page in pages:
+        resources = page.get("/Resources")
+        if not any(True for _ in iter_image_xobjects(resources)):
+            continue
+        content = page.get_contents()
+        if content is None:
+            continue
+        user_unit = float(page.get("/UserUnit", 1))
+        ctm = (user_unit, 0.0, 0.0, user_unit, 0.0, 0.0)
+        try:
+            _walk_placements(content, resources.get_object(), ctm, page.indirect_reference.pdf, sizes, frozenset())
+        except Exception as e:
+            log.warning(f"Could not measure image placements on a page: {e}")
+    for idnum, size in sizes.items():
+        if idnum in by_idnum:
+            by_idnum[idnum].display_size = size
+
+
+def target_size(width, height, display_size, dpi):
+    """Pixel size of a width x height image capped at dpi for display_size
+
+    Returns None when the image is already at or below the ceiling.
+    """
+    if not dpi or not display_size or min(display_size) <= 0:
+        return None
+    target_width = display_size[0] / 72 * dpi
+    target_height = display_size[1] / 72 * dpi
+    scale = max(target_width / width, target_height / height)
+    if scale >= 1:
+        return None
+    return (max(1, round(width * scale)), max(1, round(height * scale)))
+
+
+def downsample(img, size, box=None):
+    """Resample img to size, a target_size result
+
+    box is the region of img covering the whole image, for rasters decoded
+    at reduced size. Returns img unchanged when size is None.
+    """
+    if size is None or img.mode not in ("1", "L", "LA", "RGB", "RGBA", "CMYK"):
+        return img
+    # reducing_gap box-reduces by an integer factor first, then finishes
+    # with a bilinear pass: close to a full filter at a fraction of the cost
+    return img.resize(size, Image.BILINEAR, box=box, reducing_gap=REDUCING_GAP)
+
+
+def _replace_refs(value, mapping):
+    """Point every reference to a key of mapping at its value, in place"""
+    if isinstance(value, DictionaryObject):
+        items = [(k, value.raw_get(k)) for k in value.keys()]
+    elif isinstance(value, ArrayObject):
+        items = list(enumerate(value))
+    else:
+        return
+    for k, v in items:
+        if isinstance(v, IndirectObject):
+            if v.idnum in mapping:
+                value[k] = mapping[v.idnum]
+        else:
+            _replace_refs(v, mapping)
+
+
+def merge_duplicates(writer, index):
+    """Drop duplicate image streams, pointing all references at the canonical one"""
+    mapping = {}
+    for entry in index.values():
+        for ref in entry.duplicates:
+            mapping[ref.idnum] = entry.ref
+    if not mapping:
+        return 0
+    # Duplicates can also be referenced outside the page resources we walked
+    # (annotation appearances, other forms), so sweep the whole object table
+    for obj in writer._objects:
+        _replace_refs(obj, mapping)
+    for idnum in mapping:
+        writer._replace_object(idnum, NullObject())
+    return len(mapping)
+
+
+def decode_image(stream, reduction=None):
+    """Decode an image XObject into a PIL image
+
+    With reduction, from decode_reduction, the image comes out that many
+    times smaller (rounding up), without a full-size raster along the way,
+    and without the round trip through an image file pypdf makes.
+    """
+    if reduction is not None:
+        if _filters(stream) == ["/DCTDecode"]:
+            img = _decode_draft(stream, reduction[0])
+        else:
+            img = _decode_strips(stream, reduction)
+        if img is not None:
+            return img
+    _, _, img = _xobj_to_image(stream)
+    return img
+
+
+def _plain_mode(stream):
+    """Pillow mode of an 8-bit image whose samples are its pixels, or None
+
+    That rules out masks, /Decode arrays and the colour spaces decode_image
+    has to map, and CMYK with an /SMask, which decodes as RGBA.
+    """
+    if stream.get("/ImageMask") or "/Decode" in stream or stream.get("/BitsPerComponent") != 8:
+        return None
+    space = stream.get("/ColorSpace")
+    space = space.get_object() if space is not None else None
+    if isinstance(space, ArrayObject):
+        mode = {1: "L", 3: "RGB", 4: "CMYK"}.get(_color_components(stream)) if space[0] == "/ICCBased" else None
+    else:
+        mode = PLAIN_COLOR_SPACES.get(space)
+    if mode == "CMYK" and "/SMask" in stream:
+        return None
+    return mode
+
+
+def _predictor(stream, mode):
+    """The /Predictor of a Flate image that can be decoded in strips, or None"""
+    parms = stream.get("/DecodeParms")
+    parms = parms.get_object() if parms is not None else None
+    if isinstance(parms, ArrayObject):
+        parms = parms[0].get_object() if len(parms) == 1 else None
+    if not isinstance(parms, DictionaryObject):
+        return 1
+    predictor = parms.get("/Predictor", 1)
+    if predictor == 1:
+        return 1
+    if (10 <= predictor <= 15 and _png_prediction is not None and parms.get("/Colors", 1) == len(mode)
+            and parms.get("/BitsPerComponent", 8) == 8 and parms.get("/Columns", 1) == stream["/Width"]):
+        return predictor
+    return None
+
+
+def decode_reduction(stream, size):
+    """Factors (x, y) decode_image can shrink stream by on its way to size
+
+    JPEGs shrink by 2, 4 or 8 both ways, as far as size: libjpeg filters as
+    it scales. Plain 8-bit Flate images are box-reduced by any factors, up
+    to REDUCING_GAP times size, as downsample itself would. Returns FULL_SIZE
+    when size is None or too close, and None for images only pypdf decodes.
+    """
+    filters = _filters(stream)
+    mode = _plain_mode(stream)
+    if mode is None or filters not in (["/DCTDecode"], ["/FlateDecode"]):
+        return None
+    if filters == ["/DCTDecode"] and mode == "CMYK":
+        # Adobe CMYK JPEGs are stored inverted
+        return None
+    if filters == ["/FlateDecode"] and _predictor(stream, mode) is None:
+        return None
+    if size is None:
+        return FULL_SIZE
+    width, height = int(stream["/Width"]), int(stream["/Height"])
+    if filters == ["/DCTDecode"]:
+        scale = min(width // size[0], height // size[1])
+        return next(((s, s) for s in DRAFT_SCALES if s <= scale), FULL_SIZE)
+    return int(width / size[0] / REDUCING_GAP) or 1, int(height / size[1] / REDUCING_GAP) or 1
+
+
+def reduced_box(stream, reduction):
+    """The region of a raster decoded with reduction that covers the image, for downsample"""
+    if reduction is None:
+        return None
+    return (0, 0, int(stream["/Width"]) / reduction[0], int(stream["/Height"]) / reduction[1])
+
+
+def _decode_draft(stream, scale):
+    """A JPEG image XObject decoded at 1/scale size, or None"""
+    try:
+        img = Image.open(BytesIO(stream._data))
+        if img.mode != _plain_mode(stream) or img.size != (stream["/Width"], stream["/Height"]):
+            return None
+        # libjpeg scales while undoing the DCT, so the skipped detail is
+        # never computed. This asks for exactly 1/scale.
+        img.draft(img.mode, (img.width // scale, img.height // scale))
+        img.load()
+    except OSError:
+        return None
+    return img
+
+
+def _inflated(data, size, chunk=64 * 1024):
+    """Yield the inflated data in pieces of size bytes; the last may be shorter"""
+    inflate = zlib.decompressobj()
+    view = memoryview(data)
+    offset = 0
+    piece = bytearray()
+    while True:
+        if inflate.unconsumed_tail:
+            source = inflate.unconsumed_tail
+        elif offset < len(view):
+            source = view[offset:offset + chunk]
+            offset += chunk
+        else:
+            source = b""
+        out = inflate.decompress(source, size - len(piece))
+        if not out and not source:
+            break
+        piece += out
+        if len(piece) == size:
+            yield bytes(piece)
+            piece = bytearray()
+    if piece:
+        yield bytes(piece)
+
+
+def _decode_strips(stream, reduction):
+    """A Flate image XObject box-reduced by reduction, a strip at a time, or None
+
+    Strips are a multiple of the vertical factor high, so reducing them one
+    by one gives the same pixels as reducing the whole image.
+    """
+    mode = _plain_mode(stream)
+    predictor = _predictor(stream, mode)
+    factor_x, factor_y = reduction
+    width, height = int(stream["/Width"]), int(stream["/Height"])
+    row_bytes = width * len(mode)
+    # PNG predictors start each row with the predictor used for it
+    encoded_row = row_bytes + (predictor >= 10)
+    rows = max(1, STRIP_BYTES // encoded_row // factor_y) * factor_y
+    img = Image.new(mode, (-(-width // factor_x), -(-height // factor_y)))
+    previous = None
+    y = 0
+    try:
+        for data in _inflated(stream._data, rows * encoded_row):
+            count = min(len(data) // encoded_row, height - y)
+            data = data[:count * encoded_row]
+            if predictor >= 10 and count:
+                if previous is not None:
+                    # Rows are predicted from the one above: carry over the
+                    # last row of the previous strip, as a row with no prediction
+                    data = _png_prediction(b"\x00" + previous + data, width, encoded_row)[row_bytes:]
+                else:
+                    data = _png_prediction(data, width, encoded_row)
+                previous = data[-row_bytes:]
+            if count:
+                strip = Image.frombytes(mode, (width, count), data)
+                img.paste(strip.reduce((factor_x, factor_y)), (0, y // factor_y))
+            y += count
+            if y >= height:
+                break
+    except zlib.error:
+        return None
+    if y < height:
+        # Truncated data: leave it to the full decode to do what it can
+        return None
+    return img
+
+
+def _color_key_mask(stream):
+    """Whether stream is masked by colour ranges, which depend on its samples"""
+    mask = stream.get("/Mask")
+    mask = mask.get_object() if mask is not None else None
+    return isinstance(mask, ArrayObject)
+
+
+def encode_jpeg(stream, img, quality):
+    """Build a DCT-encoded replacement for stream from the PIL image img
+
+    Returns None when the image can't be stored as a JPEG without losing
+    information that isn't pixels (color-key masks, unusual modes).
+    """
+    if _color_key_mask(stream):
+        return None
+    if img.mode in ("RGBA", "LA"):
+        # Any alpha came from the /SMask or /Mask, which is kept as a separate stream
+        img = img.convert(img.mode[:-1])
+    if img.mode not in JPEG_COLOR_SPACES:
+        return None
+
+    buffer = BytesIO()
+    img.save(buffer, "JPEG", quality=quality)
+
+    new_stream = _image_stream(stream, img, buffer.getvalue(), JPEG_COLOR_SPACES[img.mode], 8, "/DCTDecode")
+    if img.mode == "CMYK":
+        # Pillow writes Adobe-style inverted CMYK JPEGs
+        new_stream[NameObject("/Decode")] = ArrayObject([NumberObject(v) for v in (1, 0) * 4])
+    return new_stream
+
+
+def encode_bilevel(stream, img, threshold):
+    """Build a 1-bit replacement for stream from the grayscale PIL image img
+
+    Gray levels up to threshold become black. The image is stored as CCITT
+    Group 4 or, when that is larger or Pillow can't write it, as 1-bit
+    Flate. Returns None when the original has a colour-key mask.
+    """
+    if _color_key_mask(stream):
+        return None
+    bw = img.point([0] * (threshold + 1) + [255] * (255 - threshold), "1")
+    flate = zlib.compress(bw.tobytes(), 9)
+    g4 = _encode_g4(bw)
+    if g4 is not None and len(g4) < len(flate):
+        new_stream = _image_stream(stream, bw, g4, "/DeviceGray", 1, "/CCITTFaxDecode")
+        new_stream[NameObject("/DecodeParms")] = DictionaryObject({
+            NameObject("/K"): NumberObject(-1),
+            NameObject("/Columns"): NumberObject(bw.width),
+            NameObject("/Rows"): NumberObject(bw.height),
+            NameObject("/BlackIs1"): BooleanObject(False),
+        })
+        return new_stream
+    return _image_stream(stream, bw, flate, "/DeviceGray", 1, "/FlateDecode")
+
+
+def _encode_g4(bw):
+    """CCITT Group 4 data of the mode "1" image bw, or None"""
+    # Fax coding calls 0 bits white, while Pillow stores white as 1 bits
+    buffer = BytesIO()
+    try:
+        ImageChops.invert(bw).save(buffer, "TIFF", compression="group4", strip_size=2**31 - 1)
+    except OSError:
+        # Pillow built without libtiff
+        return None
+    tiff = Image.open(buffer)
+    offsets, counts = tiff.tag_v2.get(273, ()), tiff.tag_v2.get(279, ())
+    if len(offsets) != 1:
+        # Pillow too old for strip_size: separately coded strips can't be joined
+        return None
+    return buffer.getvalue()[offsets[0]:offsets[0] + counts[0]]
+
+
+def _image_stream(stream, img, data, color_space, bits, filter_name):
+    """An image XObject of img's size holding data, with the kept entries of stream"""
+    new_stream = StreamObject()
+    new_stream.set_data(data)
+    new_stream[NameObject("/Type")] = NameObject("/XObject")
+    new_stream[NameObject("/Subtype")] = NameObject("/Image")
+    new_stream[NameObject("/Width")] = NumberObject(img.width)
+    new_stream[NameObject("/Height")] = NumberObject(img.height)
+    new_stream[NameObject("/ColorSpace")] = NameObject(color_space)
+    new_stream[NameObject("/BitsPerComponent")] = NumberObject(bits)
+    new_stream[NameObject("/Filter")] = NameObject(filter_name)
+    for key in KEPT_IMAGE_KEYS:
+        if key in stream:
+            new_stream[NameObject(key)] = stream.raw_get(key)
+    return new_stream
+
+
+def grayscale(img):
+    """img as a mode "L" image; any alpha is dropped"""
+    if img.mode == "L":
+        return img
+    if img.mode in ("RGBA", "LA"):
+        img = img.convert(img.mode[:-1])
+    return img.convert("L")
+
+
+def _filters(stream):
+    filters = stream.get("/Filter")
+    if filters is None:
+        return []
+    filters = filters.get_object()
+    return list(filters) if isinstance(filters, ArrayObject) else [filters]
+
+
+def _color_components(stream):
+    """Samples per pixel of an image, or None for colour spaces we don't size up"""
+    space = stream.get("/ColorSpace")
+    space = space.get_object() if space is not None else None
+    if isinstance(space, ArrayObject) and space:
+        name = space[0]
+        if name == "/Indexed":
+            return 1
+        if name == "/ICCBased":
+            return int(space[1].get_object().get("/N", 3))
+        return None
+    return {"/DeviceGray": 1, "/CalGray": 1, "/DeviceRGB": 3, "/CalRGB": 3, "/DeviceCMYK": 4}.get(space)
+
+
+def skip_reason(entry, dpi=None):
+    """Why the image of entry isn't worth decoding, or None if it is
+
+    Only looks at the image dictionary and the size of its encoded data:
+    tiny images, 1-bit masks and line art (which JPEG would smear) and
+    JPEGs that are already dense and wouldn't be downsampled are kept.
+    """
+    stream = entry.stream
+    size = len(stream._data)
+    width, height = int(stream.get("/Width", 0)), int(stream.get("/Height", 0))
+    pixels = width * height
+    if size < MIN_IMAGE_BYTES:
+        return "too_small"
+    if pixels < MIN_IMAGE_PIXELS:
+        return "too_few_pixels"
+    if stream.get("/ImageMask") or stream.get("/BitsPerComponent") == 1:
+        return "bilevel"
+
+    filters = _filters(stream)
+    resized = target_size(width, height, entry.display_size, dpi) is not None
+    if filters == ["/DCTDecode"] and not resized and size / pixels <= EFFICIENT_JPEG_BYTES_PER_PIXEL:
+        return "efficient_jpeg"
+
+    space = stream.get("/ColorSpace")
+    space = space.get_object() if space is not None else None
+    if isinstance(space, ArrayObject) and space and space[0] == "/Indexed" and int(space[2]) < 16:
+        return "line_art"
+    components = _color_components(stream)
+    if filters == ["/FlateDecode"] and components and size / (pixels * components) <= LINE_ART_BYTES_PER_SAMPLE:
+        return "line_art"
+    return None
+
+
+def resolve_display_sizes(pages, index, cache=None):
+    """Fill in display_size on the entries of index, measuring only once per cache"""
+    if cache is not None and cache.measured:
+        for entry in index.values():
+            entry.display_size = cache.display_sizes.get(entry.key)
+        return
+    measure_placements(pages, index)
+    if cache is not None:
+        cache.display_sizes.update((e.key, e.display_size) for e in index.values())
+        cache.measured = True
+
+
+def encode_entry(entry, quality, dpi=None, cache=None, instr=NULL_INSTRUMENTATION, min_savings=MIN_SAVINGS):
+    """Downsample and re-encode one unique image
+
+    The decoded image is classified first (see classify.classify_image):
+    black and white images are stored as 1-bit (see encode_bilevel),
+    colourless ones as single-channel JPEGs and the rest as JPEGs.
+
+    Returns (new_stream, downsampled, decision). new_stream is None when the
+    image is better left as it is: skip_reason ruled it out, it can't be
+    stored as a JPEG, or the trial encode didn't come out at least
+    min_savings (a fraction) smaller than the original. decision is
+    "encoded", "encoded_gray", "encoded_bilevel" or the reason the original
+    was kept.
+    """
+    stream = entry.stream
+    reason = skip_reason(entry, dpi)
+    if reason is not None:
+        instr.count("images_kept")
+        return None, False, reason
+    width, height = int(stream["/Width"]), int(stream["/Height"])
+    size = target_size(width, height, entry.display_size, dpi)
+    # Shrinking softens edges, which sways the classifier and its threshold,
+    # so images that may be black and white are classified at full size:
+    # single-channel ones straight away, colourless colour ones once found
+    reduction = decode_reduction(stream, size if _color_components(stream) != 1 else None)
+    img, kind, threshold = _decode_and_classify(entry, reduction, cache, instr)
+    if kind != COLOR and reduction not in (None, FULL_SIZE):
+        reduction = FULL_SIZE
+        img, kind, threshold = _decode_and_classify(entry, reduction, cache, instr)
+    box = reduced_box(stream, reduction)
+    if kind == BILEVEL:
+        bilevel_dpi = max(dpi * BILEVEL_DPI_FACTOR, BILEVEL_MIN_DPI) if dpi else None
+        with instr.stage("resample"):
+            resized = downsample(grayscale(img), target_size(width, height, entry.display_size, bilevel_dpi))
+        with instr.stage("encode"):
+            new_stream = encode_bilevel(stream, resized, threshold)
+    else:
+        with instr.stage("resample"):
+            resized = downsample(grayscale(img) if kind == GRAY else img, size, box)
+        with instr.stage("encode"):
+            new_stream = encode_jpeg(stream, resized, quality)
+    if new_stream is None:
+        decision = "unsupported"
+    elif len(new_stream._data) > len(stream._data) * (1 - min_savings):
+        new_stream = None
+        decision = "not_smaller"
+    else:
+        decision = {BILEVEL: "encoded_bilevel", GRAY: "encoded_gray"}.get(kind, "encoded")
+        if kind in (BILEVEL, GRAY):
+            instr.count("images_bilevel" if kind == BILEVEL else "images_grayscale")
+    instr.count("images_encoded" if new_stream is not None else "images_kept")
+    return new_stream, new_stream is not None and resized.size != (width, height), decision
+
+
+def _decode_and_classify(entry, reduction, cache, instr):
+    """The raster of entry decoded with reduction, with its kind and threshold"""
+    with instr.stage("decode"):
+        if cache is None or not cache.holds(entry, reduction):
+            instr.count("images_decoded")
+        img = cache.decode(entry, reduction) if cache is not None else decode_image(entry.stream, reduction)
+    with instr.stage("classify"):
+        kind, threshold = cache.classify(entry, img, reduction) if cache is not None else classify_image(img)
+    return img, kind, threshold
+
+
+def iter_reencode_images(writer, quality, dpi=None, cache=None, stats=None, instr=NULL_INSTRUMENTATION,
+                         min_savings=MIN_SAVINGS):
+    """Re-encode every unique image of writer once, one image per step
+
+    Yields (entry, bytes_in, bytes_out) after each unique image, in the
+    order of the pages that first use them. With dpi set, images drawn
+    denser than dpi are downsampled first. An ImageCache shared between
+    calls reuses decoded rasters and placements. When given, stats is
+    filled with the number of image placements seen, unique images, merged
+    duplicate streams, the bytes of image data before and after, and one
+    decision per unique image (see encode_entry); the unique image count
+    and original bytes are set before the first step. Stage timings and
+    counters go to instr.
+    """
+    with instr.stage("image_index"):
+        index = build_image_index(writer.pages)
+        merged = merge_duplicates(writer, index)
+    if dpi:
+        with instr.stage("placements"):
+            resolve_display_sizes(writer.pages, index, cache)
+
+    if stats is not None:
+        stats["unique_images"] = len(index)
+        stats["original_image_bytes"] = sum(len(e.stream._data) for e in index.values())
+
+    placements = 0
+    downsampled = 0
+    image_bytes = 0
+    decisions = []
+    for entry in index.values():
+        placements += entry.uses
+        bytes_in = len(entry.stream._data)
+        new_stream = None
+        try:
+            new_stream, resized, decision = encode_entry(entry, quality, dpi, cache, instr, min_savings)
+            downsampled += resized
+        except Exception as e:
+            log.warning(f"Skipping image {entry.ref.idnum}: {e}")
+            instr.count("images_failed")
+            decision = "failed"
+        if new_stream is not None:
+            writer._replace_object(entry.ref, new_stream)
+        bytes_out = len(entry.stream._data)
+        image_bytes += bytes_out
+        decisions.append({"object": entry.ref.idnum, "decision": decision,
+                          "bytes_in": bytes_in, "bytes_out": bytes_out})
+        yield entry, bytes_in, bytes_out
+
+    log.info(f"Re-encoded {len(index)} unique images for {placements} placements, merged {merged} duplicates, downsampled {downsampled}")
+    instr.count("images", placements)
+    instr.count("unique_images", len(index))
+    instr.count("merged_images", merged)
+    instr.count("downsampled_images", downsampled)
+    if stats is not None:
+        stats.update({
+            "images": placements,
+            "unique_images": len(index),
+            "merged_images": merged,
+            "downsampled_images": downsampled,
+            "image_bytes": image_bytes,
+            "decisions": decisions,
+        })
+
+
+def summarize_decisions(decisions):
+    """Count per-image decisions: {"encoded": 3, "efficient_jpeg": 1, ...}"""
+    counts = {}
+    for item in decisions:
+        counts[item["decision"]] = counts.get(item["decision"], 0) + 1
+    return counts
+
+
+def reencode_images(writer, quality, dpi=None, cache=None, min_savings=MIN_SAVINGS):
+    """Re-encode every unique image of writer once, at the given JPEG quality
+
+    Returns the stats dictionary described in iter_reencode_images.
+    """
+    stats = {}
+    for _ in iter_reencode_images(writer, quality, dpi, cache, stats, min_savings=min_savings):
+        pass
+    return stats
@@ -0,0 +1,110 @@
+"""Timing, memory and counter instrumentation for the SovPDF engine.
+
+An Instrumentation collects wall time and a memory sample per pipeline
+stage plus free-form counters, and turns them into a JSON-ready report.
+Code that may or may not be instrumented takes NULL_INSTRUMENTATION as its
+default, so it never has to check.
+"""
+
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Pyodide and Windows
+    resource = None
+
+
+def default_memory_sampler():
+    """Peak memory in bytes: traced Python allocations if tracemalloc is on,
+    otherwise the process's max RSS where the OS reports it, else None"""
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1]
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return None
+
+
+class Instrumentation:
+    """Per-stage timers and memory samples plus counters for one run
+
+    Parameters:
+        trace_memory: bool - start tracemalloc for exact per-stage peaks
+            (slows Python code down noticeably)
+        memory_sampler: callable returning bytes or None, used instead of
+            the default sampler
+    """
+
+    def __init__(self, trace_memory=False, memory_sampler=None):
+        self.stages = {}  # name -> {"seconds", "calls", "peak_bytes"}
+        self.counters = {}
+        self.started = time.perf_counter()
+        self.memory_sampler = memory_sampler or default_memory_sampler
+        self._own_tracing = trace_memory and not tracemalloc.is_tracing()
+        if self._own_tracing:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        """Time the body as one call of stage name and sample memory after it"""
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            record = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "peak_bytes": None})
+            record["seconds"] += elapsed
+            record["calls"] += 1
+            peak = self.memory_sampler()
+            if peak is not None:
+                record["peak_bytes"] = max(record["peak_bytes"] or 0, peak)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """JSON-ready dictionary of everything recorded so far"""
+        peaks = [s["peak_bytes"] for s in self.stages.values() if s["peak_bytes"] is not None]
+        return {
+            "total_seconds": round(time.perf_counter() - self.started, 4),
+            "peak_bytes": max(peaks) if peaks else None,
+            "stages": [
+                {"name": name, "seconds": round(s["seconds"], 4), "calls": s["calls"], "peak_bytes": s["peak_bytes"]}
+                for name, s in self.stages.items()
+            ],
+            "counters": dict(self.counters),
+        }
+
+    def to_json(self, indent=None):
+        return json.dumps(self.report(), indent=indent)
+
+    def close(self):
+        """Stop tracemalloc if this instance started it"""
+        if self._own_tracing:
+            tracemalloc.stop()
+            self._own_tracing = False
+
+
+class NullInstrumentation:
+    """Instrumentation that records nothing"""
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def count(self, name, n=1):
+        pass
+
+    def report(self):
+        return None
+
+    def close(self):
+        pass
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
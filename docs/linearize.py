@@ -0,0 +1,588 @@
+"""Linearized ("fast web view") output for the SovPDF engine.
+
+write_linearized writes a PdfWriter in the layout of Annex F of the PDF
+specification, so a viewer that fetches the file with range requests can
+show the first page before the rest has arrived:
+
+- the linearization dictionary, then the cross-reference table of the
+  first page's section;
+- the catalog and what a viewer needs to open the document;
+- the hint stream: where each page starts and which shared objects it uses;
+- the first page and everything it uses;
+- every other page with the objects only it uses, then the objects several
+  pages share, then everything else;
+- the cross-reference table of all that.
+
+Objects are assigned to these parts the way qpdf does, so that
+`qpdf --check-linearization` accepts the output. No object streams are
+used: each object is written on its own and indexed by plain
+cross-reference tables, so the file is somewhat larger than
+optimize.write_compact's.
+
+check_linearization verifies the linearization dictionary, both
+cross-reference tables and the page offsets of the hint stream of a file.
+"""
+
+import re
+import zlib
+from collections import defaultdict
+from io import BytesIO
+
+from pypdf import PdfReader
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+from optimize import _serialize, _trailer_refs, write_compact
+
+# Catalog entries a viewer needs to open the document, before any page
+OPEN_DOCUMENT_KEYS = {"/ViewerPreferences", "/PageMode", "/Threads", "/OpenAction", "/AcroForm"}
+# Written by qpdf and Acrobat; readers ignore it, as no numerators are written
+SHARED_DENOMINATOR = 4
+# The linearization dictionary must start within this many bytes
+LINEARIZATION_WINDOW = 1024
+
+_LINEARIZATION = re.compile(rb"(\d+)\s+(\d+)\s+obj\s*<<(.*?)>>", re.S)
+_OBJECT = re.compile(rb"(\d+)\s+(\d+)\s+obj\b")
+_SUBSECTION = re.compile(rb"\s*(\d+)\s+(\d+)")
+_ENTRY = re.compile(rb"\s*(\d{10}) (\d{5}) ([nf])")
+
+
+def _bits(value):
+    """Bits needed to represent value"""
+    return value.bit_length()
+
+
+class _BitWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self.value = 0
+        self.count = 0
+
+    def write(self, value, bits):
+        for shift in range(bits - 1, -1, -1):
+            self.value = (self.value << 1) | ((value >> shift) & 1)
+            self.count += 1
+            if self.count == 8:
+                self.data.append(self.value)
+                self.value = self.count = 0
+
+    def flush(self):
+        """Pad to a byte boundary, as each column of a hint table is"""
+        if self.count:
+            self.write(0, 8 - self.count)
+
+
+class _BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, bits):
+        value = 0
+        for _ in range(bits):
+            byte = self.data[self.position >> 3]
+            value = (value << 1) | ((byte >> (7 - (self.position & 7))) & 1)
+            self.position += 1
+        return value
+
+    def skip_to_byte(self):
+        self.position = (self.position + 7) & ~7
+
+
+def _traverse(objects, owner, start, users, top=None):
+    """Record owner as a user of every object reachable from start
+
+    Other pages are not entered, nor is the /Parent of the page top; the
+    /Thumb of top is recorded as used by its thumbnail instead. Returns
+    the objects found, in depth-first order.
+    """
+    found = []
+    visited = set()
+    stack = [(start, owner)]
+    while stack:
+        value, user = stack.pop()
+        is_page = False
+        if isinstance(value, IndirectObject):
+            idnum = value.idnum
+            obj = objects.get(idnum)
+            if obj is None or idnum in visited:
+                continue
+            is_page = isinstance(obj, DictionaryObject) and obj.get("/Type") == "/Page"
+            if is_page and idnum != top:
+                continue
+            visited.add(idnum)
+            users[idnum].add(user)
+            found.append(idnum)
+            value = obj
+        if isinstance(value, DictionaryObject):
+            for key in reversed(list(value.keys())):
+                if is_page and key == "/Parent":
+                    continue
+                child = ("thumb", user[1]) if is_page and key == "/Thumb" else user
+                stack.append((value.raw_get(key), child))
+        elif isinstance(value, ArrayObject):
+            stack.extend((item, user) for item in reversed(value))
+    return found
+
+
+def plan_parts(objects, root, trailer, pages):
+    """Assign the objects of a document to the parts of a linearized file
+
+    objects maps object numbers to objects, root is the number of the
+    catalog, trailer maps trailer keys to object numbers and pages lists
+    the page object numbers in order. Returns a dictionary of lists of
+    object numbers in file order: "open_document", "first_page",
+    "outlines", "shared" and "other" for those parts, "pages" with one
+    list per page after the first (its page object first) and
+    "page_shared" with one list per page after the first of the objects it
+    uses that something else uses too.
+    """
+    users = defaultdict(set)
+    users[root].add(("root",))
+    catalog = objects[root]
+    open_order = []
+    outline_order = []
+    for key in catalog.keys():
+        found = _traverse(objects, ("root_key", key), catalog.raw_get(key), users)
+        if key in OPEN_DOCUMENT_KEYS:
+            open_order.extend(found)
+        elif key == "/Outlines":
+            # The outline dictionary comes first
+            outline_order = found
+    for key, idnum in trailer.items():
+        if key != "/Root":
+            found = _traverse(objects, ("trailer", key), IndirectObject(idnum, 0, None), users)
+            if key == "/Encrypt":
+                open_order.extend(found)
+    page_order = [_traverse(objects, ("page", index), IndirectObject(idnum, 0, None), users, top=idnum)
+                  for index, idnum in enumerate(pages)]
+
+    parts = {}
+    for idnum in objects:
+        in_open = in_outlines = in_first = is_root = False
+        other_pages = set()
+        thumbs = others = 0
+        for user in users.get(idnum, ()):
+            kind = user[0]
+            if kind == "root":
+                is_root = True
+            elif kind == "page":
+                if user[1] == 0:
+                    in_first = True
+                else:
+                    other_pages.add(user[1])
+            elif kind == "thumb":
+                thumbs += 1
+            elif kind == "root_key" and user[1] in OPEN_DOCUMENT_KEYS:
+                in_open = True
+            elif kind == "root_key" and user[1] == "/Outlines":
+                in_outlines = True
+            elif kind == "trailer" and user[1] == "/Encrypt":
+                in_open = True
+            else:
+                others += 1
+        if is_root:
+            parts[idnum] = "root"
+        elif in_outlines:
+            parts[idnum] = "outlines"
+        elif in_open:
+            parts[idnum] = "open"
+        elif in_first:
+            parts[idnum] = "first"
+        elif len(other_pages) == 1 and not others and not thumbs:
+            parts[idnum] = other_pages.pop()
+        elif len(other_pages) > 1:
+            parts[idnum] = "shared"
+        else:
+            parts[idnum] = "other"
+
+    def unique(idnums):
+        return list(dict.fromkeys(idnums))
+
+    open_document = [root] + unique(idnum for idnum in open_order if parts[idnum] == "open")
+    # The page object comes first, then what only the first page uses
+    first = page_order[0]
+    first_page = unique([pages[0]] + [idnum for idnum in first if users[idnum] == {("page", 0)}] +
+                        [idnum for idnum in first if parts[idnum] == "first"])
+    outlines = [idnum for idnum in outline_order if parts[idnum] == "outlines"]
+    page_sections = [unique([pages[index]] + [idnum for idnum in page_order[index] if parts[idnum] == index])
+                     for index in range(1, len(pages))]
+    shared = unique(idnum for found in page_order[1:] for idnum in found if parts[idnum] == "shared")
+    placed = set(open_document) | set(first_page) | set(outlines) | set(shared)
+    placed.update(idnum for section in page_sections for idnum in section)
+    return {
+        "open_document": open_document,
+        "first_page": first_page,
+        "outlines": outlines,
+        "pages": page_sections,
+        "shared": shared,
+        "other": [idnum for idnum in objects if idnum not in placed],
+        "page_shared": [[idnum for idnum in found if len(users[idnum]) > 1] for found in page_order[1:]],
+    }
+
+
+def _write_value(value, out, numbers):
+    """Serialize value into out, renumbering references with numbers"""
+    if isinstance(value, IndirectObject):
+        number = numbers.get(value.idnum)
+        out.write(b"%d 0 R" % number if number is not None else b"null")
+    elif isinstance(value, DictionaryObject):
+        out.write(b"<<")
+        for key in value.keys():
+            if isinstance(value, StreamObject) and key == "/Length":
+                continue
+            out.write(b" ")
+            key.write_to_stream(out)
+            out.write(b" ")
+            _write_value(value.raw_get(key), out, numbers)
+        if isinstance(value, StreamObject):
+            out.write(b" /Length %d" % len(value._data))
+        out.write(b" >>")
+    elif isinstance(value, ArrayObject):
+        out.write(b"[")
+        for index, item in enumerate(value):
+            if index:
+                out.write(b" ")
+            _write_value(item, out, numbers)
+        out.write(b"]")
+    else:
+        value.write_to_stream(out)
+
+
+def _object_parts(number, obj, numbers):
+    """The bytes of object number obj, as a list of parts (stream data is not copied)"""
+    if isinstance(obj, StreamObject) and not obj._data and getattr(obj, "_operations", None):
+        obj.get_data()  # a ContentStream rebuilds its data from its operations
+    out = BytesIO()
+    out.write(b"%d 0 obj\n" % number)
+    _write_value(obj, out, numbers)
+    if isinstance(obj, StreamObject):
+        out.write(b"\nstream\n")
+        return [out.getvalue(), obj._data, b"\nendstream\nendobj\n"]
+    out.write(b"\nendobj\n")
+    return [out.getvalue()]
+
+
+def _hint_stream(page_lengths, page_objects, page_shared, group_lengths, first_page_groups,
+                 first_page_offset, first_shared, first_shared_offset, outlines):
+    """The data of the hint stream and the offsets of its shared object and outline tables
+
+    Offsets are taken as if the hint stream were not in the file, as
+    Annex F prescribes.
+    """
+    out = _BitWriter()
+    # Page offset hint table (Table F.3 and F.4)
+    min_objects = min(page_objects)
+    min_length = min(page_lengths)
+    most_shared = max(len(ids) for ids in page_shared)
+    largest_id = max((max(ids) for ids in page_shared if ids), default=0)
+    objects_bits = _bits(max(page_objects) - min_objects)
+    length_bits = _bits(max(page_lengths) - min_length)
+    shared_bits = _bits(most_shared)
+    id_bits = _bits(largest_id)
+    for value, bits in ((min_objects, 32), (first_page_offset, 32), (objects_bits, 16),
+                        (min_length, 32), (length_bits, 16),
+                        # Content stream offsets and lengths, as Acrobat writes them
+                        (0, 32), (0, 16), (min_length, 32), (length_bits, 16),
+                        (shared_bits, 16), (id_bits, 16), (0, 16), (SHARED_DENOMINATOR, 16)):
+        out.write(value, bits)
+    for values, base, bits in ((page_objects, min_objects, objects_bits),
+                               (page_lengths, min_length, length_bits),
+                               ([len(ids) for ids in page_shared], 0, shared_bits)):
+        for value in values:
+            out.write(value - base, bits)
+        out.flush()
+    for ids in page_shared:
+        for value in ids:
+            out.write(value, id_bits)
+    out.flush()
+    # No numerators, content offsets are all zero and content lengths repeat the page lengths
+    for value in page_lengths:
+        out.write(value - min_length, length_bits)
+    out.flush()
+
+    # Shared object hint table (Table F.5 and F.6), one object per group
+    shared_offset = len(out.data)
+    min_group = min(group_lengths)
+    group_bits = _bits(max(group_lengths) - min_group)
+    for value, bits in ((first_shared, 32), (first_shared_offset, 32), (first_page_groups, 32),
+                        (len(group_lengths), 32), (0, 16), (min_group, 32), (group_bits, 16)):
+        out.write(value, bits)
+    for value in group_lengths:
+        out.write(value - min_group, group_bits)
+    out.flush()
+    for _ in group_lengths:
+        out.write(0, 1)  # no signature
+    out.flush()
+
+    outline_offset = None
+    if outlines is not None:
+        # Generic hint table (Table F.7)
+        outline_offset = len(out.data)
+        for value in outlines:
+            out.write(value, 32)
+    return bytes(out.data), shared_offset, outline_offset
+
+
+def write_linearized(writer, stream):
+    """Write writer to stream as a linearized PDF
+
+    Encrypted writers are written by write_compact instead, as their
+    objects can't be renumbered.
+    """
+    if getattr(writer, "_encryption", None):
+        write_compact(writer, stream)
+        return
+    if hasattr(writer, "_resolve_links"):
+        writer._resolve_links()
+
+    objects = {idnum: obj for idnum, obj in enumerate(writer._objects, start=1) if obj is not None}
+    refs = _trailer_refs(writer)
+    trailer = {key: ref.idnum for key, ref in refs.items()}
+    pages = [page.indirect_reference.idnum for page in writer.pages]
+    root = trailer["/Root"]
+    parts = plan_parts(objects, root, trailer, pages)
+    open_document, first_page, outlines = parts["open_document"], parts["first_page"], parts["outlines"]
+    page_sections, shared, other = parts["pages"], parts["shared"], parts["other"]
+    # Outlines belong with the first page if the viewer opens them with it
+    outlines_first = objects[root].get("/PageMode") == "/UseOutlines" and bool(outlines)
+    if outlines_first:
+        first_section = first_page + outlines
+    else:
+        first_section = first_page
+        other = outlines + other
+
+    # The first page's section is numbered after everything else, so the
+    # main cross-reference table starts at object 0
+    rest = [idnum for section in page_sections for idnum in section] + shared + other
+    numbers = {idnum: number for number, idnum in enumerate(rest, start=1)}
+    rest_count = len(rest) + 1
+    linearization_number = rest_count
+    for number, idnum in enumerate(open_document, start=linearization_number + 1):
+        numbers[idnum] = number
+    hint_number = linearization_number + 1 + len(open_document)
+    for number, idnum in enumerate(first_section, start=hint_number + 1):
+        numbers[idnum] = number
+    size = hint_number + 1 + len(first_section)
+
+    chunks = {idnum: _object_parts(numbers[idnum], objects[idnum], numbers) for idnum in objects}
+    lengths = {idnum: sum(len(part) for part in chunks[idnum]) for idnum in objects}
+
+    header = max(writer.pdf_header.decode() if isinstance(writer.pdf_header, bytes) else writer.pdf_header,
+                 "%PDF-1.4").encode() + b"\n%\xE2\xE3\xCF\xD3\n"
+    id_array = getattr(writer, "_ID", None)
+    trailer_refs = b"/Root %d 0 R " % numbers[root]
+    if "/Info" in trailer and trailer["/Info"] in numbers:
+        trailer_refs += b"/Info %d 0 R " % numbers[trailer["/Info"]]
+    id_entry = b"/ID " + _serialize(id_array) + b" " if id_array else b""
+
+    def linearization(length, hint_offset, hint_length, first_page_end, main_first_entry):
+        # Fixed-width values, so the dictionary's length doesn't depend on them
+        return (b"%d 0 obj\n<< /Linearized 1 /L %-10d /H [ %-10d %-10d ] /O %d /E %-10d /N %d /T %-10d >>\nendobj\n"
+                % (linearization_number, length, hint_offset, hint_length, numbers[pages[0]],
+                   first_page_end, len(pages), main_first_entry))
+
+    def first_xref(main_offset):
+        entries = b"".join(b"%010d 00000 n \n" % offset for offset in first_offsets)
+        return (b"xref\n%d %d\n" % (linearization_number, size - linearization_number) + entries +
+                b"trailer\n<< /Size %d %s%s/Prev %-10d >>\nstartxref\n0\n%%%%EOF\n"
+                % (size, trailer_refs, id_entry, main_offset))
+
+    # Lay out everything but the hint stream, whose tables count offsets as if it were absent
+    first_offsets = [0] * (size - linearization_number)
+    start = len(header) + len(linearization(0, 0, 0, 0, 0)) + len(first_xref(0))
+    position = start
+    offsets = {}
+    for idnum in open_document:
+        offsets[idnum] = position
+        position += lengths[idnum]
+    hint_offset = position
+    for idnum in first_section + rest:
+        offsets[idnum] = position
+        position += lengths[idnum]
+
+    page_objects = [len(first_section)] + [len(section) for section in page_sections]
+    page_lengths = [sum(lengths[idnum] for idnum in first_section)]
+    page_lengths += [sum(lengths[idnum] for idnum in section) for section in page_sections]
+    groups = first_section + shared
+    group_index = {idnum: index for index, idnum in enumerate(groups)}
+    # The first page's shared objects are part of its section
+    page_shared = [[]] + [sorted(group_index[idnum] for idnum in used if idnum in group_index)
+                          for used in parts["page_shared"]]
+    outline_hints = None
+    if outlines_first:
+        outline_hints = (numbers[outlines[0]], offsets[outlines[0]], len(outlines),
+                         sum(lengths[idnum] for idnum in outlines))
+    hint_data, shared_offset, outline_offset = _hint_stream(
+        page_lengths, page_objects, page_shared, [lengths[idnum] for idnum in groups], len(first_section),
+        offsets[pages[0]], numbers[shared[0]] if shared else 0, offsets[shared[0]] if shared else 0,
+        outline_hints)
+    hint_data = zlib.compress(hint_data, 9)
+    hint_dict = b"/Filter /FlateDecode /S %d " % shared_offset
+    if outline_offset is not None:
+        hint_dict += b"/O %d " % outline_offset
+    hint = (b"%d 0 obj\n<< %s/Length %d >>\nstream\n" % (hint_number, hint_dict, len(hint_data)) +
+            hint_data + b"\nendstream\nendobj\n")
+
+    # Now shift everything after the hint stream by its length
+    for idnum in first_section + rest:
+        offsets[idnum] += len(hint)
+    first_page_end = offsets[first_section[-1]] + lengths[first_section[-1]]
+    main_offset = position + len(hint)
+    main_entries = b"".join(b"%010d 00000 n \n" % offsets[idnum] for idnum in rest)
+    main_head = b"xref\n0 %d" % rest_count
+    main_xref = (main_head + b"\n0000000000 65535 f \n" + main_entries +
+                 b"trailer\n<< /Size %d %s>>\nstartxref\n%d\n%%%%EOF\n"
+                 % (rest_count, id_entry, len(header) + len(linearization(0, 0, 0, 0, 0))))
+    length = main_offset + len(main_xref)
+
+    first_offsets = [len(header)] + [offsets[idnum] for idnum in open_document] + [hint_offset]
+    first_offsets += [offsets[idnum] for idnum in first_section]
+    stream.write(header)
+    stream.write(linearization(length, hint_offset, len(hint), first_page_end, main_offset + len(main_head)))
+    stream.write(first_xref(main_offset))
+    for idnum in open_document:
+        stream.writelines(chunks.pop(idnum))
+    stream.write(hint)
+    for idnum in first_section + rest:
+        stream.writelines(chunks.pop(idnum))
+    stream.write(main_xref)
+
+
+def _parse_xref(data, offset):
+    """(entries, first entry, trailer) of the cross-reference table at offset
+
+    entries maps object numbers to offsets (None for free entries) and
+    first entry is the offset of the white-space before the first entry.
+    """
+    if data[offset:offset + 4] != b"xref":
+        raise ValueError(f"no cross-reference table at offset {offset}")
+    position = offset + 4
+    entries = {}
+    first_entry = None
+    while True:
+        match = _SUBSECTION.match(data, position)
+        if match is None:
+            break
+        start, count = int(match.group(1)), int(match.group(2))
+        position = match.end()
+        if first_entry is None:
+            first_entry = position
+        for number in range(start, start + count):
+            entry = _ENTRY.match(data, position)
+            if entry is None:
+                raise ValueError(f"bad cross-reference entry for object {number}")
+            entries[number] = int(entry.group(1)) if entry.group(3) == b"n" else None
+            position = entry.end()
+    trailer = data.find(b"trailer", position)
+    end = data.find(b"startxref", trailer)
+    return entries, first_entry, data[trailer:end]
+
+
+def _trailer_value(trailer, key):
+    match = re.search(rb"/" + key + rb"\s+(\d+)", trailer)
+    return int(match.group(1)) if match else None
+
+
+def check_linearization(data):
+    """Problems with the linearization of the PDF in data, a list of strings
+
+    Checks that the linearization dictionary comes first and that its
+    file length, hint stream, first page, first page end, page count and
+    main cross-reference offset are right; that both cross-reference
+    tables point at their objects; and that the page offset hint table
+    locates every page. An empty list means the file is linearized.
+    """
+    data = bytes(data)
+    problems = []
+    if not data.startswith(b"%PDF-"):
+        return ["not a PDF file"]
+    match = _LINEARIZATION.search(data, 0, LINEARIZATION_WINDOW)
+    first_object = _OBJECT.search(data, 0, LINEARIZATION_WINDOW)
+    if match is None or b"/Linearized" not in match.group(3) or first_object.start() != match.start():
+        return ["no linearization dictionary at the start of the file"]
+    params = {}
+    for key in (b"L", b"O", b"E", b"N", b"T"):
+        value = re.search(rb"/" + key + rb"\s+(\d+)", match.group(3))
+        if value is None:
+            problems.append(f"linearization dictionary has no /{key.decode()}")
+        else:
+            params[key.decode()] = int(value.group(1))
+    hint = re.search(rb"/H\s*\[\s*(\d+)\s+(\d+)", match.group(3))
+    if hint is None:
+        problems.append("linearization dictionary has no /H")
+    if problems:
+        return problems
+    hint_offset, hint_length = int(hint.group(1)), int(hint.group(2))
+    if params["L"] != len(data):
+        problems.append(f"/L is {params['L']}, the file is {len(data)} bytes")
+
+    # The first-page table follows the linearization dictionary; startxref points at it
+    end = data.find(b"endobj", match.end()) + len(b"endobj")
+    first_xref = data.find(b"xref", end)
+    startxref = re.match(rb"startxref\s+(\d+)", data[data.rfind(b"startxref"):])
+    if data[end:first_xref].strip() or startxref is None or int(startxref.group(1)) != first_xref:
+        problems.append("the last startxref doesn't point at the first-page cross-reference table")
+    try:
+        first_entries, _, first_trailer = _parse_xref(data, first_xref)
+        main_offset = _trailer_value(first_trailer, b"Prev")
+        main_entries, main_first_entry, main_trailer = _parse_xref(data, main_offset or 0)
+    except ValueError as e:
+        return problems + [str(e)]
+    if main_first_entry != params["T"]:
+        problems.append(f"/T is {params['T']}, the main cross-reference table's first entry is at {main_first_entry}")
+    if min(first_entries) != len(main_entries) or _trailer_value(main_trailer, b"Size") != len(main_entries):
+        problems.append("the main cross-reference table doesn't end where the first-page table starts")
+    if _trailer_value(first_trailer, b"Size") != len(main_entries) + len(first_entries):
+        problems.append("the first-page trailer's /Size doesn't count every object")
+    offsets = {}
+    for number, offset in {**main_entries, **first_entries}.items():
+        if offset is None:
+            continue
+        found = _OBJECT.match(data, offset)
+        if found is None or int(found.group(1)) != number:
+            problems.append(f"the cross-reference entry of object {number} doesn't point at it")
+        offsets[number] = offset
+    if problems:
+        return problems
+
+    # Each object ends where the next one in the file starts
+    ordered = sorted(offsets.values())
+    next_offset = dict(zip(ordered, ordered[1:] + [main_offset]))
+    reader = PdfReader(BytesIO(data))
+    pages = [page.indirect_reference.idnum for page in reader.pages]
+    if params["N"] != len(pages):
+        problems.append(f"/N is {params['N']}, the document has {len(pages)} pages")
+    if params["O"] != pages[0]:
+        problems.append(f"/O is {params['O']}, the first page is object {pages[0]}")
+    if params["O"] not in first_entries:
+        problems.append("the first page isn't in the first-page cross-reference table")
+    first_page_end = max(next_offset[offsets[number]] for number in first_entries)
+    if params["E"] != first_page_end:
+        problems.append(f"/E is {params['E']}, the first page's section ends at {first_page_end}")
+    if hint_offset not in next_offset or next_offset[hint_offset] - hint_offset != hint_length:
+        problems.append("/H doesn't span the hint stream object")
+        return problems
+
+    # The page offset hint table, with offsets as if the hint stream were absent
+    hint_number = int(_OBJECT.match(data, hint_offset).group(1))
+    hints = reader.get_object(hint_number).get_data()
+    bits = _BitReader(hints)
+    min_objects, first_page, objects_bits, min_length, length_bits = (
+        bits.read(32), bits.read(32), bits.read(16), bits.read(32), bits.read(16))
+
+    def actual(offset):
+        return offset + hint_length if offset >= hint_offset else offset
+
+    if len(hints) < 36:
+        return problems + ["the page offset hint table is truncated"]
+    bits.position = 36 * 8
+    for _ in pages:
+        bits.read(objects_bits)
+    bits.skip_to_byte()
+    position = actual(first_page)
+    for index, number in enumerate(pages):
+        if offsets.get(number) != position:
+            problems.append(f"the hint table puts page {index + 1} at {position}, it is at {offsets.get(number)}")
+            break
+        position += min_length + bits.read(length_bits)
+    return problems
@@ -1,20 +1,67 @@
+import io
 import os
-import base64
-from pypdf import PdfReader, PdfWriter
+import html
+import json
+import time
+import asyncio
+import js
 from pyscript import when, display, document, fetch, window, ffi
+from instrument import Instrumentation
+from zipstream import ZipLayout, crc32
+# The engine modules need pypdf and Pillow, which are installed and imported
+# by load_engine once a file is selected, so the UI doesn't wait for them
 
 # Add console object for debugging
 console = window.console
 
 # Global variables
 selected_preset = "medium"  # Changed from "normal" to "medium"
-current_pdf = None
-current_pdf_size = 0
-processed_files = {}  # Store processed files for download
-is_processing = False  # Flag to prevent multiple simultaneous processing
-temp_files = []  # Track temporary files for cleanup
-current_pdf_compressed_files = []  # Track compressed files for the current PDF
-current_button = None  # Track the currently clicked button
+loaded_pdfs = []  # Selected or dropped PDFs: dicts of id, name, size, file (a JS File) and digest
+processed_files = {}  # Object URLs of compressed outputs, by output filename
+jobs = {}  # Compression jobs by output filename, in the order they were first queued
+job_counter = 0  # Sequence number of the last queued job
+batch_jobs = []  # Jobs queued since the queue was last empty, for the summary notification
+local_busy = False  # Whether this worker is running a job
+busy_workers = set()  # Indexes of the job workers running a job
+current_analysis = None  # Parsed reader and decoded images of one loaded PDF, shared by its presets
+current_analysis_id = None  # id of the loaded PDF current_analysis belongs to
+current_cancel = None  # CancelToken of the job running on this worker
+run_reports = []  # Instrumentation reports of the compressions of the loaded PDFs
+zip_url = None  # Object URL of the last "download all" archive
+report_export_url = None  # Object URL of the last exported report
+result_cache = None  # ResultCache of compressed outputs, kept in IndexedDB across sessions
+engine_task = None  # Task of load_engine, started by ensure_engine
+startup_timing = {}  # Milliseconds from navigation until the UI and the engine were ready
+
+# Names of the preset buttons, the keys of engine.PRESETS
+PRESET_NAMES = ("medium", "small", "tiny")
+
+# Compressed outputs kept in the result cache, least recently used evicted first
+RESULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Files above STREAMING_THRESHOLD_MB are compressed in streaming mode, page
+# window by page window within STREAMING_MEMORY_BUDGET; MAX_FILE_MB is the
+# largest file accepted at all
+STREAMING_THRESHOLD_MB = 100
+STREAMING_MEMORY_BUDGET = 192 * 1024 * 1024
+MAX_FILE_MB = 1024
+
+# Job workers run whole jobs next to this worker, one per spare CPU core
+# up to MAX_JOB_WORKERS, as each one holds its own Python and document
+MAX_JOB_WORKERS = 4
+
+# The engine uses pypdf internals, so it runs on the release it is tested
+# with (see also PYPI_PACKAGES in sw.js)
+PYPDF_VERSION = "6.20.1"
+
+# PyScript config of the job and shard workers (see register_worker_pool)
+SHARD_WORKER_CONFIG = {
+    "packages": ["pillow", "numpy", "fonttools", f"pypdf=={PYPDF_VERSION}"],
+    "files": {f"./{name}": f"./{name}" for name in (
+        "engine.py", "images.py", "classify.py", "content.py", "fonts.py", "pdfio.py", "instrument.py",
+        "optimize.py", "shard.py", "linearize.py", "strip.py",
+    )},
+}
 
 # Cache frequently accessed DOM elements
 DOM_ELEMENTS = {}
@@ -34,58 +81,33 @@ def highlight_selected_button(button_id):
     # Add active class to selected button
     get_element(f"#{button_id}").classList.add("is-active")
 
-def set_button_loading(button_id, is_loading=True):
-    """Set the loading state of a button"""
-    button = get_element(f"#{button_id}")
-    if is_loading:
-        button.classList.add("is-loading")
-    else:
-        button.classList.remove("is-loading")
-
-# Clean up temporary files
-def cleanup_files(event=None, keep_current=False):
-    global temp_files
-    console.log(f"Cleaning up {len(temp_files)} temporary files")
-    
-    files_to_keep = current_pdf_compressed_files if keep_current else []
-    
-    for file_path in temp_files:
-        try:
-            if os.path.exists(file_path) and file_path not in files_to_keep:
-                os.remove(file_path)
-                console.log(f"Removed temporary file: {file_path}")
-        except Exception as e:
-            console.error(f"Error removing file {file_path}: {str(e)}")
-    
-    # Update the list to only contain files we kept
-    if keep_current:
-        temp_files = files_to_keep.copy()
-    else:
-        temp_files = []
-        # Also clear the current PDF compressed files list
-        current_pdf_compressed_files.clear()
+# Release the memory held for the loaded PDFs and their outputs
+def cleanup_files(event=None):
+    global zip_url
+    console.log("Releasing loaded PDFs and compressed outputs")
 
-def reduce_quality(reader, quality=90):
-    console.log(f"Reducing quality with setting: {quality}")
-    writer = PdfWriter()
-    for page in reader.pages:
-        writer.add_page(page)
+    # Queued jobs are dropped; one running here stops at its next step,
+    # and those on job workers finish without a row to show them
+    if current_cancel is not None:
+        current_cancel.cancel()
+    jobs.clear()
+    batch_jobs.clear()
+    loaded_pdfs.clear()
+    release_analysis()
 
-    for page in writer.pages:
-        for img in page.images:
-            img.replace(img.image, quality=quality)
-    
-    writer.add_metadata(reader.metadata)
-    console.log("Quality reduction complete")
-    return writer
-
-def compress_lossless(writer, level=3):
-    console.log(f"Compressing with level: {level}")
-    for page in writer.pages:
-        page.compress_content_streams(level=level)  # This is CPU intensive!
+    # Release the compressed outputs held by object URLs
+    revoke_downloads()
+    if zip_url:
+        js.URL.revokeObjectURL(zip_url)
+        zip_url = None
+    clear_reports()
 
-    console.log("Compression complete")
-    return writer
+# Revoke the object URLs of every prepared download
+def revoke_downloads():
+    for download in processed_files.values():
+        js.URL.revokeObjectURL(download['url'])
+    console.log(f"Revoked {len(processed_files)} download URLs")
+    processed_files.clear()
 
 # Function to safely handle filenames with special characters
 def safe_filename(filename):
@@ -96,31 +118,31 @@ def safe_filename(filename):
     return filename
 
 # Function to prepare a file for download
-def prepare_file_for_download(filepath):
+def prepare_file_for_download(blob, filename):
+    """Hand a compressed PDF Blob to the browser as an object URL
+
+    Nothing is base64 encoded or re-read from disk, and only the short
+    object URL crosses to the page.
+
+    Args:
+        blob: JavaScript Blob holding the compressed PDF (see output_blob)
+        filename: str - name to save the file under
+    """
     try:
-        with open(filepath, "rb") as f:
-            content = f.read()
-            
-        # Convert to base64 for easier handling
-        b64content = base64.b64encode(content).decode('utf-8')
-        
-        # Generate a unique ID for this download
-        download_id = f"download_{len(processed_files)}"
-        
-        # Register the download with JavaScript - using a single global download function
-        js_code = f"""
-        if (!window.sovPdfDownload) {{
-            window.sovPdfDownload = function(data, filename) {{
+        # Register the download function with JavaScript - using a single global download function
+        js_code = """
+        if (!window.sovPdfDownload) {
+            window.sovPdfDownload = function(url, filename) {
                 const link = document.createElement('a');
-                link.href = data;
+                link.href = url;
                 link.download = filename;
                 document.body.appendChild(link);
                 link.click();
-                setTimeout(function() {{
+                setTimeout(function() {
                     document.body.removeChild(link);
-                }}, 100);
-            }};
-        }}
+                }, 100);
+            };
+        }
         """
         
         # Execute the JavaScript code only once
@@ -130,174 +152,819 @@ def prepare_file_for_download(filepath):
             document.head.appendChild(script)
             window.sovPdfDownloadRegistered = True
         
-        # Store the base64 data for download
-        processed_files[download_id] = {
-            'filename': os.path.basename(filepath),
-            'data': f"data:application/pdf;base64,{b64content}"
+        # A re-run of the same preset replaces its previous download
+        if filename in processed_files:
+            js.URL.revokeObjectURL(processed_files[filename]['url'])
+        
+        processed_files[filename] = {
+            'filename': filename,
+            'url': js.URL.createObjectURL(blob)
         }
         
-        return download_id
+        return filename
     except Exception as e:
         console.error(f"Error preparing file for download: {str(e)}")
         return None
 
-async def process_pdf(filename, preset):
-    """Process the PDF with the selected preset"""
-    global is_processing, temp_files, current_pdf_compressed_files, current_button
+# Function to turn a compressed output buffer into a Blob
+def output_blob(output):
+    """Copy a BytesIO or BlobSink holding a compressed PDF into a Blob
+
+    The Blob is built in this worker; blob: URLs made from it are usable
+    from the page on the same origin.
+    """
+    if isinstance(output, BlobSink):
+        return output.to_blob("application/pdf")
+    data = ffi.to_js(output.getbuffer())
+    return js.Blob.new(ffi.to_js([data]), ffi.to_js({"type": "application/pdf"}))
+
+# Function to get the cached analysis of a loaded PDF, parsing it on first use
+def get_analysis(pdf, data, instr=None):
+    """Return the DocumentAnalysis of pdf (content in data), reusing it across presets
+
+    Only the analysis of the last PDF compressed here is kept. The parse
+    time is recorded in instr when this call does the parsing.
+    """
+    global current_analysis, current_analysis_id
+    if current_analysis_id != pdf["id"]:
+        release_analysis()
+        current_analysis = DocumentAnalysis(data, instr)
+        current_analysis_id = pdf["id"]
+    return current_analysis
+
+def release_analysis():
+    """Drop the cached analysis so its reader and rasters can be freed"""
+    global current_analysis, current_analysis_id
+    if current_analysis is not None:
+        current_analysis.close()
+        current_analysis = None
+        current_analysis_id = None
+
+# Function to read a loaded PDF into memory
+async def read_pdf(pdf):
+    """Return the content of pdf as a memoryview, which the engine reads in place"""
+    tmp = window.URL.createObjectURL(pdf["file"])
+    try:
+        return await fetch(tmp).arrayBuffer()
+    finally:
+        window.URL.revokeObjectURL(tmp)
+
+def preset_display_name(preset, target_mb=None):
+    if preset == "target":
+        return f"Under {target_mb:g} MB"
+    return preset.capitalize()
+
+def output_filename(name, preset, target_mb=None):
+    """Name of the compressed output of the PDF name with preset"""
+    base_name = safe_filename(os.path.splitext(os.path.basename(name))[0])
+    if preset == "target":
+        return f"{base_name}-{target_mb:g}mb.pdf"
+    return f"{base_name}-{preset}.pdf"
+
+# Function to queue a preset, or a target size, for every loaded PDF
+def queue_jobs(preset, target_mb=None):
+    """Add a job per loaded PDF and start as many as the pool allows
+
+    With preset "target", target_mb is the size in MB the outputs must fit
+    in. An output already queued or running is not queued again; a
+    finished one is replaced. Returns the number of jobs queued.
+    """
+    global job_counter
+    if not any(job["status"] in ("queued", "running") for job in jobs.values()):
+        batch_jobs.clear()
+    queued = 0
+    for pdf in loaded_pdfs:
+        filename = output_filename(pdf["name"], preset, target_mb)
+        previous = jobs.get(filename)
+        if previous is not None and previous["status"] in ("queued", "running"):
+            continue
+        job_counter += 1
+        job = {
+            "seq": job_counter,
+            "pdf": pdf,
+            "preset": preset,
+            "target_mb": target_mb,
+            "linearize": get_element("#linearizeMode").checked,
+            "filename": filename,
+            # A re-run keeps the row of the output it replaces
+            "row_id": previous["row_id"] if previous is not None else f"job-{job_counter}",
+            "status": "queued",
+            "worker": None,
+            "blob": None,
+            "stats": None,
+            "error": None,
+        }
+        jobs[filename] = job
+        batch_jobs.append(job)
+        render_job_row(job)
+        queued += 1
+    console.log(f"Queued {queued} {preset_display_name(preset, target_mb)} jobs")
+    if queued:
+        ensure_engine()
+        dispatch_jobs()
+    return queued
+
+def job_worker_count():
+    """Number of job workers to use besides this worker"""
+    # Sharded runs use the same workers for their page ranges
+    if get_element("#shardedMode").checked:
+        return 0
+    return max(0, min(MAX_JOB_WORKERS, int(window.navigator.hardwareConcurrency or 1) - 1))
+
+def needs_this_worker(job):
+    """Whether job can only run here: target sizes, streaming and sharded runs"""
+    return (job["preset"] == "target"
+            or job["pdf"]["size"] > STREAMING_THRESHOLD_MB * 1024 * 1024
+            or get_element("#shardedMode").checked)
+
+# Function to start queued jobs on the free slots of the pool
+def dispatch_jobs():
+    """Start queued jobs, smallest input first, while the pool has room
+
+    The pool is this worker, which shows the progress of what it runs,
+    plus up to job_worker_count() job workers. Small files go first so
+    their results are ready while larger ones are still running. Work is
+    spread by file: the presets of a PDF all run on the worker its first
+    one went to (its "home"), which keeps the PDF's analysis between them.
+    """
+    global local_busy
+    queued = sorted((job for job in jobs.values() if job["status"] == "queued"),
+                    key=lambda job: (job["pdf"]["size"], job["seq"]))
+    # Workers kept for the PDFs that have presets left to run there
+    homes = {job["pdf"]["home"] for job in queued if "home" in job["pdf"]}
+    for job in queued:
+        pdf = job["pdf"]
+        if needs_this_worker(job):
+            worker = None
+        elif "home" in pdf:
+            worker = pdf["home"]
+        else:
+            free = [index for index in range(job_worker_count()) if index not in busy_workers | homes]
+            if free:
+                worker = free[0]
+            elif None in homes:
+                continue
+            else:
+                worker = None
+        if worker is None:
+            if local_busy:
+                continue
+            local_busy = True
+        elif worker in busy_workers:
+            continue
+        else:
+            busy_workers.add(worker)
+        if not needs_this_worker(job) and "home" not in pdf:
+            pdf["home"] = worker
+            homes.add(worker)
+        job["status"] = "running"
+        job["worker"] = worker
+        render_job_row(job)
+        asyncio.ensure_future(run_job(job, worker))
+
+# Function to run one job of the queue
+async def run_job(job, worker=None):
+    """Compress the PDF of job here (worker None) or on job worker number worker
+
+    The result comes from the result cache when the same PDF was
+    compressed with the same settings before.
+    """
+    global local_busy
+    pdf = job["pdf"]
+    try:
+        engine = ensure_engine()
+        if not engine.done():
+            if worker is None:
+                show_progress()
+                get_element("#progressText").textContent = "Loading the compression engine..."
+            await engine
+
+        data = await read_pdf(pdf)
+        if pdf["digest"] is None:
+            pdf["digest"] = input_digest(data)
+        # Everything the output depends on, including how compress_here runs it
+        if job["preset"] == "target":
+            request = {"target": int(job["target_mb"] * 1024 * 1024)}
+        else:
+            request = {"preset": job["preset"], **PRESETS[job["preset"]]}
+            if pdf["size"] > STREAMING_THRESHOLD_MB * 1024 * 1024:
+                request["memory_budget"] = STREAMING_MEMORY_BUDGET
+            elif get_element("#shardedMode").checked:
+                request["sharded"] = True
+        if job["linearize"]:
+            request["linearize"] = True
+
+        cached = await cache_lookup(pdf["digest"], request)
+        if cached is not None:
+            blob, stats = cached
+            stats["cached"] = True
+            console.log(f"Using cached result for {job['filename']}")
+        else:
+            console.log(f"Processing {pdf['name']} with preset {preset_display_name(job['preset'], job['target_mb'])}")
+            if worker is None:
+                output, stats = await compress_here(job, data)
+            else:
+                output, stats = await compress_on_worker(job, data, worker)
+            data = None
+            stats["crc32"] = output_crc32(output)
+            blob = output_blob(output)
+            output.close()
+            await cache_store(pdf["digest"], request, blob, stats)
+            if jobs.get(job["filename"]) is job:
+                show_report(job["filename"], stats)
+
+        job["blob"] = blob
+        job["stats"] = stats
+        job["status"] = "done"
+        console.log(f"Compressed {job['filename']}: {stats['compressed_size'] / 1024:,.0f} kb ({stats['ratio']:.2%})")
+    except Exception as e:
+        if type(e).__name__ == "CompressionCancelled":
+            console.log(f"Compression of {job['filename']} cancelled")
+            job["status"] = "cancelled"
+        else:
+            console.error(f"Error processing {job['filename']}: {str(e)}")
+            job["status"] = "failed"
+            job["error"] = str(e)
+    finally:
+        if worker is None:
+            local_busy = False
+            hide_progress()
+        else:
+            busy_workers.discard(worker)
+        if not any(other["pdf"] is pdf and other["status"] in ("queued", "running") for other in jobs.values()):
+            pdf.pop("home", None)
+
+    # The app may have been cleared while the job ran
+    if jobs.get(job["filename"]) is job:
+        if job["status"] == "done":
+            prepare_file_for_download(job["blob"], job["filename"])
+        render_job_row(job)
+    dispatch_jobs()
+    if not any(job["status"] in ("queued", "running") for job in jobs.values()):
+        notify_batch_done()
+
+# Function to compress a job on this worker, with progress and cancel
+async def compress_here(job, data):
+    """Return (output, stats) of job, like engine.compress_to_buffer"""
+    pdf = job["pdf"]
+    # Time every stage of this run for the performance report
+    instr = Instrumentation(memory_sampler=wasm_heap_size)
+    large = pdf["size"] > STREAMING_THRESHOLD_MB * 1024 * 1024
+    if job["preset"] == "target":
+        if large:
+            raise ValueError(f"Target size mode is not available for files over {STREAMING_THRESHOLD_MB} MB")
+        console.log(f"Writing compressed file: {job['filename']}")
+        target_bytes = int(job["target_mb"] * 1024 * 1024)
+        output, stats = compress_to_target(data, target_bytes, get_analysis(pdf, data, instr), instr=instr,
+                                           linearize=job["linearize"])
+        console.log(f"Target search used quality={stats['quality']}, dpi={stats['dpi']} in {stats['full_passes']} full passes")
+        return output, stats
+
+    settings = PRESETS[job["preset"]]
+    console.log(f"Using quality={settings['quality']}, level={settings['level']}, dpi={settings['dpi']}")
+    if large:
+        if job["linearize"]:
+            console.log(f"Fast web view is not available for files over {STREAMING_THRESHOLD_MB} MB, writing {job['filename']} without it")
+        return await run_streaming_job(data, job["preset"], job["filename"], instr)
+    analysis = get_analysis(pdf, data, instr)
+    if get_element("#shardedMode").checked:
+        return await run_sharded_job(analysis, data, job["preset"], job["filename"], instr, job["linearize"])
+    return await run_compression_job(analysis, job["preset"], job["filename"], instr, job["linearize"])
+
+# Function to compress a job on one of the job workers
+async def compress_on_worker(job, data, worker):
+    """Return (output, stats) of job, compressed by job worker number worker
+
+    The worker keeps the analysis of the last PDF it compressed, for the
+    other presets of that PDF.
+    """
+    register_worker_pool()
+    result = await resolve(window.sovPdfRunJob(worker, ffi.to_js(data), job["preset"], job["linearize"],
+                                               job["pdf"]["id"]))
+    output = io.BytesIO(result[0].to_py())
+    return output, json.loads(result[1])
+
+def output_crc32(output):
+    """CRC-32 of a compressed output, for the ZIP archive of all outputs"""
+    if isinstance(output, BlobSink):
+        return output.crc32
+    return crc32(output.getbuffer())
+
+# Function to show the status of a job in its row of the results table
+def render_job_row(job):
+    row = document.getElementById(job["row_id"])
+    if row is None:
+        row = document.createElement("tr")
+        row.id = job["row_id"]
+        get_element("tbody").appendChild(row)
+
+    # Use consistent is-info tag for all compression information
+    tag_class = "is-info"
+    # Without a download URL there is nothing to save: count it as a failure
+    if job["status"] == "done" and job["filename"] not in processed_files:
+        job["status"] = "failed"
+        job["error"] = "The compressed file could not be prepared for download"
+        console.error(f"Error processing {job['filename']}: {job['error']}")
+    status = job["status"]
+    action = ""
+    if status == "done":
+        stats = job["stats"]
+        compressed_size = stats["compressed_size"] / 1024
+        compression_percent = (1 - stats["ratio"]) * 100
+        size = f"""
+            <span>{compressed_size:,.0f} kb</span>
+            <span class="tag {tag_class} is-light ml-2">{compression_percent:.1f}% smaller</span>
+        """
+        if stats.get("cached"):
+            size += '<span class="tag is-light ml-2">Cached</span>'
+        if stats.get("reached") is False:
+            size += '<span class="tag is-warning is-light ml-2">Target not reached</span>'
+        download_data = processed_files[job["filename"]]
+        action = f"""
+            <button class="button is-info" data-url="{download_data['url']}" data-filename="{html.escape(download_data['filename'])}" onclick="window.sovPdfDownload(this.dataset.url, this.dataset.filename)">
+                <span class="icon is-small">
+                    <i class="fa fa-download"></i>
+                </span>
+                <span>Save</span>
+            </button>
+        """
+    elif status == "running":
+        where = "here" if job["worker"] is None else f"on worker {job['worker'] + 1}"
+        size = f'<span class="tag is-warning is-light">Compressing {where}...</span>'
+    elif status == "queued":
+        size = '<span class="tag is-light">Queued</span>'
+    elif status == "cancelled":
+        size = '<span class="tag is-light">Cancelled</span>'
+    else:
+        size = f'<span class="tag is-danger is-light" title="{html.escape(job["error"] or "")}">Failed</span>'
+
+    row.innerHTML = f"""
+        <td>
+            <span>{html.escape(job['filename'])}</span>
+            <span class="tag {tag_class} is-light ml-2">{preset_display_name(job['preset'], job['target_mb'])}</span>
+        </td>
+        <td>{size}</td>
+        <td>{action}</td>
+    """
+
+    # Show the clear and download all buttons when we have results
+    get_element("#clearButton").classList.remove("is-hidden")
+    if any(job["status"] == "done" for job in jobs.values()):
+        get_element("#zipButton").classList.remove("is-hidden")
+
+# Function to tell the user how the jobs queued together went
+def notify_batch_done():
+    done = [job for job in batch_jobs if job["status"] == "done"]
+    failed = [job for job in batch_jobs if job["status"] == "failed"]
+    if len(batch_jobs) == 1 and failed:
+        show_notification(f"Error processing PDF: {html.escape(failed[0]['error'])}", "is-danger")
+    elif len(batch_jobs) == 1 and done:
+        job = done[0]
+        stats = job["stats"]
+        name = preset_display_name(job["preset"], job["target_mb"])
+        compression_percent = (1 - stats["ratio"]) * 100
+        if stats.get("reached") is False:
+            show_notification(f"Could not get below {job['target_mb']:g} MB, the smallest result is {stats['compressed_size'] / 1048576:,.1f} MB", "is-warning")
+        elif stats.get("cached"):
+            show_notification(f"Loaded the {name} result from cache. Saved {compression_percent:.1f}% of space", "is-info")
+        else:
+            show_notification(f"PDF compressed successfully with {name} preset! Saved {compression_percent:.1f}% of space", "is-info")
+    elif failed:
+        show_notification(f"Compressed {len(done)} files, {len(failed)} failed", "is-warning")
+    elif done:
+        original = sum(job["stats"]["original_size"] for job in done)
+        compressed = sum(job["stats"]["compressed_size"] for job in done)
+        show_notification(f"Compressed {len(done)} files, saving {(1 - compressed / original) * 100:.1f}% of space", "is-info")
+    batch_jobs.clear()
+
+# Run a preset as an incremental job, feeding the progress bar
+async def run_compression_job(analysis, preset, compressed_filename, instr, linearize=False):
+    """Compress a PDF step by step, yielding to the browser between steps
+
+    Returns (output, stats) like engine.compress_to_buffer. Raises
+    CompressionCancelled if the cancel button is pressed. With linearize,
+    the output is laid out for fast web view.
+    """
+    global current_cancel
+    start = time.perf_counter()
+    current_cancel = CancelToken()
+    job = analysis.job(preset, current_cancel, instr)
+    show_progress()
     
-    # Prevent multiple processing
-    if is_processing:
-        console.log("Already processing a PDF, please wait")
-        # Show user notification
-        show_notification("Please wait for the current processing to finish", "is-warning")
-        return False
-        
-    is_processing = True
-    button_id = f"{preset}Button"
-    current_button = button_id
+    # Updating the DOM from the worker is a round trip, so throttle it
+    last_update = 0
+    try:
+        for event in job.steps():
+            now = time.perf_counter()
+            if now - last_update > 0.1:
+                update_progress(event)
+                last_update = now
+            # Give the event loop a chance to deliver a cancel click
+            await sleep(0)
+    finally:
+        current_cancel = None
     
-    # Set button to loading state
-    set_button_loading(button_id, True)
+    get_element("#progressText").textContent = "Writing file..."
+    await sleep(0)
+    console.log(f"Writing compressed file: {compressed_filename}")
+    with instr.stage("write"):
+        output = write_to_buffer(job.writer, linearize)
+    hide_progress()
+    stats = make_stats(preset, analysis.size, buffer_size(output), start, instr)
+    stats["image_decisions"] = summarize_decisions(job.image_stats.get("decisions", []))
+    stats["stripped"] = dict(job.strip_stats)
+    if linearize:
+        stats["linearized"] = True
+    return output, stats
+
+# Run a preset in streaming mode, for files too large to hold twice
+async def run_streaming_job(data, preset, compressed_filename, instr):
+    """Compress the PDF in data window by window into Blob parts
+
+    Only the input and one window of pages are held in Python memory; the
+    output moves to JavaScript as it is written. Returns (output, stats)
+    with output a BlobSink. Raises CompressionCancelled like
+    run_compression_job.
+    """
+    global current_cancel
+    start = time.perf_counter()
+    # The streaming job keeps its own reader, dropping objects as it goes
+    release_analysis()
+    output = BlobSink()
+    current_cancel = CancelToken()
+    job = StreamingJob(data, PRESETS[preset], output, STREAMING_MEMORY_BUDGET, current_cancel, instr)
+    show_progress()
+    console.log(f"Streaming {compressed_filename} with a {STREAMING_MEMORY_BUDGET // 1048576} MB budget")
     
+    last_update = 0
     try:
-        # Get friendly name for display
-        preset_display_name = preset.capitalize()
-        console.log(f"Processing {filename} with preset {preset_display_name}")
-        
-        # Map presets to quality and level
-        presets = {
-            "medium": (90, 3),
-            "small": (75, 5),
-            "tiny": (50, 9)
-        }
+        for event in job.steps():
+            now = time.perf_counter()
+            if now - last_update > 0.1:
+                update_progress(event)
+                last_update = now
+            await sleep(0)
+    finally:
+        current_cancel = None
+        hide_progress()
+    stats = make_stats(preset, job.size, job.bytes_written, start, instr)
+    stats["windows"] = job.windows
+    return output, stats
 
-        quality, level = presets[preset]
-        console.log(f"Using quality={quality}, level={level}")
+# Write-only stream that moves what is written into JavaScript Blob parts
+class BlobSink(io.RawIOBase):
+    """Collects output in Blob parts of CHUNK_SIZE bytes, so it never piles up in Python memory"""
+    CHUNK_SIZE = 4 * 1024 * 1024
+    
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.buffer = bytearray()
+        self.position = 0
+        self.crc32 = 0
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self.buffer += data
+        self.crc32 = crc32(data, self.crc32)
+        self.position += len(data)
+        if len(self.buffer) >= self.CHUNK_SIZE:
+            self.flush_part()
+        return len(data)
+    
+    def tell(self):
+        return self.position
+    
+    def flush_part(self):
+        if self.buffer:
+            self.parts.append(js.Blob.new(ffi.to_js([ffi.to_js(memoryview(self.buffer))])))
+            self.buffer = bytearray()
+    
+    def to_blob(self, mime_type):
+        self.flush_part()
+        return js.Blob.new(ffi.to_js(self.parts), ffi.to_js({"type": mime_type}))
+    
+    def close(self):
+        self.flush_part()
+        super().close()
 
-        reader = PdfReader(filename)
-        console.log(f"PDF has {len(reader.pages)} pages")
-        writer = reduce_quality(reader, quality)
-        writer = compress_lossless(writer, level)
-        
-        # Create safe output filename with preset name
-        base_name = os.path.splitext(os.path.basename(filename))[0]
-        safe_base_name = safe_filename(base_name)
-        compressed_filename = f"{safe_base_name}-{preset}.pdf"
+# Run a preset on several shard workers at once, one page range each
+async def run_sharded_job(analysis, data, preset, compressed_filename, instr, linearize=False):
+    """Compress a PDF across one Web Worker per spare CPU core
+
+    Each worker compresses a range of pages and this worker merges the
+    results. Documents too small to be worth splitting run as a normal job.
+    Returns (output, stats) like engine.compress_to_buffer.
+    """
+    start = time.perf_counter()
+    # Leave one core for this worker, which merges the results
+    workers = max(1, int(window.navigator.hardwareConcurrency or 1) - 1)
+    with instr.stage("plan_shards"):
+        shards = plan_shards(page_costs(analysis.reader), workers)
+    if len(shards) == 1:
+        return await run_compression_job(analysis, preset, compressed_filename, instr, linearize)
+    
+    register_worker_pool()
+    show_progress()
+    # The shard workers can't be interrupted midway
+    get_element("#cancelButton").classList.add("is-hidden")
+    get_element("#progressText").textContent = f"Compressing on {len(shards)} workers..."
+    await sleep(0)
+    console.log(f"Compressing {len(analysis.reader.pages)} pages in {len(shards)} shards: {shards}")
+    try:
+        with instr.stage("shards"):
+            results = await resolve(window.sovPdfRunShards(
+                ffi.to_js(data), ffi.to_js(shards), json.dumps(PRESETS[preset]),
+            ))
+            parts = [result[0].to_py() for result in results]
         
+        get_element("#progressText").textContent = "Merging..."
+        await sleep(0)
+        writer = merge_shards(parts, analysis.reader.metadata, instr, PRESETS[preset])
         console.log(f"Writing compressed file: {compressed_filename}")
-        
-        with open(compressed_filename, "wb") as f:
-            writer.write(f)
-            
-        # Add file to cleanup list
-        temp_files.append(compressed_filename)
-        
-        # Also add to the current PDF compressed files list
-        if compressed_filename not in current_pdf_compressed_files:
-            current_pdf_compressed_files.append(compressed_filename)
-
-        compressed_size = os.path.getsize(compressed_filename) / 1024
-        original_size = current_pdf_size
-        compression_ratio = compressed_size / original_size
-        compression_percent = (1 - compression_ratio) * 100
-        
-        console.log(f"Compressed file size: {compressed_size:,.0f} kb")
-        console.log(f"Compression ratio: {compression_ratio:.2%}")
-        
-        # Prepare file for download - each file gets its own unique download ID
-        download_id = prepare_file_for_download(compressed_filename)
-        
-        # Add to results table with download button
-        table = get_element("tbody")
-        download_data = processed_files[download_id]
-        
-        # Use consistent is-info tag for all compression information
-        tag_class = "is-info"
-        
-        # Check if this preset already exists in the table
-        existing_row = None
-        for row in document.querySelectorAll("tbody tr"):
-            if row.querySelector("td:first-child span") and row.querySelector("td:first-child span").textContent == compressed_filename:
-                existing_row = row
-                break
-                
-        if existing_row:
-            # Update the existing row
-            existing_row.innerHTML = f"""
-                <td>
-                    <span>{compressed_filename}</span>
-                    <span class="tag {tag_class} is-light ml-2">{preset_display_name}</span>
-                </td>
-                <td>
-                    <span>{compressed_size:,.0f} kb</span>
-                    <span class="tag {tag_class} is-light ml-2">{compression_percent:.1f}% smaller</span>
-                </td>
-                <td>
-                    <button class="button is-info" onclick="window.sovPdfDownload('{download_data['data']}', '{download_data['filename']}')">
-                        <span class="icon is-small">
-                            <i class="fa fa-download"></i>
-                        </span>
-                        <span>Save</span>
-                    </button>
-                </td>
-            """
-        else:
-            # Add a new row
-            table.innerHTML += f"""<tr>
-                                <td>
-                                    <span>{compressed_filename}</span>
-                                    <span class="tag {tag_class} is-light ml-2">{preset_display_name}</span>
-                                </td>
-                                <td>
-                                    <span>{compressed_size:,.0f} kb</span>
-                                    <span class="tag {tag_class} is-light ml-2">{compression_percent:.1f}% smaller</span>
-                                </td>
-                                <td>
-                                    <button class="button is-info" onclick="window.sovPdfDownload('{download_data['data']}', '{download_data['filename']}')">
-                                        <span class="icon is-small">
-                                            <i class="fa fa-download"></i>
-                                        </span>
-                                        <span>Save</span>
-                                    </button>
-                                </td>
-                            </tr>"""
-        
-        console.log("UI updated with result")
-        
-        # Show the clear button when we have results in the table
-        get_element("#clearButton").classList.remove("is-hidden")
-        
-        # Show success notification with display name
-        show_notification(f"PDF compressed successfully with {preset_display_name} preset! Saved {compression_percent:.1f}% of space", "is-info")
-        
-        # Reset button loading state
-        set_button_loading(button_id, False)
-        
-        is_processing = False
-        current_button = None
-        return True
+        with instr.stage("write"):
+            output = write_to_buffer(writer, linearize)
+    finally:
+        get_element("#cancelButton").classList.remove("is-hidden")
+        hide_progress()
+    stats = make_stats(preset, analysis.size, buffer_size(output), start, instr)
+    stats.update(shard_stats([json.loads(result[1]) for result in results]))
+    stats["shards"] = len(shards)
+    if linearize:
+        stats["linearized"] = True
+    return output, stats
+
+# Register the page-side pool of job and shard workers, once
+def register_worker_pool():
+    if hasattr(window, "sovPdfRunShards"):
+        return
+    js_code = """
+    (function() {
+        const workers = [];
+        // Workers are started on first use and kept, as each one boots its own Python
+        async function worker(index) {
+            const { PyWorker } = await import('https://pyscript.net/releases/2025.3.1/core.js');
+            while (workers.length <= index) {
+                workers.push(PyWorker('./shard_worker.py', { type: 'pyodide', config: %s }));
+            }
+            return workers[index];
+        }
+        window.sovPdfRunShards = async function(data, shards, settings) {
+            const ready = await Promise.all(shards.map((shard, i) => worker(i)));
+            return Promise.all(shards.map(([start, stop], i) =>
+                ready[i].sync.compress_range(data, start, stop, settings)));
+        };
+        window.sovPdfRunJob = async function(index, data, preset, linearize, key) {
+            return (await worker(index)).sync.compress_document(data, preset, linearize, key);
+        };
+    })();
+    """ % json.dumps(SHARD_WORKER_CONFIG)
+    script = document.createElement('script')
+    script.textContent = js_code
+    document.head.appendChild(script)
+
+# Function to get the result cache, opening it on first use
+def get_result_cache():
+    global result_cache
+    if result_cache is None:
+        result_cache = ResultCache(IndexedDBStorage(), RESULT_CACHE_MAX_BYTES)
+    return result_cache
+
+# Function to look up an earlier result of request on a PDF
+async def cache_lookup(digest, request):
+    """Return (blob, stats) cached for request on the PDF with digest, or None
+
+    The cache only saves time: when IndexedDB is unavailable (e.g. some
+    private browsing modes) or fails, it is a miss.
+    """
+    try:
+        return await get_result_cache().get(cache_key(digest, request))
     except Exception as e:
-        handle_error(f"Error processing PDF: {str(e)}")
-        return False
+        console.warn(f"Result cache lookup failed: {str(e)}")
+        return None
+
+# Function to keep a compressed result for later runs of the same request
+async def cache_store(digest, request, blob, stats):
+    try:
+        await get_result_cache().put(cache_key(digest, request), blob, blob.size, stats)
+    except Exception as e:
+        console.warn(f"Could not cache the result: {str(e)}")
+
+def idb_request(request):
+    """Return a future resolved with the result of an IndexedDB request"""
+    future = asyncio.get_event_loop().create_future()
+    
+    def on_success(event):
+        if not future.done():
+            future.set_result(request.result)
+    
+    def on_error(event):
+        if not future.done():
+            future.set_exception(RuntimeError(f"IndexedDB error: {request.error}"))
+    
+    handlers = [ffi.create_proxy(on_success), ffi.create_proxy(on_error)]
+    request.onsuccess, request.onerror = handlers
+    future.add_done_callback(lambda _: [handler.destroy() for handler in handlers])
+    return future
+
+class IndexedDBStorage:
+    """Result cache storage in IndexedDB, implementing cache.CacheStorage
+
+    Outputs are kept as Blobs in the "results" store, so a hit is handed to
+    the page without copying the PDF through Python; their metadata, as
+    JSON, in the "meta" store, which is all eviction has to read.
+    """
+    
+    def __init__(self, name="sovpdf-results"):
+        self.name = name
+        self.db = None
+    
+    async def _store(self, name, mode="readonly"):
+        if self.db is None:
+            request = js.indexedDB.open(self.name, 1)
+            
+            def upgrade(event):
+                db = request.result
+                db.createObjectStore("results")
+                db.createObjectStore("meta")
+            
+            upgrade_handler = ffi.create_proxy(upgrade)
+            request.onupgradeneeded = upgrade_handler
+            try:
+                self.db = await idb_request(request)
+            finally:
+                upgrade_handler.destroy()
+        return self.db.transaction(name, mode).objectStore(name)
+    
+    async def get(self, key):
+        meta = await idb_request((await self._store("meta")).get(key))
+        if meta is None:
+            return None
+        blob = await idb_request((await self._store("results")).get(key))
+        if blob is None:
+            return None
+        return blob, json.loads(meta)
+    
+    async def put(self, key, data, meta):
+        await idb_request((await self._store("results", "readwrite")).put(data, key))
+        # The metadata goes last: a record without it doesn't exist yet
+        await self.touch(key, meta)
+    
+    async def touch(self, key, meta):
+        await idb_request((await self._store("meta", "readwrite")).put(json.dumps(meta), key))
+    
+    async def delete(self, key):
+        await idb_request((await self._store("meta", "readwrite")).delete(key))
+        await idb_request((await self._store("results", "readwrite")).delete(key))
+    
+    async def index(self):
+        store = await self._store("meta")
+        keys = await idb_request(store.getAllKeys())
+        values = await idb_request(store.getAll())
+        return {key: json.loads(value) for key, value in zip(keys, values)}
+
+# Values returned by page-side JavaScript may still be promises
+async def resolve(value):
+    if hasattr(value, "then"):
+        return await value
+    return value
+
+# Function to install pypdf and Pillow and import the engine modules
+async def load_engine():
+    """Load the packages the engine needs, then import its modules into this module
+
+    They come from the Pyodide CDN and PyPI (through the service worker
+    cache once the app has been used), not from the PyScript config, so
+    the UI is interactive before they are downloaded.
+    """
+    global PRESETS, CancelToken, CompressionCancelled, DocumentAnalysis, make_stats
+    global ResultCache, cache_key, input_digest, summarize_decisions, buffer_size, write_to_buffer
+    global merge_shards, page_costs, plan_shards, shard_stats, StreamingJob, compress_to_target, analyze_document
+    import pyodide_js
+    start = time.perf_counter()
+    await pyodide_js.loadPackage(ffi.to_js(["pillow", "numpy", "fonttools", "micropip"]))
+    import micropip
+    await micropip.install(f"pypdf=={PYPDF_VERSION}")
+    installed = time.perf_counter()
+    from engine import PRESETS, CancelToken, CompressionCancelled, DocumentAnalysis, make_stats
+    from analyze import analyze_document
+    from cache import ResultCache, cache_key, input_digest
+    from images import summarize_decisions
+    from pdfio import buffer_size, write_to_buffer
+    from shard import merge_shards, page_costs, plan_shards, shard_stats
+    from streaming import StreamingJob
+    from target import compress_to_target
+    startup_timing["engine_ready_ms"] = round(window.performance.now())
+    window.sovPdfStartup = json.dumps(startup_timing)
+    console.log(f"Engine loaded: packages in {installed - start:.2f} s, imports in {time.perf_counter() - installed:.2f} s")
+
+# Function to start loading the engine in the background, once
+def ensure_engine():
+    """Return the task loading the engine, starting it on the first call
+
+    Await it before using any engine module. A failed load is retried by
+    the next call.
+    """
+    global engine_task
+    if engine_task is None or (engine_task.done() and engine_task.exception() is not None):
+        engine_task = asyncio.ensure_future(load_engine())
+    return engine_task
+
+# Memory sampler for the instrumentation: the WebAssembly heap only grows,
+# so its size is the peak memory used so far
+def wasm_heap_size():
+    try:
+        import pyodide_js
+        return pyodide_js._module.HEAP8.length
+    except Exception:
+        return None
+
+# Performance report panel
+def show_report(compressed_filename, stats):
+    """Add the instrumentation report of a run to the report panel"""
+    report = stats.get("report")
+    if not report:
+        return
+    decisions = stats.get("image_decisions", {})
+    run_reports.append({"file": compressed_filename, "preset": stats["preset"], "image_decisions": decisions, **report})
+    
+    rows = ""
+    for stage in report["stages"]:
+        peak = f"{stage['peak_bytes'] / 1048576:,.1f} MB" if stage["peak_bytes"] else "-"
+        rows += f"<tr><td>{stage['name']}</td><td>{stage['calls']}</td><td>{stage['seconds']:.3f} s</td><td>{peak}</td></tr>"
+    counters = ", ".join(f"{name}: {value:,}" for name, value in report["counters"].items())
+    images = ", ".join(f"{name.replace('_', ' ')}: {count}" for name, count in decisions.items())
+    
+    get_element("#reportBody").innerHTML = f"""
+        <p class="is-size-7 mb-2"><strong>{html.escape(compressed_filename)}</strong> in {report['total_seconds']:.2f} s</p>
+        <table class="table is-narrow is-fullwidth is-size-7">
+            <thead><tr><th>Stage</th><th>Calls</th><th>Time</th><th>Peak memory</th></tr></thead>
+            <tbody>{rows}</tbody>
+        </table>
+        <p class="is-size-7 has-text-grey">{counters}</p>
+        <p class="is-size-7 has-text-grey">Images: {images or "none"}</p>
+    """
+    get_element("#reportPanel").classList.remove("is-hidden")
+
+def clear_reports():
+    global report_export_url
+    run_reports.clear()
+    if report_export_url:
+        js.URL.revokeObjectURL(report_export_url)
+        report_export_url = None
+    get_element("#reportBody").innerHTML = ""
+    get_element("#reportPanel").classList.add("is-hidden")
+
+# Event handler for the report export button
+@when("click", "#exportReportButton")
+def export_report_handler(event):
+    """Download every report of the current PDF as one JSON file"""
+    global report_export_url
+    if report_export_url:
+        js.URL.revokeObjectURL(report_export_url)
+    blob = js.Blob.new(ffi.to_js([json.dumps(run_reports, indent=2)]), ffi.to_js({"type": "application/json"}))
+    report_export_url = js.URL.createObjectURL(blob)
+    window.sovPdfDownload(report_export_url, "sovpdf-report.json")
+
+# Progress bar helpers
+def show_progress():
+    get_element("#progressBar").value = 0
+    get_element("#progressText").textContent = "Starting..."
+    get_element("#progressArea").classList.remove("is-hidden")
+
+def hide_progress():
+    get_element("#progressArea").classList.add("is-hidden")
+
+def update_progress(event):
+    """Show a progress event from the engine in the progress bar"""
+    get_element("#progressBar").value = round(event["fraction"] * 100)
+    if event["stage"] == "images":
+        text = f"Images {event['images_done']}"
+        if event["images_total"]:
+            text += f"/{event['images_total']}"
+    elif event["stage"] == "pages":
+        text = f"Page {event['pages_done']}/{event['pages_total']}"
+    else:
+        text = f"Content streams, page {event['pages_done']}/{event['pages_total']}"
+    text += f" · {event['bytes_in'] / 1048576:,.1f} MB → {event['bytes_out'] / 1048576:,.1f} MB"
+    if event["eta"] is not None:
+        text += f" · about {event['eta']:,.0f}s left"
+    get_element("#progressText").textContent = text
+
+# Event handler for the cancel button
+@when("click", "#cancelButton")
+def cancel_button_handler(event):
+    """Ask the running compression job to stop after its current step"""
+    if current_cancel is not None:
+        console.log("Cancelling compression")
+        current_cancel.cancel()
 
 # Helper function to allow UI updates
 async def sleep(ms):
     """Sleep for the specified number of milliseconds to allow UI updates"""
-    await ffi.sleep(ms / 1000)
-
-# Centralized error handling
-def handle_error(error_message):
-    """Centralized function for handling errors"""
-    console.error(error_message)
-    # Show error notification
-    show_notification(error_message, "is-danger")
-    # Reset button loading state if there's an active button
-    global current_button, is_processing
-    if current_button:
-        set_button_loading(current_button, False)
-        current_button = None
-    # Set processing flag to false to allow new operations
-    is_processing = False
+    await asyncio.sleep(ms / 1000)
 
 # Function to show notifications
 def show_notification(message, type="is-info"):
@@ -352,11 +1019,11 @@ async def preset_button_handler(event):
             
     preset = button_id.replace('Button', '').lower()
     
-    # Skip handling for the clearButton
-    if button_id == "clearButton":
+    # Skip handling for the buttons that have their own handlers
+    if button_id in ("clearButton", "compareButton", "targetButton", "cancelButton", "exportReportButton", "zipButton"):
         return
         
-    if preset not in ['medium', 'small', 'tiny']:  # Changed from 'normal' to 'medium'
+    if preset not in PRESET_NAMES:
         console.error(f"Unknown preset: {preset}")
         return
         
@@ -365,9 +1032,74 @@ async def preset_button_handler(event):
     console.log(f"{preset.capitalize()} preset selected")
     highlight_selected_button(button_id)
     
-    # Process the PDF if we have one loaded
-    if current_pdf:
-        await process_pdf(current_pdf, preset)
+    # Queue the loaded PDFs with this preset
+    if loaded_pdfs:
+        queue_jobs(preset)
+
+# Event handler for the compare button
+@when("click", "#compareButton")
+async def compare_button_handler(event):
+    """Queue every preset for the loaded PDFs; the presets of a PDF run on one worker and share one parse"""
+    if not loaded_pdfs:
+        show_notification("Please select a PDF file first", "is-warning")
+        return
+    console.log("Comparing all presets")
+    for preset in PRESET_NAMES:
+        queue_jobs(preset)
+
+# Event handler for the target size button
+@when("click", "#targetButton")
+async def target_button_handler(event):
+    """Queue the loaded PDFs to fit the size typed in the target field"""
+    if not loaded_pdfs:
+        show_notification("Please select a PDF file first", "is-warning")
+        return
+    try:
+        target_mb = float(get_element("#targetSize").value)
+    except ValueError:
+        target_mb = 0
+    if target_mb <= 0:
+        show_notification("Please enter a target size in MB", "is-warning")
+        return
+    queue_jobs("target", target_mb)
+
+# Event handler for the download all button
+@when("click", "#zipButton")
+async def zip_button_handler(event):
+    """Download every finished output as one ZIP archive
+
+    The archive is a Blob made of the ZIP headers and the output Blobs
+    themselves, so no output is copied or held in Python memory for it.
+    """
+    global zip_url
+    done = [job for job in jobs.values() if job["status"] == "done"]
+    if not done:
+        return
+    layout = ZipLayout()
+    parts = []
+    for job in done:
+        crc = job["stats"].get("crc32")
+        if crc is None:
+            # Results cached before outputs had their CRC-32 recorded
+            crc = await blob_crc32(job["blob"])
+            job["stats"]["crc32"] = crc
+        parts.append(ffi.to_js(memoryview(layout.add(job["filename"], int(job["blob"].size), crc))))
+        parts.append(job["blob"])
+    parts.append(ffi.to_js(memoryview(layout.finish())))
+    if zip_url:
+        js.URL.revokeObjectURL(zip_url)
+    blob = js.Blob.new(ffi.to_js(parts), ffi.to_js({"type": "application/zip"}))
+    zip_url = js.URL.createObjectURL(blob)
+    console.log(f"Archived {len(done)} outputs, {blob.size / 1048576:,.1f} MB")
+    window.sovPdfDownload(zip_url, "sovpdf.zip")
+
+async def blob_crc32(blob):
+    """CRC-32 of a Blob, read in BlobSink.CHUNK_SIZE slices"""
+    crc = 0
+    for offset in range(0, int(blob.size), BlobSink.CHUNK_SIZE):
+        chunk = await blob.slice(offset, offset + BlobSink.CHUNK_SIZE).arrayBuffer()
+        crc = crc32(chunk.to_py(), crc)
+    return crc
 
 @when("change", "#filePdf")
 async def file_change_handler(event):
@@ -380,11 +1112,12 @@ async def file_change_handler(event):
             console.log("No files selected")
             return
         
-        # We only process the first file, even if multiple were somehow selected
-        file = input.files.item(0)
-        
-        # Load the PDF file using the shared helper function
-        await load_pdf_file(file)
+        # Add every selected file using the shared helper function
+        for index in range(input.files.length):
+            await load_pdf_file(input.files.item(index))
+
+        # Let the same files be selected again later
+        input.value = ""
         
     except Exception as e:
         console.error(f"Error in file selection handler: {str(e)}")
@@ -393,9 +1126,7 @@ async def file_change_handler(event):
 # Function to reset the application state
 def reset_app():
     """Reset the application to a clean state"""
-    global current_pdf, current_pdf_size, processed_files
-    
-    # Clean up temporary files
+    # Release the loaded PDFs, the queue and the outputs
     cleanup_files()
     
     # Clear the results table
@@ -411,15 +1142,10 @@ def reset_app():
     if file_input:
         file_input.value = ""
     
-    # Hide the clear button
-    clear_btn = get_element("#clearButton")
-    if clear_btn:
-        clear_btn.classList.add("is-hidden")
-    
-    # Reset current PDF references
-    current_pdf = None
-    current_pdf_size = 0
-    
+    # Hide the clear and download all buttons
+    get_element("#clearButton").classList.add("is-hidden")
+    get_element("#zipButton").classList.add("is-hidden")
+
     show_notification("Application reset to clean state", "is-info")
 
 # Event handler for clear button
@@ -451,7 +1177,9 @@ def main():
     # Listen for the custom cleanup event
     document.addEventListener('py-cleanup', cleanup_files)
     
-    console.log("App initialized")
+    startup_timing["interactive_ms"] = round(window.performance.now())
+    window.sovPdfStartup = json.dumps(startup_timing)
+    console.log(f"App initialized, interactive after {startup_timing['interactive_ms']:,} ms")
     
     # Signal that the app is fully loaded by dispatching a custom event
     js_code = """
@@ -511,26 +1239,27 @@ def setup_drag_and_drop():
       
       const dt = e.dataTransfer;
       if (dt.files && dt.files.length > 0) {
-        const file = dt.files[0];
-        
-        // Check if it's a PDF
-        if (!file.name.toLowerCase().endsWith('.pdf')) {
+        // Keep the PDFs among the dropped files
+        const dataTransfer = new DataTransfer();
+        for (const file of dt.files) {
+          if (file.name.toLowerCase().endsWith('.pdf')) {
+            dataTransfer.items.add(file);
+          }
+        }
+
+        if (dataTransfer.files.length === 0) {
           console.error('Not a PDF file');
           // Show alert - we can't call Python functions directly from here
-          alert('Please drop a PDF file');
+          alert('Please drop PDF files');
           return;
         }
-        
-        console.log('JavaScript: PDF file dropped, processing directly');
-        
-        // Create a new FileList containing this file
-        const dataTransfer = new DataTransfer();
-        dataTransfer.items.add(file);
-        
-        // Set the file to the input element
+
+        console.log(`JavaScript: ${dataTransfer.files.length} PDF files dropped, processing directly`);
+
+        // Set the files to the input element
         const fileInput = document.getElementById('filePdf');
         fileInput.files = dataTransfer.files;
-        
+
         // Trigger change event on the file input element
         // Note: We need to create a new Event with the 'new' keyword
         fileInput.dispatchEvent(new Event('change'));
@@ -545,95 +1274,109 @@ def setup_drag_and_drop():
     
     console.log("Drag and drop functionality set up")
 
-# Process a dropped file directly (used as fallback)
-async def process_dropped_file(file):
-    """Process a dropped file directly if setting the file input fails"""
-    console.log("Using fallback file processing method")
-    await load_pdf_file(file)
+# Function to show what each preset would make of a loaded PDF
+async def analyze_pdf(pdf, row):
+    """Show the estimated size and time of every preset in the row of pdf
+
+    Only a few images are encoded for the estimates, so this takes well
+    under a second for typical files. Files that will be streamed are not
+    analyzed, as that would mean parsing them whole.
+    """
+    if pdf["size"] > STREAMING_THRESHOLD_MB * 1024 * 1024:
+        return
+    cell = row.querySelector("td:last-child")
+    cell.innerHTML = '<span class="has-text-grey-light">Estimating...</span>'
+    try:
+        await ensure_engine()
+        data = await read_pdf(pdf)
+        if pdf not in loaded_pdfs:
+            return
+        # A job running here is using the cached analysis, so don't replace it;
+        # otherwise the job that follows reuses this parse and the sampled images
+        analysis = DocumentAnalysis(data) if local_busy else get_analysis(pdf, data)
+        result = analyze_document(analysis, PRESET_NAMES)
+    except Exception as e:
+        console.warn(f"Could not analyze {pdf['name']}: {str(e)}")
+        cell.innerHTML = '<span class="has-text-grey-light">Selected file</span>'
+        return
+    console.log(f"Analyzed {pdf['name']} in {result['seconds']:.2f} s: {result['images']['unique']} images, "
+                f"{result['images']['bytes'] / 1024:,.0f} kb of images, {result['content_bytes'] / 1024:,.0f} kb of content")
+    tags = []
+    for preset, estimate in result["estimates"].items():
+        seconds = f"{estimate['seconds']:.0f} s" if estimate["seconds"] >= 1 else "under 1 s"
+        tags.append(f'<span class="tag is-light" title="Estimated before compressing">'
+                    f'{preset_display_name(preset)}: ~{estimate["bytes"] / 1024:,.0f} kb, {seconds}</span>')
+    cell.innerHTML = f'<div class="tags">{"".join(tags)}</div>'
 
 async def load_pdf_file(file):
     """
-    Process a PDF file - common functionality for both file input and drag-drop
-    
+    Add a PDF file to the loaded files - common functionality for both file input and drag-drop
+
+    The content is only read when a job runs, so many files can be queued
+    without holding them all in memory.
+
     Args:
         file: JavaScript File object
-        
+
     Returns:
         bool: True if successful, False otherwise
     """
     try:
-        global current_pdf, current_pdf_size
-        
-        # Check file size - limit to 100MB to prevent browser crashes
+        # Check file size - files above STREAMING_THRESHOLD_MB are streamed,
+        # but the input itself still has to fit in browser memory
         file_size_mb = file.size / (1024 * 1024)
-        if file_size_mb > 100:
+        if file_size_mb > MAX_FILE_MB:
             console.error(f"File too large: {file_size_mb:.1f}MB")
-            show_notification(f"File too large ({file_size_mb:.1f}MB). Please select a PDF smaller than 100MB.", "is-warning")
+            show_notification(f"File too large ({file_size_mb:.1f}MB). Please select a PDF smaller than {MAX_FILE_MB}MB.", "is-warning")
             return False
-            
-        # Clean up any existing files
-        cleanup_files()
-        
+
         # Get file name
         pdf = file.name
         console.log(f"Loading file: {pdf}")
-        
+
         # Validate file type
         if not pdf.lower().endswith('.pdf'):
             console.error("Not a PDF file")
             show_notification("Please select a PDF file", "is-warning")
             return False
-            
-        # Create a temporary URL
-        tmp = window.URL.createObjectURL(file)
-        console.log("URL created")
-        
-        # Fetch and save its content
-        console.log("Fetching file content...")
-        with open(pdf, "wb") as dest:
-            dest.write(await fetch(tmp).bytearray())
-        console.log("File saved locally")
-        
-        # Track this file for cleanup
-        temp_files.append(pdf)
-        
-        # Revoke the tmp URL
-        window.URL.revokeObjectURL(tmp)
-        
-        # Store current PDF filename and size
-        current_pdf = pdf
-        current_pdf_size = os.path.getsize(pdf) / 1024
-        
-        # Clear the results table
-        get_element("tbody").innerHTML = ""
-        
-        # Clear processed files dictionary
-        processed_files.clear()
-        
+
+        # The same file selected twice is loaded once
+        pdf_id = f"{pdf}:{int(file.size)}:{int(file.lastModified)}"
+        if any(loaded["id"] == pdf_id for loaded in loaded_pdfs):
+            console.log(f"{pdf} is already loaded")
+            return True
+        loaded_pdfs.append({"id": pdf_id, "name": pdf, "size": int(file.size), "file": file, "digest": None})
+
+        # Get the engine ready while the user picks a preset
+        ensure_engine()
+
         # Add the original PDF to the results table with a distinctive style
-        table = get_element("tbody")
-        
-        # Add original file as first row with a neutral style - using is-light
-        table.innerHTML = f"""<tr class="is-selected has-background-light">
+        row = document.createElement("tr")
+        row.className = "is-selected has-background-light"
+        row.innerHTML = f"""
                             <td>
-                                <span class="has-text-weight-bold">{pdf}</span>
+                                <span class="has-text-weight-bold">{html.escape(pdf)}</span>
                                 <span class="tag is-info is-light ml-2">Original</span>
                             </td>
                             <td>
-                                <span>{current_pdf_size:,.0f} kb</span>
+                                <span>{file.size / 1024:,.0f} kb</span>
                             </td>
                             <td>
                                 <span class="has-text-grey-light">Selected file</span>
                             </td>
-                        </tr>"""
-    
+                        """
+        get_element("tbody").appendChild(row)
+
+        # Estimate each preset's result while the user decides
+        asyncio.ensure_future(analyze_pdf(loaded_pdfs[-1], row))
+
         # Show the clear button since we have a file loaded
         get_element("#clearButton").classList.remove("is-hidden")
-        
-        console.log(f"Original file size: {current_pdf_size:,.0f} kb")
-        
+
+        console.log(f"Original file size: {file.size / 1024:,.0f} kb")
+
         return True
-        
+
     except Exception as e:
         console.error(f"Error loading PDF: {str(e)}")
         # Show error notification
@@ -0,0 +1,343 @@
+"""Object-level optimisation and compact output for the SovPDF engine.
+
+optimize_objects merges objects with identical content and drops objects
+nothing refers to; write_compact then stores every non-stream object in
+deflated object streams, indexed by a cross-reference stream (PDF 1.5).
+Both work in a constant number of linear passes over the object table, so
+they scale to documents with hundreds of thousands of objects.
+"""
+
+import hashlib
+import logging
+import zlib
+from io import BytesIO
+
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+from instrument import NULL_INSTRUMENTATION
+
+log = logging.getLogger("sovpdf")
+
+# Objects that must keep their own identity even when another one is identical:
+# the page tree (a page listed twice in /Kids is invalid), annotations (one
+# annotation object may only appear on one page), structure elements and
+# optional content groups (each is a layer of its own, however it is named)
+DISTINCT_TYPES = {"/Catalog", "/Pages", "/Page", "/Annot", "/StructTreeRoot", "/StructElem", "/OBJR", "/Sig", "/OCG"}
+# ... and so must dictionaries with any of these keys, as /Type is optional:
+# tree nodes (/Parent, /Kids), form fields (/FT) and objects tied to a page (/P)
+DISTINCT_KEYS = ("/Parent", "/Kids", "/FT", "/P")
+
+OBJECTS_PER_STREAM = 200
+
+
+def _iter_refs(value):
+    """Yield every IndirectObject directly inside value (not following them)"""
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, IndirectObject):
+            yield item
+        elif isinstance(item, DictionaryObject):
+            # Covers streams too: their dictionary is all that can hold references
+            stack.extend(item.raw_get(k) for k in item.keys())
+        elif isinstance(item, ArrayObject):
+            stack.extend(item)
+
+
+def replace_references(value, mapping):
+    """Point every reference to a key of mapping at its value, in place"""
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, DictionaryObject):
+            entries = [(k, item.raw_get(k)) for k in item.keys()]
+        elif isinstance(item, ArrayObject):
+            entries = list(enumerate(item))
+        else:
+            continue
+        for k, v in entries:
+            if isinstance(v, IndirectObject):
+                if v.idnum in mapping:
+                    item[k] = mapping[v.idnum]
+            else:
+                stack.append(v)
+
+
+def _resolve_merge(canonical, idnum):
+    """The object idnum ends up as: an object merged into one that merged in turn follows it"""
+    while idnum in canonical:
+        idnum = canonical[idnum]
+    return idnum
+
+
+def _hash_value(value, digest, canonical):
+    """Feed value into digest, naming references by their canonical object"""
+    if isinstance(value, IndirectObject):
+        digest.update(b"R%d" % _resolve_merge(canonical, value.idnum))
+    elif isinstance(value, DictionaryObject):
+        digest.update(b"<<")
+        for k in sorted(value.keys()):
+            if k == "/Length":
+                continue
+            digest.update(k.encode())
+            _hash_value(value.raw_get(k), digest, canonical)
+        digest.update(b">>")
+    elif isinstance(value, ArrayObject):
+        digest.update(b"[")
+        for item in value:
+            _hash_value(item, digest, canonical)
+        digest.update(b"]")
+    else:
+        digest.update(type(value).__name__.encode())
+        digest.update(repr(value).encode())
+
+
+def _object_key(obj, canonical):
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(obj, StreamObject):
+        digest.update(b"stream")
+        digest.update(obj._data)
+    _hash_value(obj, digest, canonical)
+    return digest.digest()
+
+
+def _mergeable(obj):
+    if isinstance(obj, DictionaryObject):
+        if obj.get("/Type") in DISTINCT_TYPES or any(key in obj for key in DISTINCT_KEYS):
+            return False
+        # An annotation that leaves out /Type
+        return not ("/Subtype" in obj and "/Rect" in obj)
+    return obj is not None
+
+
+def _annotation_ids(objects):
+    """Object numbers of the annotations (and /Annots arrays) pages list"""
+    ids = set()
+    for obj in objects:
+        if isinstance(obj, DictionaryObject) and "/Annots" in obj:
+            annotations = obj.raw_get("/Annots")
+            if isinstance(annotations, IndirectObject):
+                ids.add(annotations.idnum)
+                annotations = annotations.get_object()
+            if isinstance(annotations, ArrayObject):
+                ids.update(ref.idnum for ref in annotations if isinstance(ref, IndirectObject))
+    return ids
+
+
+def _trailer_refs(writer):
+    """{key: reference} of the objects the trailer points at"""
+    refs = {"/Root": writer.root_object.indirect_reference}
+    for key, name in (("/Info", "_info"), ("/Encrypt", "_encrypt_entry")):
+        obj = getattr(writer, name, None)
+        ref = obj if isinstance(obj, IndirectObject) else getattr(obj, "indirect_reference", None)
+        if ref is not None:
+            refs[key] = ref
+    return refs
+
+
+def merge_identical_objects(writer):
+    """Replace objects that are identical to an earlier one by references to it
+
+    Objects referring to merged objects can become identical in turn (two
+    font dictionaries whose descriptors were just merged), so their
+    referrers are rehashed until nothing changes. Every object is hashed a
+    bounded number of times. Returns the number of objects merged.
+    """
+    objects = writer._objects
+    # The trailer's objects, and annotations whatever their dictionary says
+    pinned = {ref.idnum for ref in _trailer_refs(writer).values()} | _annotation_ids(objects)
+    canonical = {}  # idnum -> idnum of the identical object it merges into
+    referrers = {}  # idnum -> idnums of the objects referring to it
+    for idnum, obj in enumerate(objects, start=1):
+        if obj is not None:
+            for ref in _iter_refs(obj):
+                referrers.setdefault(ref.idnum, []).append(idnum)
+
+    seen = {}  # content key -> idnum
+    keys = {}  # idnum -> content key
+    pending = [i for i, obj in enumerate(objects, start=1) if i not in pinned and _mergeable(obj)]
+    while pending:
+        merged_now = []
+        for idnum in pending:
+            if idnum in canonical:
+                continue
+            key = _object_key(objects[idnum - 1], canonical)
+            old = keys.get(idnum)
+            if old is not None and seen.get(old) == idnum:
+                del seen[old]
+            keys[idnum] = key
+            first = seen.setdefault(key, idnum)
+            if first != idnum:
+                canonical[idnum] = first
+                merged_now.append(idnum)
+        # Only objects pointing at something just merged can have changed
+        pending = sorted({
+            r for idnum in merged_now for r in referrers.get(idnum, ())
+            if r not in pinned and r not in canonical and _mergeable(objects[r - 1])
+        })
+
+    if canonical:
+        mapping = {idnum: IndirectObject(_resolve_merge(canonical, idnum), 0, writer) for idnum in canonical}
+        for obj in objects:
+            if obj is not None:
+                replace_references(obj, mapping)
+        for idnum in canonical:
+            objects[idnum - 1] = None
+    return len(canonical)
+
+
+def remove_orphans(writer):
+    """Drop every object that can't be reached from the trailer
+
+    Returns the number of objects removed.
+    """
+    objects = writer._objects
+    reachable = set()
+    stack = [ref.idnum for ref in _trailer_refs(writer).values()]
+    while stack:
+        idnum = stack.pop()
+        if idnum in reachable or not 0 < idnum <= len(objects):
+            continue
+        reachable.add(idnum)
+        obj = objects[idnum - 1]
+        if obj is not None:
+            stack.extend(ref.idnum for ref in _iter_refs(obj) if ref.idnum not in reachable)
+
+    removed = 0
+    for idnum, obj in enumerate(objects, start=1):
+        if obj is not None and idnum not in reachable:
+            objects[idnum - 1] = None
+            removed += 1
+    return removed
+
+
+def optimize_objects(writer, instr=NULL_INSTRUMENTATION):
+    """Merge identical objects, then drop unreachable ones
+
+    Returns {"merged_objects": n, "orphan_objects": n}.
+    """
+    with instr.stage("optimize"):
+        if hasattr(writer, "_resolve_links"):
+            writer._resolve_links()
+        merged = merge_identical_objects(writer)
+        orphans = remove_orphans(writer)
+    instr.count("merged_objects", merged)
+    instr.count("orphan_objects", orphans)
+    log.info(f"Merged {merged} identical objects, removed {orphans} unreachable objects")
+    return {"merged_objects": merged, "orphan_objects": orphans}
+
+
+def _serialize(obj):
+    buffer = BytesIO()
+    obj.write_to_stream(buffer)
+    return buffer.getvalue()
+
+
+def _field_width(value):
+    return max(1, (value.bit_length() + 7) // 8)
+
+
+class CompactWriter:
+    """Incremental writer of a PDF 1.5 file with object streams and a cross-reference stream
+
+    Objects are added one at a time, in any order, under their final
+    numbers, all below first_free. Streams (and objects with a nonzero
+    generation) are written at once; other objects are buffered and packed
+    OBJECTS_PER_STREAM at a time into deflated object streams, so at most
+    one object stream's worth of them is held in memory.
+    """
+
+    def __init__(self, stream, first_free, header="%PDF-1.5", level=6):
+        if isinstance(header, bytes):
+            header = header.decode()
+        self.stream = stream
+        self.base = stream.tell()
+        self.level = level
+        self.next_idnum = first_free  # numbers from here on are for object and xref streams
+        self.entries = {}  # idnum -> (type, field 2, field 3)
+        self.pending = []  # (idnum, serialized object) waiting for an object stream
+        stream.write(max(header, "%PDF-1.5").encode() + b"\n%\xE2\xE3\xCF\xD3\n")
+
+    def tell(self):
+        """Bytes written so far"""
+        return self.stream.tell() - self.base
+
+    def add(self, idnum, obj, generation=0):
+        if isinstance(obj, StreamObject) or generation:
+            self.entries[idnum] = (1, self.tell(), generation)
+            self.stream.write(b"%d %d obj\n" % (idnum, generation))
+            obj.write_to_stream(self.stream)
+            self.stream.write(b"\nendobj\n")
+        else:
+            self.pending.append((idnum, _serialize(obj)))
+            if len(self.pending) >= OBJECTS_PER_STREAM:
+                self.flush()
+
+    def flush(self):
+        """Write the buffered objects as one object stream"""
+        if not self.pending:
+            return
+        container = self.next_idnum
+        self.next_idnum += 1
+        offsets = []
+        position = 0
+        for index, (idnum, body) in enumerate(self.pending):
+            offsets.append(b"%d %d" % (idnum, position))
+            position += len(body) + 1
+            self.entries[idnum] = (2, container, index)
+        head = b" ".join(offsets) + b"\n"
+        data = zlib.compress(head + b"\n".join(body for _, body in self.pending), self.level)
+        self.entries[container] = (1, self.tell(), 0)
+        self.stream.write(b"%d 0 obj\n<< /Type /ObjStm /N %d /First %d /Filter /FlateDecode /Length %d >>\nstream\n"
+                          % (container, len(self.pending), len(head), len(data)))
+        self.stream.write(data)
+        self.stream.write(b"\nendstream\nendobj\n")
+        self.pending = []
+
+    def finish(self, root, info=None, id_array=None):
+        """Flush, then write the cross-reference stream and the file trailer"""
+        self.flush()
+        # The cross-reference stream indexes itself too
+        xref_idnum = self.next_idnum
+        xref_offset = self.tell()
+        self.entries[xref_idnum] = (1, xref_offset, 0)
+        size = xref_idnum + 1
+        rows = [self.entries.get(idnum, (0, 0, 0)) for idnum in range(size)]
+        rows[0] = (0, 0, 0xFFFF)
+        widths = (1, _field_width(max(r[1] for r in rows)), _field_width(max(r[2] for r in rows)))
+        data = zlib.compress(b"".join(
+            kind.to_bytes(widths[0], "big") + field2.to_bytes(widths[1], "big") + field3.to_bytes(widths[2], "big")
+            for kind, field2, field3 in rows
+        ), self.level)
+
+        trailer = b"/Root %d %d R " % (root.idnum, root.generation)
+        if info is not None:
+            trailer += b"/Info %d %d R " % (info.idnum, info.generation)
+        if id_array:
+            trailer += b"/ID " + _serialize(id_array) + b" "
+        self.stream.write(b"%d 0 obj\n<< /Type /XRef /Size %d /W [%d %d %d] %s/Filter /FlateDecode /Length %d >>\nstream\n"
+                          % (xref_idnum, size, *widths, trailer, len(data)))
+        self.stream.write(data)
+        self.stream.write(b"\nendstream\nendobj\nstartxref\n%d\n%%%%EOF\n" % xref_offset)
+
+
+def write_compact(writer, stream, level=6):
+    """Write writer to stream with object streams and a cross-reference stream
+
+    Streams are written as they are; all other objects are packed into
+    deflated object streams by a CompactWriter. Encrypted writers fall back
+    to writer.write, as their objects can't be packed.
+    """
+    if getattr(writer, "_encryption", None):
+        writer.write(stream)
+        return
+    if hasattr(writer, "_resolve_links"):
+        writer._resolve_links()
+
+    objects = writer._objects
+    out = CompactWriter(stream, len(objects) + 1, writer.pdf_header, level)
+    for idnum, obj in enumerate(objects, start=1):
+        if obj is not None:
+            out.add(idnum, obj)
+    refs = _trailer_refs(writer)
+    out.finish(refs["/Root"], refs.get("/Info"), getattr(writer, "_ID", None))
@@ -0,0 +1,102 @@
+"""In-memory input and output for the SovPDF engine.
+
+The browser hands the engine the uploaded file as a memoryview; wrapping it
+in a seekable stream instead of a BytesIO (or a file on the virtual
+filesystem) means the input exists exactly once in Python memory.
+"""
+
+import io
+import os
+
+from linearize import write_linearized
+from optimize import write_compact
+
+
+class MemorySource(io.RawIOBase):
+    """Read-only, seekable stream over a buffer, without copying it"""
+
+    def __init__(self, data):
+        super().__init__()
+        self._view = memoryview(data).cast("B")
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        chunk = self._view[self._pos:self._pos + len(b)]
+        n = len(chunk)
+        b[:n] = chunk
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if pos < 0:
+            raise ValueError(f"Negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._view.release()
+        super().close()
+
+
+def open_source(source):
+    """Return what PdfReader should be given for a path, buffer or stream
+
+    Paths and streams are passed through; buffers are wrapped without a copy.
+    """
+    if isinstance(source, bytes):
+        # BytesIO shares the memory of an immutable bytes object
+        return io.BytesIO(source)
+    if isinstance(source, (bytearray, memoryview)):
+        return MemorySource(source)
+    return source
+
+
+def source_size(source):
+    """Size in bytes of a path, buffer or seekable stream"""
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    if isinstance(source, (bytes, bytearray)):
+        return len(source)
+    if isinstance(source, memoryview):
+        return source.nbytes
+    pos = source.tell()
+    size = source.seek(0, io.SEEK_END)
+    source.seek(pos)
+    return size
+
+
+def write_to_buffer(writer, linearize=False):
+    """Write a PdfWriter into a new in-memory sink and return the BytesIO
+
+    Objects are packed into object streams (see optimize.write_compact),
+    or with linearize, laid out for fast web view (see
+    linearize.write_linearized).
+    """
+    sink = io.BytesIO()
+    if linearize:
+        write_linearized(writer, sink)
+    else:
+        write_compact(writer, sink)
+    return sink
+
+
+def buffer_size(sink):
+    """Number of bytes written to an in-memory sink, without copying it"""
+    return sink.getbuffer().nbytes
@@ -0,0 +1,242 @@
+"""Sharded compression for the SovPDF engine.
+
+A document's pages are split into contiguous ranges of roughly equal work,
+each range is compressed on its own (in a worker process headless, in a Web
+Worker in the browser) and the compressed ranges are merged back into one
+document. Images shared between ranges are encoded once per range and
+become identical objects, which the optimizer merges again. Fonts are
+subset after merging, to the glyphs of the whole document. Links to pages
+of another range are carried across as page numbers, since that page is
+not in the range's own file, and pointed at the merged page again.
+"""
+
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NumberObject
+
+from engine import PRESETS, DocumentAnalysis, compress_to_buffer, make_stats
+from fonts import optimize_fonts
+from images import iter_image_xobjects, summarize_decisions
+from instrument import NULL_INSTRUMENTATION
+from optimize import optimize_objects
+from pdfio import buffer_size, write_to_buffer
+
+log = logging.getLogger("sovpdf")
+
+# Estimated work of a page without images, in the same unit as image bytes
+PAGE_COST = 2000
+# Below this much work per shard, the extra parsing and merging costs more
+# than the parallelism saves
+MIN_SHARD_COST = 1000000
+# How much larger than a single process's output a sharded one may come out
+SHARD_SIZE_SLACK = 0.05
+
+
+def page_costs(reader):
+    """Estimated work per page: a fixed cost plus the bytes of the images it
+    is the first page to use"""
+    seen = set()
+    costs = []
+    for page in reader.pages:
+        cost = PAGE_COST
+        for _, _, ref in iter_image_xobjects(page.get("/Resources")):
+            if ref.idnum not in seen:
+                seen.add(ref.idnum)
+                cost += len(ref.get_object()._data)
+        costs.append(cost)
+    return costs
+
+
+def plan_shards(costs, count):
+    """Split pages into at most count contiguous (start, stop) ranges of similar cost"""
+    left = sum(costs)
+    count = max(1, min(count, len(costs), left // MIN_SHARD_COST))
+    shards = []
+    start = 0
+    shard_cost = 0
+    for index, cost in enumerate(costs):
+        shard_cost += cost
+        shards_left = count - len(shards)
+        # Close the range once it holds its share of what is left, keeping
+        # a page for every later range
+        if shards_left > 1 and shard_cost >= left / shards_left and len(costs) - index - 1 >= shards_left - 1:
+            shards.append((start, index + 1))
+            start = index + 1
+            left -= shard_cost
+            shard_cost = 0
+    shards.append((start, len(costs)))
+    return shards
+
+
+def _resolve(value):
+    return value.get_object() if isinstance(value, IndirectObject) else value
+
+
+def _destinations(page):
+    """Yield the explicit destination arrays the links and actions of page go to"""
+    actions = [_resolve(page.get("/AA"))]
+    annotations = _resolve(page.get("/Annots"))
+    for annotation in annotations if isinstance(annotations, ArrayObject) else ():
+        annotation = _resolve(annotation)
+        if not isinstance(annotation, DictionaryObject):
+            continue
+        dest = _resolve(annotation.get("/Dest"))
+        if isinstance(dest, ArrayObject):
+            yield dest
+        actions += [_resolve(annotation.get("/A")), _resolve(annotation.get("/AA"))]
+    seen = set()
+    while actions:
+        action = actions.pop()
+        if not isinstance(action, DictionaryObject) or id(action) in seen:
+            continue
+        seen.add(id(action))
+        if "/S" not in action:
+            # A trigger dictionary of /AA: its values are actions
+            actions += [_resolve(action.raw_get(k)) for k in action]
+            continue
+        dest = _resolve(action.get("/D"))
+        if action.get("/S") == "/GoTo" and isinstance(dest, ArrayObject):
+            yield dest
+        chain = _resolve(action.get("/Next"))
+        actions += [_resolve(a) for a in chain] if isinstance(chain, ArrayObject) else [chain]
+
+
+def _number_destinations(reader, start, stop):
+    """Replace the links of pages start to stop to pages outside them by page numbers
+
+    Otherwise copying the range would copy every page a link goes to.
+    """
+    numbers = {page.indirect_reference.idnum: index for index, page in enumerate(reader.pages)}
+    for index in range(start, stop):
+        for dest in _destinations(reader.pages[index]):
+            target = numbers.get(dest[0].idnum) if dest and isinstance(dest[0], IndirectObject) else None
+            if target is not None and not start <= target < stop:
+                dest[0] = NumberObject(target)
+
+
+def _link_destinations(writer):
+    """Point the links numbered by _number_destinations at the pages of writer"""
+    pages = [page.indirect_reference for page in writer.pages]
+    for page in writer.pages:
+        for dest in _destinations(page):
+            if dest and isinstance(dest[0], NumberObject) and 0 <= int(dest[0]) < len(pages):
+                dest[0] = pages[int(dest[0])]
+
+
+def compress_shard(source, start, stop, settings):
+    """Compress pages start to stop of source with settings
+
+    Returns (PDF bytes, stats): the stats hold the range's image decisions
+    and stripped bytes, to be added up by shard_stats.
+    """
+    analysis = DocumentAnalysis(source)
+    try:
+        _number_destinations(analysis.reader, start, stop)
+        # Fonts are subset once the ranges are merged
+        writer = analysis.job_with({**settings, "subset_fonts": False}, pages=range(start, stop)).run()
+        stats = {
+            "image_decisions": summarize_decisions(analysis.image_stats.get("decisions", [])),
+            "stripped": dict(analysis.strip_stats),
+        }
+        return write_to_buffer(writer).getvalue(), stats
+    finally:
+        analysis.close()
+
+
+def shard_stats(parts):
+    """The image decisions and stripped bytes of the compressed ranges, added up
+
+    An image shared by several ranges counts once per range, as each range
+    encodes it.
+    """
+    stats = {"image_decisions": {}, "stripped": {}}
+    for part in parts:
+        for key, totals in stats.items():
+            for name, count in part[key].items():
+                totals[name] = totals.get(name, 0) + count
+    return stats
+
+
+def merge_shards(parts, metadata=None, instr=NULL_INSTRUMENTATION, settings=None):
+    """Join compressed ranges (PDF bytes, in page order) into one PdfWriter
+
+    Identical objects of different ranges are merged. With settings (those
+    the ranges were compressed with), fonts are then merged and subset.
+    """
+    with instr.stage("merge"):
+        writer = PdfWriter()
+        for part in parts:
+            for page in PdfReader(BytesIO(part)).pages:
+                writer.add_page(page)
+        _link_destinations(writer)
+        if metadata:
+            writer.add_metadata(metadata)
+    if settings is not None:
+        optimize_fonts(writer, settings["level"], settings.get("subset_fonts", True), instr)
+    optimize_objects(writer, instr)
+    return writer
+
+
+def _link_targets(data):
+    """Per page of the PDF in data, the page numbers its links go to (None when
+    a link goes to no page of the document)"""
+    pages = PdfReader(BytesIO(data)).pages
+    numbers = {page.indirect_reference.idnum: index for index, page in enumerate(pages)}
+    return [[numbers.get(dest[0].idnum) if dest and isinstance(dest[0], IndirectObject) else None
+             for dest in _destinations(page)] for page in pages]
+
+
+def check_shards(sharded, single):
+    """Differences between the sharded and the single-process output of one
+    document (PDF bytes), a list of strings
+
+    Both must have the same pages and links, and the sharded one may be
+    at most SHARD_SIZE_SLACK larger. An empty list means they match.
+    """
+    problems = []
+    sharded_links, single_links = _link_targets(bytes(sharded)), _link_targets(bytes(single))
+    if len(sharded_links) != len(single_links):
+        problems.append(f"{len(sharded_links)} pages instead of {len(single_links)}")
+    for index, (links, expected) in enumerate(zip(sharded_links, single_links)):
+        if links != expected:
+            problems.append(f"page {index} links to pages {links} instead of {expected}")
+    if len(sharded) > len(single) * (1 + SHARD_SIZE_SLACK):
+        problems.append(f"{len(sharded):,} bytes against {len(single):,} in a single process")
+    return problems
+
+
+def compress_sharded(source, preset, workers, analysis=None, instr=None):
+    """Compress source with preset across up to workers processes
+
+    source must be a path or bytes, as it is sent to each worker. Returns
+    (sink, stats) like engine.compress_to_buffer; the stats record the
+    number of shards.
+    """
+    if preset not in PRESETS:
+        raise ValueError(f"Unknown preset: {preset}")
+    start = time.perf_counter()
+    if analysis is None:
+        analysis = DocumentAnalysis(source, instr)
+    with (instr or NULL_INSTRUMENTATION).stage("plan_shards"):
+        shards = plan_shards(page_costs(analysis.reader), workers)
+    log.info(f"Compressing {len(analysis.reader.pages)} pages in {len(shards)} shards")
+
+    if len(shards) == 1:
+        sink, stats = compress_to_buffer(source, preset, analysis, instr)
+    else:
+        with (instr or NULL_INSTRUMENTATION).stage("shards"):
+            with ProcessPoolExecutor(max_workers=len(shards)) as pool:
+                futures = [pool.submit(compress_shard, source, a, b, PRESETS[preset]) for a, b in shards]
+                parts = [future.result() for future in futures]
+        writer = merge_shards([data for data, _ in parts], analysis.reader.metadata, instr or NULL_INSTRUMENTATION,
+                              PRESETS[preset])
+        with (instr or NULL_INSTRUMENTATION).stage("write"):
+            sink = write_to_buffer(writer)
+        stats = make_stats(preset, analysis.size, buffer_size(sink), start, instr)
+        stats.update(shard_stats([part_stats for _, part_stats in parts]))
+    stats["shards"] = len(shards)
+    return sink, stats
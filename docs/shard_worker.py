@@ -0,0 +1,56 @@
+# SovPDF shard worker: compresses one page range of a PDF for main.py,
+# which starts several of these to use every CPU core on a large document,
+# or a whole PDF for main.py's job queue
+import json
+from pyscript import sync, ffi
+from engine import DocumentAnalysis, compress_to_buffer
+from instrument import Instrumentation
+from shard import compress_shard
+
+current_analysis = None  # Parsed reader and decoded images of the last PDF compressed whole here
+current_key = None  # key main.py gave that PDF
+
+# Drop the kept analysis so its reader and rasters can be freed
+def release_analysis():
+    global current_analysis, current_key
+    if current_analysis is not None:
+        current_analysis.close()
+        current_analysis = None
+        current_key = None
+
+# Compress pages start to stop of the PDF in data (a Uint8Array)
+def compress_range(data, start, stop, settings):
+    """Return [the compressed page range as a Uint8Array, its stats as JSON]
+
+    Args:
+        data: Uint8Array holding the whole PDF
+        start, stop: int - page range to compress
+        settings: str - JSON of the preset settings to use
+    """
+    release_analysis()
+    output, stats = compress_shard(data.to_py(), int(start), int(stop), json.loads(settings))
+    return ffi.to_js([memoryview(output), json.dumps(stats)])
+
+# Compress the whole PDF in data with a preset
+def compress_document(data, preset, linearize=False, key=None):
+    """Return [the compressed PDF as a Uint8Array, its stats as JSON]
+
+    Args:
+        data: Uint8Array holding the PDF
+        preset: str - name of the preset to use
+        linearize: bool - lay the output out for fast web view
+        key: str - identifies the PDF: its analysis is kept for the next
+            preset with the same key, instead of parsing the PDF again
+    """
+    global current_analysis, current_key
+    instr = Instrumentation()
+    if key is None or key != current_key:
+        release_analysis()
+        current_analysis = DocumentAnalysis(data.to_py(), instr)
+        current_key = key
+    sink, stats = compress_to_buffer(None, str(preset), current_analysis, instr, bool(linearize))
+    return ffi.to_js([memoryview(sink.getbuffer()), json.dumps(stats)])
+
+# Expose to the page, which calls them as worker.sync.compress_range(...)
+sync.compress_range = compress_range
+sync.compress_document = compress_document
@@ -0,0 +1,305 @@
+"""Memory-bounded streaming compression for the SovPDF engine.
+
+The regular pipeline copies every page into a PdfWriter and keeps all of
+it until the file is written. A StreamingJob instead walks the pages in
+windows sized by a memory budget: the images of a window are re-encoded one
+at a time, then everything the window's pages reference is written straight
+to the output and dropped from the reader's cache. Objects keep the numbers
+they have in the input, so later windows and the final pass (page tree,
+outlines, ...) can refer to anything already written. Peak memory depends
+on the largest window, not on the size of the document. Fonts are written
+as they are, since one is written with the first window that uses it,
+before the glyphs later windows show are known. Payload no page renders
+(see strip.py) is stripped from each object before it is written.
+"""
+
+import logging
+import time
+
+from pypdf import PdfReader
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+from content import ContentCompressor
+from engine import PRESETS, CancelToken, make_stats
+from images import MIN_SAVINGS, build_image_index, encode_entry, iter_image_xobjects, measure_placements
+from instrument import NULL_INSTRUMENTATION
+from optimize import CompactWriter, replace_references
+from pdfio import open_source, source_size
+from strip import SAFE, Stripper
+
+log = logging.getLogger("sovpdf")
+
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+# Allowance for the objects of a page besides its images, in bytes
+PAGE_OVERHEAD = 64 * 1024
+
+
+def _first_free(reader):
+    """One more than the highest object number the input uses"""
+    highest = int(reader.trailer.get("/Size", 1)) - 1
+    for table in reader.xref.values():
+        if table:
+            highest = max(highest, max(table))
+    if reader.xref_objStm:
+        highest = max(highest, max(reader.xref_objStm))
+    return highest + 1
+
+
+def _is_page(obj):
+    return isinstance(obj, DictionaryObject) and obj.get("/Type") == "/Page"
+
+
+class StreamingJob:
+    """One streaming compression of source into the binary stream sink
+
+    Like engine.CompressionJob, steps() yields a progress event after every
+    image and every page and checks the cancel token between them; run()
+    does the whole job at once. settings is a PRESETS entry (or explicit
+    quality/level/dpi settings); memory_budget, in bytes, caps the estimated
+    image memory of a window of pages: encoded data plus decoded rasters.
+    At least one page is always processed at a time, so a single page
+    larger than the budget still goes through.
+    """
+
+    def __init__(self, source, settings, sink, memory_budget=DEFAULT_MEMORY_BUDGET, cancel=None, instr=None):
+        self.source = source
+        self.settings = settings
+        self.sink = sink
+        self.memory_budget = memory_budget
+        self.cancel = cancel or CancelToken()
+        self.instr = instr or NULL_INSTRUMENTATION
+        self.size = source_size(source)
+        self.bytes_written = 0
+        self.windows = 0
+        self.images_done = 0
+        self.strip_stats = {}
+
+    def steps(self):
+        start = time.perf_counter()
+        instr = self.instr
+        with instr.stage("parse"):
+            reader = PdfReader(open_source(self.source))
+            if reader.is_encrypted:
+                raise ValueError("Encrypted PDFs can't be compressed in streaming mode")
+            pages_total = len(reader.pages)
+        self.reader = reader
+        self.out = CompactWriter(self.sink, _first_free(reader), reader.pdf_header, self.settings["level"])
+        self.written = set()
+        self.stripper = Stripper(self.settings.get("strip", SAFE))
+        self.canonical = {}  # idnum of a duplicate image -> reference to the kept copy
+        self.replacements = {}  # idnum -> re-encoded image stream, for the current window
+        self.content_ids = set()  # idnums of the content streams of the current window
+        # Identical content streams are compressed once, within a share of the budget
+        self.content = ContentCompressor(self.settings["level"], instr, self.memory_budget // 8)
+        encoded = {}  # image content key -> reference of the first copy
+        pages_done = 0
+
+        for window in self._windows(reader):
+            self.windows += 1
+            pages = [reader.pages[i] for i in window]
+            with instr.stage("image_index"):
+                index = build_image_index(pages, rewire=False)
+            if self.settings["dpi"]:
+                with instr.stage("placements"):
+                    measure_placements(pages, index)
+
+            # Re-encode the window's images, each unique image once per document
+            for entry in index.values():
+                self.cancel.check()
+                for ref in entry.duplicates:
+                    self.canonical[ref.idnum] = encoded.get(entry.key, entry.ref)
+                if entry.key in encoded:
+                    self.canonical[entry.ref.idnum] = encoded[entry.key]
+                    continue
+                encoded[entry.key] = entry.ref
+                try:
+                    new_stream, _, _ = encode_entry(entry, self.settings["quality"], self.settings["dpi"], None, instr,
+                                                    self.settings.get("min_savings", MIN_SAVINGS))
+                except Exception as e:
+                    log.warning(f"Skipping image {entry.ref.idnum}: {e}")
+                    instr.count("images_failed")
+                    new_stream = None
+                if new_stream is not None:
+                    self.replacements[entry.ref.idnum] = new_stream
+                self.images_done += 1
+                yield self._event("images", start, pages_done, pages_total)
+
+            # Write each page with everything it references
+            for page in pages:
+                self.cancel.check()
+                contents = page.raw_get("/Contents") if "/Contents" in page else None
+                refs = contents.get_object() if isinstance(contents, IndirectObject) else contents
+                if isinstance(refs, ArrayObject):
+                    self.content_ids.update(r.idnum for r in refs if isinstance(r, IndirectObject))
+                elif isinstance(contents, IndirectObject):
+                    self.content_ids.add(contents.idnum)
+                with instr.stage("write"):
+                    self._write_reachable(page.indirect_reference, page.indirect_reference.idnum)
+                pages_done += 1
+                instr.count("pages")
+                yield self._event("pages", start, pages_done, pages_total)
+
+            self.replacements.clear()
+            self.content_ids.clear()
+            self._evict()
+
+        # The page tree, outlines, names and everything else left. Named
+        # destinations are pruned once the outlines, the last links, are written
+        with instr.stage("write"):
+            root = reader.trailer.raw_get("/Root")
+            info = reader.trailer.raw_get("/Info") if "/Info" in reader.trailer else None
+            catalog = root.get_object()
+            self.stripper.visit(catalog)
+            self.stripper.detach_destinations(catalog)
+            outlines = catalog.raw_get("/Outlines") if "/Outlines" in catalog else None
+            if isinstance(outlines, IndirectObject):
+                self._write_reachable(outlines)
+            self.stripper.attach_destinations()
+            self._write_reachable(root)
+            if isinstance(info, IndirectObject):
+                self._write_reachable(info)
+            else:
+                info = None
+            self.out.finish(root, info, reader.trailer.get("/ID"))
+        self.bytes_written = self.out.tell()
+        self._measure_stripped()
+        log.info(f"Streamed {pages_total} pages in {self.windows} windows, {len(encoded)} unique images")
+
+    def _windows(self, reader):
+        """Yield lists of page indexes whose image data fits the memory budget"""
+        window = []
+        cost = 0
+        seen = set()
+        for index, page in enumerate(reader.pages):
+            page_cost = PAGE_OVERHEAD
+            for _, _, ref in iter_image_xobjects(page.get("/Resources")):
+                if ref.idnum not in seen:
+                    seen.add(ref.idnum)
+                    stream = ref.get_object()
+                    # The encoded data plus a worst-case decoded RGBA raster
+                    page_cost += len(stream._data) + 4 * int(stream.get("/Width", 0)) * int(stream.get("/Height", 0))
+            if window and cost + page_cost > self.memory_budget:
+                yield window
+                window = []
+                cost = 0
+            window.append(index)
+            cost += page_cost
+        if window:
+            yield window
+
+    def _write_reachable(self, ref, page_idnum=None):
+        """Write ref and every unwritten object it references, children first
+
+        While writing a page (page_idnum), other pages and the page tree
+        (/Parent) are not followed: they are written with their own window
+        or in the final pass, after their images have been re-encoded.
+        """
+        reader = self.reader
+        expanded = set()
+        stack = [ref]
+        while stack:
+            ref = stack[-1]
+            ref = self.canonical.get(ref.idnum, ref)
+            idnum = ref.idnum
+            if idnum in self.written:
+                stack.pop()
+                continue
+            obj = self.replacements.get(idnum)
+            if obj is None:
+                obj = reader.get_object(ref)
+            if obj is None:
+                stack.pop()
+                continue
+            if idnum not in expanded:
+                expanded.add(idnum)
+                self.stripper.visit(obj)
+                for child in self._children(obj, idnum == page_idnum):
+                    child = self.canonical.get(child.idnum, child)
+                    if child.idnum in self.written or child.idnum in expanded:
+                        continue
+                    if page_idnum is not None and child.idnum != page_idnum and _is_page(reader.get_object(child)):
+                        continue
+                    stack.append(child)
+                continue
+            stack.pop()
+            replace_references(obj, self.canonical)
+            if idnum in self.content_ids and isinstance(obj, StreamObject):
+                obj = self.content.compress(obj) or obj
+            self.out.add(idnum, obj, ref.generation)
+            self.written.add(idnum)
+
+    def _children(self, obj, is_current_page):
+        """References directly inside obj that have to be written with it"""
+        stack = [obj]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, IndirectObject):
+                yield item
+            elif isinstance(item, DictionaryObject):
+                for key in item.keys():
+                    # /Length is written inline; the page tree comes last
+                    if key == "/Length" and isinstance(item, StreamObject):
+                        continue
+                    if key == "/Parent" and is_current_page:
+                        continue
+                    stack.append(item.raw_get(key))
+            elif isinstance(item, ArrayObject):
+                stack.extend(item)
+
+    def _measure_stripped(self):
+        """Count the bytes stripped per category, in self.strip_stats and the instrumentation"""
+        sizes, orphans = self.stripper.measure(self.reader.get_object, self.written)
+        self.written.update(orphans)  # only so that _evict drops them
+        self._evict()
+        self.strip_stats.update(sizes)
+        for category, size in sizes.items():
+            self.instr.count(f"stripped_{category}_bytes", size)
+
+    def _evict(self):
+        """Drop written objects from the reader's cache so they can be freed"""
+        cache = self.reader.resolved_objects
+        for key in [k for k in cache if k[1] in self.written]:
+            del cache[key]
+
+    def _event(self, stage, start, pages_done, pages_total):
+        elapsed = time.perf_counter() - start
+        fraction = pages_done / pages_total if pages_total else 1
+        return {
+            "stage": stage,
+            "pages_done": pages_done,
+            "pages_total": pages_total,
+            "images_done": self.images_done,
+            "images_total": 0,  # not known until the last window
+            "bytes_in": self.size,
+            "bytes_out": self.out.tell(),
+            "fraction": fraction,
+            "elapsed": elapsed,
+            "eta": elapsed * (1 - fraction) / fraction if fraction > 0 else None,
+        }
+
+    def run(self, on_progress=None):
+        """Run every step, passing each progress event to on_progress"""
+        for event in self.steps():
+            if on_progress is not None:
+                on_progress(event)
+        return self.bytes_written
+
+
+def compress_streaming(source, output, preset, memory_budget=DEFAULT_MEMORY_BUDGET, instr=None):
+    """Compress source into output (a path or binary stream) in streaming mode
+
+    Returns a stats dictionary like engine.make_stats, plus the number of
+    page windows used.
+    """
+    if preset not in PRESETS:
+        raise ValueError(f"Unknown preset: {preset}")
+    start = time.perf_counter()
+    if isinstance(output, str):
+        with open(output, "wb") as f:
+            return compress_streaming(source, f, preset, memory_budget, instr)
+    job = StreamingJob(source, PRESETS[preset], output, memory_budget, instr=instr)
+    job.run()
+    stats = make_stats(preset, job.size, job.bytes_written, start, instr)
+    stats["windows"] = job.windows
+    stats["stripped"] = dict(job.strip_stats)
+    return stats
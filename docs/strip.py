@@ -0,0 +1,287 @@
+"""Removal of payload no page needs to render, for the SovPDF engine.
+
+Authoring tools leave data in PDFs that no viewer draws: page thumbnails,
+application private data (/PieceInfo), alternate versions of images, XMP
+metadata packets, JavaScript, embedded files and named destinations nothing
+links to. Which of these categories go is a policy, the "strip" setting of
+a preset. A Stripper takes them out of each object as a traversal reaches
+it, so stripping costs no pass of its own: strip_payload does it in one walk
+of a PdfWriter from the trailer, and streaming.StreamingJob while it writes.
+Named destinations are pruned last, once every link to them has been seen.
+"""
+
+import logging
+from io import BytesIO
+
+from pypdf.generic import (ArrayObject, ByteStringObject, DictionaryObject, IndirectObject, NameObject,
+                           StreamObject, TextStringObject)
+
+from instrument import NULL_INSTRUMENTATION
+from optimize import _iter_refs, _trailer_refs
+
+log = logging.getLogger("sovpdf")
+
+CATEGORIES = ("thumbnails", "piece_info", "alternates", "metadata", "javascript", "embedded_files", "destinations")
+# Never changes how the document looks or behaves on screen
+SAFE = ("thumbnails", "piece_info", "alternates")
+# The document's own XMP packet is kept up to this size, as it may carry its
+# title or PDF/A identification; page and image packets always go
+MAX_DOCUMENT_METADATA = 16 * 1024
+
+
+def _resolved(dictionary, key):
+    value = dictionary.raw_get(key)
+    return value.get_object() if isinstance(value, IndirectObject) else value
+
+
+def _is_script(action):
+    action = action.get_object() if isinstance(action, IndirectObject) else action
+    return isinstance(action, DictionaryObject) and action.get("/S") == "/JavaScript"
+
+
+def _subtype(annotation):
+    annotation = annotation.get_object() if isinstance(annotation, IndirectObject) else annotation
+    return annotation.get("/Subtype") if isinstance(annotation, DictionaryObject) else None
+
+
+def _name_key(value):
+    """Key of a named destination, whether it is a name (/Dests) or a string (name tree)"""
+    if isinstance(value, NameObject):
+        return str(value)
+    if isinstance(value, (TextStringObject, ByteStringObject)):
+        return value.original_bytes
+    return None
+
+
+def _size(obj):
+    """Bytes obj takes when written: its dictionary plus, for a stream, its data"""
+    buffer = BytesIO()
+    if isinstance(obj, StreamObject):
+        DictionaryObject.write_to_stream(obj, buffer)
+        return buffer.tell() + len(obj._data)
+    obj.write_to_stream(buffer)
+    return buffer.tell()
+
+
+class Stripper:
+    """Takes the categories of policy out of the objects visit() is given
+
+    The removed values are kept per category until measure() counts them;
+    the named destinations links use are collected along the way.
+    """
+
+    def __init__(self, policy):
+        self.policy = frozenset(policy)
+        self.removed = {category: [] for category in CATEGORIES if category in self.policy}
+        self.adjustments = dict.fromkeys(self.removed, 0)  # bytes added back, per category
+        self.used_names = set()
+        self.destinations = []  # (container, key, value) taken out by detach_destinations
+
+    def visit(self, obj):
+        """Strip obj and the direct objects inside it, without following references"""
+        stack = [obj]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, DictionaryObject):
+                self._strip(item)
+                stack.extend(item.raw_get(k) for k in item.keys())
+            elif isinstance(item, ArrayObject):
+                stack.extend(item)
+
+    def _remove(self, dictionary, key, category):
+        self.removed[category].append(dictionary.raw_get(key))
+        del dictionary[key]
+
+    def _strip(self, d):
+        policy = self.policy
+        kind = d.get("/Type")
+        if "thumbnails" in policy and "/Thumb" in d and kind == "/Page":
+            self._remove(d, "/Thumb", "thumbnails")
+        if "piece_info" in policy and "/PieceInfo" in d:
+            self._remove(d, "/PieceInfo", "piece_info")
+        if "alternates" in policy and "/Alternates" in d and d.get("/Subtype") == "/Image":
+            self._remove(d, "/Alternates", "alternates")
+        if "metadata" in policy and "/Metadata" in d:
+            packet = _resolved(d, "/Metadata")
+            if kind != "/Catalog" or not isinstance(packet, StreamObject) or len(packet._data) > MAX_DOCUMENT_METADATA:
+                self._remove(d, "/Metadata", "metadata")
+        names = _resolved(d, "/Names") if kind == "/Catalog" and "/Names" in d else None
+        names = names if isinstance(names, DictionaryObject) else {}
+        if "javascript" in policy:
+            self._strip_scripts(d)
+            if "/JavaScript" in names:
+                self._remove(names, "/JavaScript", "javascript")
+        if "embedded_files" in policy:
+            if "/AF" in d:
+                self._remove(d, "/AF", "embedded_files")
+            if kind == "/Catalog" and "/Collection" in d:
+                self._remove(d, "/Collection", "embedded_files")
+            if "/EmbeddedFiles" in names:
+                self._remove(names, "/EmbeddedFiles", "embedded_files")
+            annotations = _resolved(d, "/Annots") if "/Annots" in d else None
+            if isinstance(annotations, ArrayObject):
+                attachments = [a for a in annotations if _subtype(a) == "/FileAttachment"]
+                if attachments:
+                    self.removed["embedded_files"].extend(attachments)
+                    annotations[:] = [a for a in annotations if _subtype(a) != "/FileAttachment"]
+        if "destinations" in policy:
+            for key in ("/Dest", "/D") if "/Dest" in d or d.get("/S") == "/GoTo" else ():
+                name = _name_key(_resolved(d, key)) if key in d else None
+                if name is not None:
+                    self.used_names.add(name)
+
+    def _strip_scripts(self, d):
+        """Remove the JavaScript actions of d: its action, triggers and next actions"""
+        for key in ("/A", "/OpenAction"):
+            if key in d and _is_script(d.raw_get(key)):
+                self._remove(d, key, "javascript")
+        if "/AA" in d:
+            triggers = _resolved(d, "/AA")
+            if isinstance(triggers, DictionaryObject):
+                for key in [k for k in triggers if _is_script(triggers.raw_get(k))]:
+                    self._remove(triggers, key, "javascript")
+                if not triggers:
+                    self._remove(d, "/AA", "javascript")
+        if "/Next" in d and "/S" in d:
+            chain = _resolved(d, "/Next")
+            if isinstance(chain, ArrayObject):
+                scripts = [action for action in chain if _is_script(action)]
+                self.removed["javascript"].extend(scripts)
+                chain[:] = [action for action in chain if not _is_script(action)]
+            if _is_script(chain) or chain == []:
+                self._remove(d, "/Next", "javascript")
+
+    def detach_destinations(self, root):
+        """Take the named destinations out of the catalog root, until attach_destinations
+
+        They are left out of the traversal, so only what the kept names
+        refer to is reached once they are pruned.
+        """
+        if "destinations" not in self.policy:
+            return
+        names = _resolved(root, "/Names") if "/Names" in root else None
+        for container in (root, names):
+            if isinstance(container, DictionaryObject) and "/Dests" in container:
+                self.destinations.append((container, NameObject("/Dests"), container.raw_get("/Dests")))
+                del container["/Dests"]
+
+    def attach_destinations(self):
+        """Put back the detached destinations, cut down to the names links use
+
+        Returns the values put back, to be traversed in turn.
+        """
+        attached = []
+        for container, key, value in self.destinations:
+            tree = value.get_object()
+            if not isinstance(tree, DictionaryObject):
+                continue
+            if container.get("/Type") == "/Catalog":
+                entries = [(NameObject(k), tree.raw_get(k)) for k in tree]
+            else:
+                entries = list(self._leaves(tree))
+            kept = [(name, dest) for name, dest in entries if _name_key(name) in self.used_names]
+            if len(kept) == len(entries):
+                container[key] = value
+                attached.append(value)
+                continue
+            self.removed["destinations"].append(value)
+            if not kept:
+                continue
+            if container.get("/Type") == "/Catalog":
+                pruned = DictionaryObject(kept)
+            else:
+                pruned = DictionaryObject({NameObject("/Names"): ArrayObject(v for pair in kept for v in pair)})
+            # What is kept was counted with the removed tree
+            self.adjustments["destinations"] -= _size(pruned)
+            container[key] = pruned
+            attached.append(pruned)
+        self.destinations = []
+        return attached
+
+    def _leaves(self, tree):
+        """(name, destination) pairs of a name tree, in order"""
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            node = node.get_object() if isinstance(node, IndirectObject) else node
+            if not isinstance(node, DictionaryObject):
+                continue
+            pairs = _resolved(node, "/Names") if "/Names" in node else None
+            if isinstance(pairs, ArrayObject):
+                yield from zip(pairs[0::2], pairs[1::2])
+            kids = _resolved(node, "/Kids") if "/Kids" in node else None
+            if isinstance(kids, ArrayObject):
+                stack.extend(reversed(kids))
+
+    def measure(self, get_object, kept):
+        """Bytes removed per category, counting the objects only removed values refer to
+
+        get_object resolves a reference (or returns None); kept holds the
+        object numbers that are written regardless. Returns (bytes per
+        category, object numbers of the objects nothing kept refers to).
+        """
+        sizes = {}
+        orphans = set()
+        for category, values in self.removed.items():
+            total = self.adjustments[category]
+            stack = list(values)
+            while stack:
+                value = stack.pop()
+                if isinstance(value, IndirectObject):
+                    if value.idnum in kept or value.idnum in orphans:
+                        continue
+                    orphans.add(value.idnum)
+                    value = get_object(value)
+                    if value is None:
+                        continue
+                total += _size(value)
+                stack.extend(_iter_refs(value))
+            if total > 0:
+                sizes[category] = total
+        return sizes, orphans
+
+
+def strip_payload(writer, policy=SAFE, instr=NULL_INSTRUMENTATION):
+    """Remove the payload categories of policy from writer, in one traversal
+
+    Objects only the removed entries referred to are dropped. Returns
+    {category: bytes removed}, for the categories that removed anything.
+    """
+    if not policy:
+        return {}
+    with instr.stage("strip"):
+        stripper = Stripper(policy)
+        objects = writer._objects
+        stripper.detach_destinations(writer.root_object)
+
+        def get_object(ref):
+            return objects[ref.idnum - 1] if 0 < ref.idnum <= len(objects) else None
+
+        reachable = set()
+        stack = [ref.idnum for ref in _trailer_refs(writer).values()]
+        while True:
+            while stack:
+                idnum = stack.pop()
+                if idnum in reachable or not 0 < idnum <= len(objects):
+                    continue
+                reachable.add(idnum)
+                obj = objects[idnum - 1]
+                if obj is not None:
+                    stripper.visit(obj)
+                    stack.extend(ref.idnum for ref in _iter_refs(obj) if ref.idnum not in reachable)
+            if not stripper.destinations:
+                break
+            for value in stripper.attach_destinations():
+                if isinstance(value, IndirectObject):
+                    stack.append(value.idnum)
+                else:
+                    stack.extend(ref.idnum for ref in _iter_refs(value))
+
+        sizes, orphans = stripper.measure(get_object, reachable)
+        for idnum in orphans:
+            objects[idnum - 1] = None
+    for category, size in sizes.items():
+        instr.count(f"stripped_{category}_bytes", size)
+    if sizes:
+        log.info("Stripped " + ", ".join(f"{category}: {size:,} bytes" for category, size in sizes.items()))
+    return sizes
@@ -1,5 +1,18 @@
 // SovPDF Service Worker
-const CACHE_NAME = 'sovpdf-cache-v1';
+const CACHE_NAME = 'sovpdf-cache-v21';
+
+// The Pyodide runtime and the wheels of the engine's packages. Their URLs
+// carry the Pyodide or package version, so the responses never change and
+// this cache survives app updates; entries of an older Pyodide release are
+// pruned once a newer one is in use.
+const RUNTIME_CACHE = 'sovpdf-runtime-v1';
+const RUNTIME_HOSTS = ['https://cdn.jsdelivr.net/pyodide/', 'https://files.pythonhosted.org/'];
+// Package indexes change with every release, so they are only a fallback
+const INDEX_HOSTS = ['https://pypi.org/'];
+// Packages main.py loads from the Pyodide distribution, and from PyPI with
+// the exact version it pins (PYPDF_VERSION in main.py)
+const RUNTIME_PACKAGES = ['pillow', 'numpy', 'fonttools', 'micropip'];
+const PYPI_PACKAGES = {pypdf: '6.20.1'};
 
 // List of resources to cache
 const RESOURCES_TO_CACHE = [
@@ -7,6 +20,23 @@ const RESOURCES_TO_CACHE = [
   './index.html',
   './manifest.json',
   './main.py',
+  './engine.py',
+  './images.py',
+  './classify.py',
+  './content.py',
+  './fonts.py',
+  './pdfio.py',
+  './target.py',
+  './analyze.py',
+  './instrument.py',
+  './optimize.py',
+  './shard.py',
+  './linearize.py',
+  './strip.py',
+  './shard_worker.py',
+  './streaming.py',
+  './cache.py',
+  './zipstream.py',
   './bulma.min.css',
   './font-awesome/css/font-awesome.min.css',
   './font-awesome/fonts/fontawesome-webfont.woff',
@@ -44,7 +74,7 @@ self.addEventListener('install', event => {
 
 // Activate event - clear old caches when a new service worker is activated
 self.addEventListener('activate', event => {
-  const currentCaches = [CACHE_NAME];
+  const currentCaches = [CACHE_NAME, RUNTIME_CACHE];
   event.waitUntil(
     caches.keys().then(cacheNames => {
       return cacheNames.filter(cacheName => !currentCaches.includes(cacheName));
@@ -59,8 +89,95 @@ self.addEventListener('activate', event => {
   );
 });
 
+// Cache the wheels main.py loads after startup, plus their dependencies,
+// using the lock file of the Pyodide release at indexURL
+async function precacheRuntime(indexURL, lock) {
+  const cache = await caches.open(RUNTIME_CACHE);
+  const names = new Set();
+  const queue = [...RUNTIME_PACKAGES];
+  while (queue.length) {
+    const name = queue.pop();
+    const entry = lock.packages[name];
+    if (entry && !names.has(name)) {
+      names.add(name);
+      queue.push(...entry.depends);
+    }
+  }
+  const urls = [...names].map(name => indexURL + lock.packages[name].file_name);
+  for (const [name, version] of Object.entries(PYPI_PACKAGES)) {
+    const response = await fetch(`https://pypi.org/pypi/${name}/${version}/json`);
+    const wheel = (await response.json()).urls.find(file => file.filename.endsWith('-none-any.whl'));
+    if (wheel) {
+      urls.push(wheel.url);
+    }
+  }
+  await Promise.all(urls.map(async url => {
+    if (!(await cache.match(url))) {
+      const response = await fetch(url);
+      if (response.ok) {
+        await cache.put(url, response);
+      }
+    }
+  }));
+  // Drop the files of other Pyodide releases
+  for (const request of await cache.keys()) {
+    if (request.url.startsWith(RUNTIME_HOSTS[0]) && !request.url.startsWith(indexURL)) {
+      await cache.delete(request);
+    }
+  }
+  console.log(`Service worker: Runtime cached for ${indexURL}`);
+}
+
+// Serve a runtime file from the cache, fetching and caching it on first use.
+// Loading the Pyodide lock file also caches the engine's wheels.
+async function runtimeResponse(event) {
+  const cache = await caches.open(RUNTIME_CACHE);
+  const cachedResponse = await cache.match(event.request);
+  if (cachedResponse) {
+    return cachedResponse;
+  }
+  const response = await fetch(event.request);
+  if (response.ok) {
+    await cache.put(event.request, response.clone());
+    if (event.request.url.endsWith('/pyodide-lock.json')) {
+      const indexURL = event.request.url.slice(0, -'pyodide-lock.json'.length);
+      event.waitUntil(response.clone().json()
+        .then(lock => precacheRuntime(indexURL, lock))
+        .catch(error => console.log('Service worker: Runtime precache failed', error)));
+    }
+  }
+  return response;
+}
+
+// Fetch a package index from the network, falling back to the cached copy offline
+async function indexResponse(event) {
+  const cache = await caches.open(RUNTIME_CACHE);
+  try {
+    const response = await fetch(event.request);
+    if (response.ok) {
+      await cache.put(event.request, response.clone());
+    }
+    return response;
+  } catch (error) {
+    const cachedResponse = await cache.match(event.request);
+    if (cachedResponse) {
+      return cachedResponse;
+    }
+    throw error;
+  }
+}
+
 // Fetch event - intercept network requests and serve from cache when offline
 self.addEventListener('fetch', event => {
+  const url = event.request.url;
+  if (event.request.method === 'GET' && RUNTIME_HOSTS.some(host => url.startsWith(host))) {
+    event.respondWith(runtimeResponse(event));
+    return;
+  }
+  if (event.request.method === 'GET' && INDEX_HOSTS.some(host => url.startsWith(host))) {
+    event.respondWith(indexResponse(event));
+    return;
+  }
   // Skip cross-origin requests
   if (event.request.url.startsWith(self.location.origin) || 
       event.request.url.startsWith('https://pyscript.net/')) {
@@ -0,0 +1,322 @@
+"""Target-size compression for the SovPDF engine.
+
+Searches a ladder of image settings for the gentlest one that fits a byte
+budget. Candidates are judged on an estimate built from a sample of encoded
+images and a few sampled pages written without their images; a full write
+only happens for the candidate the estimate picks, and each full write
+recalibrates the estimate for the next one.
+"""
+
+import hashlib
+import logging
+import time
+
+from pypdf.generic import ArrayObject, IndirectObject, NullObject, StreamObject
+
+from content import ContentCompressor
+from engine import DocumentAnalysis, copy_pages, make_stats
+from images import (build_image_index, encode_entry, iter_image_xobjects, resolve_display_sizes, skip_reason,
+                    summarize_decisions, target_size)
+from instrument import NULL_INSTRUMENTATION
+from optimize import optimize_objects
+from pdfio import buffer_size, write_to_buffer
+from strip import SAFE, strip_payload
+
+log = logging.getLogger("sovpdf")
+
+# Settings tried by the search, from gentlest to most aggressive
+LADDER = [
+    {"quality": 90, "dpi": 200, "level": 6},
+    {"quality": 85, "dpi": 150, "level": 6},
+    {"quality": 75, "dpi": 150, "level": 6},
+    {"quality": 75, "dpi": 110, "level": 6},
+    {"quality": 65, "dpi": 110, "level": 6},
+    {"quality": 55, "dpi": 96, "level": 6},
+    {"quality": 50, "dpi": 72, "level": 9},
+    {"quality": 40, "dpi": 72, "level": 9},
+    {"quality": 30, "dpi": 60, "level": 9},
+    {"quality": 25, "dpi": 50, "level": 9},
+]
+
+SAMPLE_SIZE = 8  # images actually encoded per estimate
+# Pages compressed and written to measure the cost of everything but images
+PAGE_SAMPLE_SIZE = 8
+MAX_FULL_PASSES = 3
+HEADROOM = 0.97  # aim this far under the target to absorb estimate error
+# A pass that fits under this share of the target tries gentler steps
+CLEAR_SLACK = 0.9
+
+
+def _stream_key(stream):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(stream._data)
+    return digest.digest()
+
+
+def _page_contents(page):
+    """The content streams of page, as (idnum, stream) pairs"""
+    contents = page.raw_get("/Contents") if "/Contents" in page else None
+    items = contents.get_object() if contents is not None else None
+    items = list(items) if isinstance(items, ArrayObject) else [contents]
+    return [(item.idnum, item.get_object()) for item in items
+            if isinstance(item, IndirectObject) and isinstance(item.get_object(), StreamObject)]
+
+
+def stream_inventory(reader):
+    """(unique bytes, duplicate count, duplicate bytes) of the streams of reader
+
+    A stream is a duplicate when its data is identical to an earlier one.
+    """
+    seen = set()
+    unique = count = duplicates = 0
+    for idnum in reader.xref.get(0, {}):
+        try:
+            obj = reader.get_object(IndirectObject(idnum, 0, reader))
+        except Exception:
+            continue
+        if not isinstance(obj, StreamObject):
+            continue
+        key = _stream_key(obj)
+        if key in seen:
+            count += 1
+            duplicates += len(obj._data)
+        else:
+            seen.add(key)
+            unique += len(obj._data)
+    return unique, count, duplicates
+
+
+def content_bytes(pages):
+    """Bytes of the unique content streams of pages"""
+    seen = set()
+    total = 0
+    for page in pages:
+        for idnum, stream in _page_contents(page):
+            if idnum not in seen:
+                seen.add(idnum)
+                total += len(stream._data)
+    return total
+
+
+def sample_pages(reader, settings, size=PAGE_SAMPLE_SIZE):
+    """Compress and write up to size pages of reader, spread over the document
+
+    Images are dropped before writing, as they are estimated separately.
+    Returns (pages, seconds, structure bytes, content bytes before, content
+    bytes after, stripped bytes): structure bytes is what the output spends
+    on anything but streams, once packed into object streams.
+    """
+    start = time.perf_counter()
+    step = max(1, len(reader.pages) // size)
+    indexes = range(0, len(reader.pages), step)[:size]
+    writer = copy_pages(reader, indexes)
+    stripped = sum(strip_payload(writer, settings.get("strip", SAFE)).values())
+    before = content_bytes(writer.pages)
+    content = ContentCompressor(settings["level"])
+    for page in writer.pages:
+        for xobjects, name, ref in list(iter_image_xobjects(page.get("/Resources"))):
+            writer._replace_object(ref, NullObject())
+        content.compress_page(writer, page)
+    after = content_bytes(writer.pages)
+    if settings.get("optimize", True):
+        optimize_objects(writer)
+    streams = sum(len(obj._data) for obj in writer._objects if isinstance(obj, StreamObject))
+    structure = buffer_size(write_to_buffer(writer)) - streams
+    return len(indexes), time.perf_counter() - start, max(0, structure), before, after, stripped
+
+
+class SizeEstimator:
+    """Predict the output size of a document for a set of image settings"""
+
+    def __init__(self, analysis, sample_size=SAMPLE_SIZE, max_sample_pixels=None):
+        self.analysis = analysis
+        pages = analysis.reader.pages
+        index = build_image_index(pages, rewire=False)
+        resolve_display_sizes(pages, index, analysis.images)
+        self.entries = list(index.values())
+
+        self.contents = content_bytes(pages)
+        stream_bytes, self.duplicates, self.duplicate_bytes = stream_inventory(analysis.reader)
+        # Duplicate streams are written once; fonts, profiles, metadata and
+        # the like are written as they are, unless stripped
+        image_bytes = sum(len(e.stream._data) for e in self.entries)
+        self.other_streams = max(0, stream_bytes - image_bytes - self.contents)
+        self.image_scale = 1.0
+        self.other_correction = 0  # measured minus estimated non-image bytes of the last full pass
+        self._page_samples = {}
+
+        # The largest images dominate the output, so sample those first,
+        # then spread the rest of the sample over the remaining images
+        ranked = sorted(self.entries, key=lambda e: len(e.stream._data), reverse=True)
+        head = ranked[:sample_size // 2]
+        rest = ranked[len(head):]
+        step = max(1, len(rest) // max(1, sample_size - len(head)))
+        self.sample = head + rest[::step][:sample_size - len(head)]
+        if max_sample_pixels is not None:
+            # Decoding dominates, so a pixel budget bounds the estimate's cost;
+            # the largest image is always sampled
+            kept = 0
+            for count, entry in enumerate(self.sample):
+                kept += int(entry.stream.get("/Width", 0)) * int(entry.stream.get("/Height", 0))
+                if count and kept > max_sample_pixels:
+                    self.sample = self.sample[:count]
+                    break
+        self._image_estimates = {}
+
+    def _output_pixels(self, entry, dpi):
+        width, height = int(entry.stream["/Width"]), int(entry.stream["/Height"])
+        size = target_size(width, height, entry.display_size, dpi) or (width, height)
+        return size[0] * size[1]
+
+    def image_bytes(self, settings, instr=NULL_INSTRUMENTATION):
+        """Estimated bytes of image data once encoded with settings
+
+        The sample encodes are timed in instr when they run, which is only
+        the first time these settings are estimated.
+        """
+        key = (settings["quality"], settings["dpi"])
+        if key not in self._image_estimates:
+            sampled = set()
+            encoded_bytes = 0
+            encoded_pixels = 0
+            kept_bytes = 0
+            for entry in self.sample:
+                sampled.add(entry.key)
+                try:
+                    new_stream, _, _ = encode_entry(entry, settings["quality"], settings["dpi"], self.analysis.images, instr)
+                except Exception:
+                    new_stream = None
+                if new_stream is None:
+                    kept_bytes += len(entry.stream._data)
+                else:
+                    encoded_bytes += len(new_stream._data)
+                    # Counted at the settings' resolution even when the encode
+                    # kept more (1-bit images), like the images extrapolated to
+                    encoded_pixels += self._output_pixels(entry, settings["dpi"])
+
+            # Extrapolate the sampled bytes per pixel to the other images
+            bytes_per_pixel = encoded_bytes / encoded_pixels if encoded_pixels else 0
+            estimate = encoded_bytes + kept_bytes
+            for entry in self.entries:
+                if entry.key in sampled:
+                    continue
+                original = len(entry.stream._data)
+                if skip_reason(entry, settings["dpi"]) is not None:
+                    estimate += original
+                elif bytes_per_pixel:
+                    # The gate keeps the original when encoding doesn't pay off
+                    estimate += min(original, bytes_per_pixel * self._output_pixels(entry, settings["dpi"]))
+                else:
+                    estimate += original
+            self._image_estimates[key] = estimate
+        return self._image_estimates[key] * self.image_scale
+
+    def page_sample(self, settings):
+        """sample_pages of the document for settings, run once per level and strip policy"""
+        key = (settings["level"], tuple(settings.get("strip", SAFE)), settings.get("optimize", True))
+        if key not in self._page_samples:
+            self._page_samples[key] = sample_pages(self.analysis.reader, settings)
+        return self._page_samples[key]
+
+    def other_bytes(self, settings):
+        """Estimated bytes of everything but image data: structure, content and other streams"""
+        count, _, structure, before, after, stripped = self.page_sample(settings)
+        scale = len(self.analysis.reader.pages) / count if count else 0
+        content_ratio = after / before if before else 1.0
+        # Thumbnails, XMP packets and the like are mostly streams
+        kept_streams = max(0, self.other_streams - stripped * scale)
+        return max(0, structure * scale + kept_streams + self.contents * content_ratio + self.other_correction)
+
+    def estimate(self, settings):
+        """Estimated total output size in bytes"""
+        return self.other_bytes(settings) + self.image_bytes(settings)
+
+    def calibrate(self, settings, total_bytes, image_bytes):
+        """Correct the estimate with the measured result of a full pass"""
+        self.image_scale = 1.0
+        predicted = self.image_bytes(settings)
+        if predicted:
+            self.image_scale = image_bytes / predicted
+        self.other_correction = 0
+        self.other_correction = total_bytes - image_bytes - self.other_bytes(settings)
+
+
+def first_fitting(estimator, budget, lo, hi):
+    """Index of the gentlest ladder step from lo up to hi whose estimate fits budget
+
+    Assumes estimates shrink along the ladder, so this is a binary search.
+    Returns hi, whose estimate isn't checked, when no step before it fits.
+    """
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if estimator.estimate(LADDER[mid]) <= budget:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def compress_to_target(source, target_bytes, analysis=None, max_passes=MAX_FULL_PASSES, instr=None,
+                       linearize=False):
+    """Compress source to at most target_bytes, or as close as the ladder gets
+
+    Returns (sink, stats) like engine.compress_to_buffer. The stats also
+    record the chosen settings, the number of full passes and whether the
+    target was reached. With linearize, every pass is written linearized,
+    so the target holds for the linearized file.
+    """
+    start = time.perf_counter()
+    if analysis is None:
+        analysis = DocumentAnalysis(source, instr)
+    with (instr or NULL_INSTRUMENTATION).stage("estimate"):
+        estimator = SizeEstimator(analysis)
+    budget = target_bytes * HEADROOM
+
+    # The gentlest pass that fits, or the smallest one while none does, with
+    # the stats of that pass: (sink, size, settings, decisions, stripped)
+    best = None
+    failing = -1  # most aggressive step known not to fit
+    fitting = len(LADDER)  # gentlest step known to fit
+    passes = 0
+    while passes < max_passes:
+        # Until a step fits, the last one is tried when no estimate fits;
+        # afterwards only the steps between the two known ones are left
+        with (instr or NULL_INSTRUMENTATION).stage("estimate"):
+            step = first_fitting(estimator, budget, failing + 1, min(fitting, len(LADDER) - 1))
+        if not failing < step < fitting:
+            break
+        settings = LADDER[step]
+        log.info(f"Target {target_bytes} bytes: trying {settings}, estimated {estimator.estimate(settings):,.0f} bytes")
+
+        writer = analysis.compress_with(settings, instr=instr)
+        with (instr or NULL_INSTRUMENTATION).stage("write"):
+            sink = write_to_buffer(writer, linearize)
+        size = buffer_size(sink)
+        passes += 1
+        # A pass that fits is gentler than any that fitted before, and
+        # smaller than any that didn't
+        if size <= target_bytes or best is None or size < best[1]:
+            best = (sink, size, settings, summarize_decisions(analysis.image_stats.get("decisions", [])),
+                    dict(analysis.strip_stats))
+        if size <= target_bytes:
+            fitting = step
+            if size >= target_bytes * CLEAR_SLACK:
+                break
+        else:
+            failing = step
+        estimator.calibrate(settings, size, analysis.image_stats["image_bytes"])
+
+    sink, size, settings, decisions, stripped = best
+    stats = make_stats("target", analysis.size, size, start, instr)
+    stats.update({
+        "target_size": target_bytes,
+        "reached": size <= target_bytes,
+        "quality": settings["quality"],
+        "dpi": settings["dpi"],
+        "full_passes": passes,
+        "image_decisions": decisions,
+        "stripped": stripped,
+    })
+    if linearize:
+        stats["linearized"] = True
+    return sink, stats
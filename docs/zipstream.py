@@ -0,0 +1,87 @@
+"""ZIP archive layout for outputs that are already in memory elsewhere.
+
+ZipLayout only produces the bytes that go around the files: a local header
+before each one and the central directory at the end. The caller places
+each file's data right after its header, so an archive of several outputs
+can be assembled (in the browser, as a Blob of parts) without copying them
+into one buffer. Files are stored, not deflated: compressed PDFs would not
+get smaller. CRC-32s are computed by the caller, once, when each output is
+produced (see crc32).
+"""
+
+import struct
+import time
+import zlib
+
+# Version 2.0 of the format, the first with stored files in subdirectories
+ZIP_VERSION = 20
+# General purpose flag: file names are UTF-8
+UTF8_FLAG = 0x800
+# The sizes and offsets of a plain (not ZIP64) archive are 32-bit
+MAX_ZIP_SIZE = 0xFFFFFFFF
+
+
+def crc32(data, value=0):
+    """CRC-32 of data (bytes-like), continuing from value"""
+    return zlib.crc32(data, value)
+
+
+def _dos_time(timestamp):
+    year, month, day, hour, minute, second = time.localtime(timestamp)[:6]
+    year = max(year, 1980)
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+
+class ZipLayout:
+    """Headers and central directory of a ZIP archive of stored files
+
+    Call add() for each file in order and write its header followed by the
+    file's data, then write finish(). Names are made unique by adding a
+    counter before the extension.
+    """
+
+    def __init__(self, timestamp=None):
+        self.time, self.date = _dos_time(time.time() if timestamp is None else timestamp)
+        self.entries = []
+        self.names = set()
+        self.offset = 0
+
+    def _unique(self, name):
+        base, dot, extension = name.rpartition(".")
+        if not dot:
+            base, extension = name, ""
+        candidate = name
+        count = 1
+        while candidate in self.names:
+            count += 1
+            candidate = f"{base}-{count}{dot}{extension}"
+        self.names.add(candidate)
+        return candidate
+
+    def add(self, name, size, crc):
+        """Return the local header of a file of size bytes with CRC-32 crc"""
+        encoded = self._unique(name).encode("utf-8")
+        header = struct.pack(
+            "<4s5H3L2H", b"PK\x03\x04", ZIP_VERSION, UTF8_FLAG, 0, self.time, self.date,
+            crc, size, size, len(encoded), 0,
+        ) + encoded
+        self.entries.append((encoded, size, crc, self.offset))
+        self.offset += len(header) + size
+        if self.offset > MAX_ZIP_SIZE:
+            raise ValueError("ZIP archives over 4 GB are not supported")
+        return header
+
+    def finish(self):
+        """Return the central directory and end record, after the last file"""
+        directory = b"".join(
+            struct.pack(
+                "<4s6H3L5H2L", b"PK\x01\x02", ZIP_VERSION, ZIP_VERSION, UTF8_FLAG, 0, self.time, self.date,
+                crc, size, size, len(name), 0, 0, 0, 0, 0, offset,
+            ) + name
+            for name, size, crc, offset in self.entries
+        )
+        end = struct.pack(
+            "<4s4H2LH", b"PK\x05\x06", 0, 0, len(self.entries), len(self.entries),
+            len(directory), self.offset, 0,
+        )
+        return directory + end
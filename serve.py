@@ -1,8 +1,232 @@
 #! /usr/bin/env python
+"""Serve the SovPDF web app (docs/) locally or on an intranet.
 
+Connections are handled concurrently and kept alive. Text assets are
+compressed once, at startup, with gzip and, if the brotli package is
+installed, brotli; each response carries an ETag, so a revalidating
+browser gets a 304 instead of the file again, and Range requests are
+answered with the requested bytes. Versioned assets (see VERSIONED) are
+cached by browsers for a year; everything else is revalidated on each use,
+so an update of the app shows up on the next load.
+"""
+
+import argparse
+import email.utils
+import functools
+import gzip
+import hashlib
 import http.server
-import socketserver
+import mimetypes
 import os
+import re
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "docs")
+
+# Content types of the files of a self-hosted Pyodide that mimetypes doesn't know
+CONTENT_TYPES = {
+    ".py": "text/x-python",
+    ".mjs": "text/javascript",
+    ".wasm": "application/wasm",
+    ".whl": "application/zip",
+    ".webmanifest": "application/manifest+json",
+}
+# Content types worth compressing, besides text/*
+COMPRESSIBLE_TYPES = {
+    "application/javascript", "application/json", "application/manifest+json", "application/wasm",
+    "application/xml", "image/svg+xml", "image/x-icon", "font/ttf", "font/otf",
+    "application/vnd.ms-fontobject",
+}
+# Files smaller than this fit in a packet either way
+MIN_COMPRESS_BYTES = 256
+# A compressed variant is only kept when it saves at least this fraction
+MIN_SAVING = 0.1
+# Files larger than this are read from disk on each request instead of held in memory
+MAX_MEMORY_BYTES = 16 * 1024 * 1024
+# A version number or content hash in the path, or a version in the query
+# string: the response at such a URL never changes
+VERSIONED = re.compile(
+    r"(?:^|[/_-])v?\d+\.\d+(?:\.\d+)*(?:[/._-]|$)"
+    r"|[._-][0-9a-f]{8,}\."
+    r"|(?:^|&)v(?:ersion)?="
+)
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+# Files over MAX_MEMORY_BYTES are sent in chunks of this size
+CHUNK_BYTES = 1024 * 1024
+# One range of bytes: "bytes=first-last", "bytes=first-" or "bytes=-suffix"
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+class Asset:
+    """A file of the served directory with its precomputed variants
+
+    variants maps a content coding ("identity", "br", "gzip") to the bytes
+    to send; identity is missing for files over MAX_MEMORY_BYTES, which are
+    read from path instead.
+    """
+
+    def __init__(self, path, content_type):
+        self.path = path
+        self.content_type = content_type
+        stat = os.stat(path)
+        self.stamp = (stat.st_mtime_ns, stat.st_size)
+        self.size = stat.st_size
+        self.last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        self.variants = {}
+        digest = hashlib.blake2b(digest_size=12)
+        with open(path, "rb") as f:
+            if self.size <= MAX_MEMORY_BYTES:
+                data = f.read()
+                digest.update(data)
+                self.variants["identity"] = data
+            else:
+                for chunk in iter(functools.partial(f.read, CHUNK_BYTES), b""):
+                    digest.update(chunk)
+        self.tag = digest.hexdigest()
+        if "identity" in self.variants and compressible(content_type) and self.size >= MIN_COMPRESS_BYTES:
+            data = self.variants["identity"]
+            limit = self.size * (1 - MIN_SAVING)
+            encoded = gzip.compress(data, 9, mtime=0)
+            if len(encoded) <= limit:
+                self.variants["gzip"] = encoded
+            if brotli is not None:
+                encoded = brotli.compress(data, quality=11)
+                if len(encoded) <= limit:
+                    self.variants["br"] = encoded
+
+    def etag(self, coding):
+        """The ETag of the variant in coding; each variant has its own"""
+        if coding == "identity":
+            return f'"{self.tag}"'
+        return f'"{self.tag}-{coding}"'
+
+    def matches(self, header):
+        """Whether an If-None-Match or If-Range header names any variant"""
+        if header.strip() == "*":
+            return True
+        tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+        return any(self.etag(coding) in tags for coding in ("identity", *self.variants))
+
+    def fresh(self):
+        """Whether the file is unchanged since the asset was read"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_mtime_ns, stat.st_size) == self.stamp
+
+    def send(self, wfile, start, end):
+        """Write bytes start to end (exclusive) of the file to wfile"""
+        data = self.variants.get("identity")
+        if data is not None:
+            wfile.write(memoryview(data)[start:end])
+            return
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            while start < end:
+                chunk = f.read(min(CHUNK_BYTES, end - start))
+                if not chunk:
+                    break
+                wfile.write(chunk)
+                start += len(chunk)
+
+
+def content_type(path):
+    """The Content-Type to serve the file at path with"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in CONTENT_TYPES:
+        return CONTENT_TYPES[extension]
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def compressible(content_type):
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+def accepted_codings(header):
+    """The content codings an Accept-Encoding header allows"""
+    codings = set()
+    for item in (header or "").split(","):
+        name, _, params = item.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        codings.add(name.strip().lower())
+    return codings
+
+
+def byte_range(header, size):
+    """(start, end) of a single-range Range header, None to ignore it, or False if unsatisfiable"""
+    match = _RANGE.match(header.strip())
+    if match is None:
+        # Several ranges or another unit: answering with the whole file is allowed
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        start, end = max(0, size - int(last)), size
+    else:
+        start = int(first)
+        end = min(size, int(last) + 1) if last else size
+        if last and int(last) < start:
+            return None
+    if start >= end:
+        return False
+    return start, end
+
+
+class AssetStore:
+    """The assets of a directory, read and compressed once each
+
+    preload reads every file up front; a file that changes or appears later
+    is read on its next request.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.assets = {}
+        self.lock = threading.Lock()
+
+    def preload(self):
+        """Load every file below root; return (files, bytes, compressed bytes)"""
+        files = size = compressed = 0
+        for directory, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [name for name in dirnames if not name.startswith(".") and name != "__pycache__"]
+            for name in filenames:
+                if name.startswith("."):
+                    continue
+                asset = self.get(os.path.join(directory, name))
+                files += 1
+                size += asset.size
+                compressed += min(len(data) for data in asset.variants.values()) if asset.variants else asset.size
+        return files, size, compressed
+
+    def get(self, path):
+        """The Asset for the file at path"""
+        asset = self.assets.get(path)
+        if asset is not None and asset.fresh():
+            return asset
+        with self.lock:
+            asset = self.assets.get(path)
+            if asset is None or not asset.fresh():
+                asset = Asset(path, content_type(path))
+                self.assets[path] = asset
+        return asset
+
 
 class CORSHTTPHandler(http.server.SimpleHTTPRequestHandler):
     def end_headers(self):
@@ -13,11 +237,154 @@ class CORSHTTPHandler(http.server.SimpleHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Origin', '*')
         super().end_headers()
 
-if __name__ == "__main__":
-    port = 8000
-    os.chdir("./src/")
-    # Using "localhost" instead of empty string or "0.0.0.0" ensures PyScript works properly
-    with socketserver.TCPServer(("localhost", port), CORSHTTPHandler) as httpd:
-        print(f"Serving HTTP on localhost port {port} (http://localhost:{port}/)...")
-        httpd.serve_forever()
 
+class StaticHandler(CORSHTTPHandler):
+    """Serves the files of an AssetStore with compression, validation and ranges
+
+    Directories without an index.html and missing files are left to
+    SimpleHTTPRequestHandler.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes: without this, each
+    # kept-alive response waits out the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def __init__(self, *args, store, **kwargs):
+        self.store = store
+        super().__init__(*args, directory=store.root, **kwargs)
+
+    def do_GET(self):
+        self.serve(head=False)
+
+    def do_HEAD(self):
+        self.serve(head=True)
+
+    def asset_path(self):
+        """The file to serve for this request, or None to fall back to SimpleHTTPRequestHandler"""
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            if not urlsplit(self.path).path.endswith("/"):
+                # The base class redirects to the URL with a slash
+                return None
+            path = os.path.join(path, "index.html")
+        return path if os.path.isfile(path) else None
+
+    def serve(self, head):
+        path = self.asset_path()
+        if path is None:
+            if head:
+                super().do_HEAD()
+            else:
+                super().do_GET()
+            return
+        try:
+            asset = self.store.get(path)
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+
+        url = urlsplit(self.path)
+        versioned = VERSIONED.search(url.path) or VERSIONED.search(url.query)
+        cache_control = IMMUTABLE if versioned else REVALIDATE
+
+        status = 200
+        accepted = accepted_codings(self.headers.get("Accept-Encoding"))
+        coding = next((c for c in ("br", "gzip") if c in asset.variants and c in accepted), "identity")
+        start, end = 0, asset.size
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            not_modified = asset.matches(if_none_match)
+        else:
+            since = self.headers.get("If-Modified-Since")
+            not_modified = since is not None and since == asset.last_modified
+        if not_modified:
+            status = 304
+        elif self.headers.get("Range") and asset.matches(self.headers.get("If-Range", "*")):
+            # Ranges are counted in the bytes of the file itself
+            span = byte_range(self.headers["Range"], asset.size)
+            if span is False:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{asset.size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if span is not None:
+                status = 206
+                coding = "identity"
+                start, end = span
+
+        self.send_response(status)
+        self.send_header("ETag", asset.etag(coding))
+        self.send_header("Last-Modified", asset.last_modified)
+        self.send_header("Cache-Control", cache_control)
+        if len(asset.variants) > 1:
+            self.send_header("Vary", "Accept-Encoding")
+        if status == 304:
+            self.end_headers()
+            return
+        self.send_header("Content-Type", asset.content_type)
+        self.send_header("Accept-Ranges", "bytes")
+        if coding != "identity":
+            body = asset.variants[coding]
+            self.send_header("Content-Encoding", coding)
+        else:
+            body = None
+            if status == 206:
+                self.send_header("Content-Range", f"bytes {start}-{end - 1}/{asset.size}")
+        self.send_header("Content-Length", str(len(body) if body is not None else end - start))
+        self.end_headers()
+        if head:
+            return
+        try:
+            if body is None:
+                asset.send(self.wfile, start, end)
+            else:
+                self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+class QuietStaticHandler(StaticHandler):
+    # One log line per request would slow down a busy server
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(root=ROOT, bind="localhost", port=8000, quiet=False):
+    """A threaded HTTP server for the files below root, with every asset preloaded"""
+    handler = QuietStaticHandler if quiet else StaticHandler
+    store = AssetStore(root)
+    start = time.perf_counter()
+    files, size, compressed = store.preload()
+    print(f"Loaded {files} files, {size / 1024:,.0f} kB, {compressed / 1024:,.0f} kB compressed "
+          f"({'brotli and gzip' if brotli is not None else 'gzip'}) in {time.perf_counter() - start:.2f} s",
+          file=sys.stderr)
+    httpd = http.server.ThreadingHTTPServer((bind, port), functools.partial(handler, store=store))
+    httpd.daemon_threads = True
+    return httpd
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-p", "--port", type=int, default=8000)
+    # "localhost" rather than "" or "0.0.0.0" by default, so PyScript works properly
+    parser.add_argument("-b", "--bind", default="localhost",
+                        help="address to listen on; browsers only allow PyScript's workers on "
+                             "localhost or over HTTPS")
+    parser.add_argument("-d", "--directory", default=ROOT, help="directory to serve")
+    parser.add_argument("-q", "--quiet", action="store_true", help="don't log each request")
+    args = parser.parse_args(argv)
+
+    with make_server(args.directory, args.bind, args.port, args.quiet) as httpd:
+        print(f"Serving HTTP on {args.bind} port {args.port} (http://{args.bind}:{args.port}/)...",
+              file=sys.stderr)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,6 @@
+"""Test setup: the engine lives next to the web app so the browser can load it too."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "docs"))
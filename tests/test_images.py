@@ -0,0 +1,62 @@
+"""Image re-encoding keeps what isn't pixels."""
+
+import random
+from io import BytesIO
+
+from PIL import Image
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject, NumberObject
+
+from engine import compress_to_buffer
+
+
+def _image(writer, img, **entries):
+    """Add img as an uncompressed image XObject to writer and return its reference"""
+    stream = DecodedStreamObject()
+    stream.set_data(img.tobytes())
+    stream.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Image"),
+        NameObject("/Width"): NumberObject(img.width),
+        NameObject("/Height"): NumberObject(img.height),
+        NameObject("/BitsPerComponent"): NumberObject(1 if img.mode == "1" else 8),
+        **{NameObject(k): v for k, v in entries.items()},
+    })
+    if img.mode != "1":
+        stream[NameObject("/ColorSpace")] = NameObject("/DeviceRGB")
+    return writer._add_object(stream)
+
+
+def _stencil_masked_pdf():
+    """One page showing a noisy 600x600 RGB photo with a 1-bit stencil /Mask of another size"""
+    rng = random.Random(7)
+    photo = Image.new("RGB", (600, 600))
+    photo.putdata([(rng.randrange(256), rng.randrange(256), 128) for _ in range(600 * 600)])
+    stencil = Image.new("1", (300, 300), 1)
+    stencil.paste(0, (0, 0, 150, 300))
+    writer = PdfWriter()
+    page = writer.add_blank_page(300, 300)
+    mask = _image(writer, stencil, **{"/ImageMask": NumberObject(1)})
+    del mask.get_object()["/BitsPerComponent"]
+    image = _image(writer, photo, **{"/Mask": mask})
+    page[NameObject("/Resources")] = DictionaryObject({
+        NameObject("/XObject"): DictionaryObject({NameObject("/Im0"): image}),
+    })
+    content = DecodedStreamObject()
+    content.set_data(b"q 300 0 0 300 0 0 cm /Im0 Do Q")
+    page.replace_contents(content)
+    buffer = BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def test_stencil_mask_is_kept_when_reencoding():
+    sink, stats = compress_to_buffer(_stencil_masked_pdf(), "tiny")
+    assert stats["image_decisions"] == {"encoded": 1}
+    page = PdfReader(sink).pages[0]
+    image = page["/Resources"]["/XObject"]["/Im0"].get_object()
+    assert image["/Filter"] == "/DCTDecode"
+    assert image["/Width"] < 600
+    mask = image["/Mask"].get_object()
+    assert mask["/ImageMask"]
+    assert (mask["/Width"], mask["/Height"]) == (300, 300)
@@ -0,0 +1,43 @@
+"""Merging identical objects leaves every reference pointing at a kept object."""
+
+from pypdf import PdfWriter
+from pypdf.generic import DictionaryObject, IndirectObject, NameObject, NumberObject
+
+from optimize import _iter_refs, merge_identical_objects
+
+
+def _font_pdf():
+    """Three pages with a font each: the last two share a descriptor, the first has a copy of it
+
+    The third font merges into the second at once; the second only matches
+    the first once the descriptors merge, so the third merges through it.
+    """
+    writer = PdfWriter()
+    fonts = [DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"), NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Body"),
+    }) for _ in range(3)]
+    refs = [writer._add_object(font) for font in fonts]
+    descriptors = [writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/FontDescriptor"), NameObject("/FontName"): NameObject("/Body"),
+        NameObject("/Flags"): NumberObject(32),
+    })) for _ in range(2)]
+    for font, descriptor in zip(fonts, descriptors[:1] + descriptors[1:] * 2):
+        font[NameObject("/FontDescriptor")] = descriptor
+    for ref in refs:
+        page = writer.add_blank_page(100, 100)
+        page[NameObject("/Resources")] = DictionaryObject({
+            NameObject("/Font"): DictionaryObject({NameObject("/F1"): ref}),
+        })
+    return writer
+
+
+def test_chained_merges_point_at_the_final_object():
+    writer = _font_pdf()
+    assert merge_identical_objects(writer) == 3
+    objects = writer._objects
+    fonts = {page["/Resources"]["/Font"].raw_get("/F1").idnum for page in writer.pages}
+    assert len(fonts) == 1
+    for obj in objects:
+        for ref in _iter_refs(obj) if obj is not None else ():
+            assert isinstance(ref, IndirectObject) and objects[ref.idnum - 1] is not None